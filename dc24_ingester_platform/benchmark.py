@@ -0,0 +1,241 @@
+"""
+End to end throughput benchmark for the ingester engine.
+
+Synthetic data sources are sampled, fetched, staged and archived through a real
+IngesterServiceDB and RepositoryDB on SQLite, for each combination of dataset
+count, entries per fetch and file size. The samplers are run by the engine's
+sampler loop on a Clock, which is moved on a sampling period each round, so the
+sampler schedule and state cache are part of what is measured. For each combination the entries/s,
+task latency (from the ingest task being created to it being complete) and
+peak RSS are reported. Each combination runs in its own process, so the peak
+RSS of one does not hide that of the next.
+
+Usage: run_benchmark [options], see --help
+"""
+import os
+import sys
+import time
+import datetime
+import shutil
+import tempfile
+import threading
+import itertools
+import logging
+import resource
+import multiprocessing
+from optparse import OptionParser
+from twisted.internet.task import Clock
+
+from dc24_ingester_platform.mock import MockDataSource
+from dc24_ingester_platform.ingester import IngesterEngine
+from dc24_ingester_platform.service import ingesterdb, repodb
+from jcudc24ingesterapi.models.locations import Location
+from jcudc24ingesterapi.models.dataset import Dataset
+from jcudc24ingesterapi.models.data_entry import DataEntry, FileObject
+from jcudc24ingesterapi.models.data_sources import PullDataSource
+from jcudc24ingesterapi.models.sampling import PeriodicSampling
+from jcudc24ingesterapi.schemas.data_entry_schemas import DataEntrySchema
+from jcudc24ingesterapi.schemas.data_types import FileDataType, Double
+
+logger = logging.getLogger("dc24_ingester_platform.benchmark")
+
+# The sampling rate of the synthetic datasets. Each round moves the sampler clock on by this much
+SAMPLE_RATE = 3600
+# The longest time to wait for a round of tasks to complete, in s
+ROUND_TIMEOUT = 600
+
+class SyntheticDataSource(MockDataSource):
+    """Produces a fixed number of data entries per fetch, each optionally with a file"""
+    entries = 1
+    file_size = 0
+
+    def fetch(self, cwd, service=None):
+        ret = []
+        for i in range(self.entries):
+            data_entry = DataEntry(timestamp=datetime.datetime.now())
+            data_entry["x"] = float(i)
+            if self.file_size > 0:
+                f_name = "f-%d"%i
+                with open(os.path.join(cwd, f_name), "wb") as f:
+                    f.write(os.urandom(self.file_size))
+                data_entry["file"] = FileObject(f_name)
+            ret.append(data_entry)
+        return ret
+
+class BenchmarkClock(Clock):
+    """A Clock standing in for the reactor. Calls the workers make from their threads
+    are queued, and run on the benchmark's thread by run_pending."""
+    def __init__(self):
+        Clock.__init__(self)
+        self._pending = []
+        self._lock = threading.Lock()
+        
+    def callFromThread(self, f, *args, **kwargs):
+        with self._lock:
+            self._pending.append((f, args, kwargs))
+            
+    def run_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for f, args, kwargs in pending:
+            f(*args, **kwargs)
+
+class BenchmarkService(ingesterdb.IngesterServiceDB):
+    """Records the time each ingest task takes from creation to completion"""
+    def __init__(self, db_url, repo):
+        ingesterdb.IngesterServiceDB.__init__(self, db_url, repo)
+        self._started = {}
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def create_ingest_task(self, *args, **kwargs):
+        task_id = ingesterdb.IngesterServiceDB.create_ingest_task(self, *args, **kwargs)
+        with self._lock:
+            self._started[task_id] = time.time()
+        return task_id
+
+    def mark_ingest_complete(self, ingest_task_id, node_id=None):
+        ret = ingesterdb.IngesterServiceDB.mark_ingest_complete(self, ingest_task_id, node_id)
+        with self._lock:
+            self.latencies.append(time.time() - self._started.pop(ingest_task_id))
+        return ret
+
+    def completed(self):
+        with self._lock:
+            return len(self.latencies)
+
+def percentile(values, p):
+    """Returns the p (0-1) percentile of values, by the nearest rank"""
+    values = sorted(values)
+    if len(values) == 0: return None
+    return values[int(round(p * (len(values) - 1)))]
+
+def create_datasets(service, count):
+    schema = DataEntrySchema("benchmark")
+    schema.addAttr(Double("x"))
+    schema.addAttr(FileDataType("file"))
+    schema = service.persist(schema)
+    location = service.persist(Location(10.0, 11.0))
+    datasets = []
+    for i in range(count):
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = location.id
+        dataset.data_source = PullDataSource("http://localhost/", None, field="file",
+                                             sampling=PeriodicSampling(SAMPLE_RATE))
+        datasets.append(service.persist(dataset))
+    return datasets
+
+def run_benchmark(datasets, entries, file_size, rounds=3, ingress_workers=4, archive_workers=1):
+    """Run one benchmark configuration in this process.
+
+    :param datasets: the number of datasets
+    :param entries: the number of data entries each fetch produces
+    :param file_size: the size in bytes of the file attached to each entry, 0 for none
+    :param rounds: the number of times every dataset is sampled
+    :returns: dict of the results
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        staging = os.path.join(tmp, "staging")
+        os.mkdir(staging)
+        repo = repodb.RepositoryDB({"db":"sqlite:///%s"%os.path.join(tmp, "repo.db"),
+                                    "files":os.path.join(tmp, "files")})
+        service = BenchmarkService("sqlite:///%s"%os.path.join(tmp, "ingester.db"), repo)
+        dataset_list = create_datasets(service, datasets)
+
+        def data_source_factory(data_source_config, state, parameters):
+            data_source = SyntheticDataSource(state, parameters, data_source_config)
+            data_source.entries = entries
+            data_source.file_size = file_size
+            return data_source
+
+        clock = BenchmarkClock()
+        # Start from now, so the sampler times are realistic
+        clock.advance(time.time())
+        ingester = IngesterEngine(service, staging, data_source_factory, archive_workers=archive_workers,
+                                  reactor=clock)
+        workers = [threading.Thread(target=ingester.process_ingress_queue) for i in range(ingress_workers)]
+        workers += [threading.Thread(target=ingester.process_archive_queue, kwargs={"shard":i})
+                    for i in range(archive_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            start = time.time()
+            # Every sampler is due straight away, so the first round runs now
+            ingester.start_samplers(clock)
+            for r in range(rounds):
+                if r > 0:
+                    # The samplers all come due again a period after the last round
+                    clock.advance(SAMPLE_RATE)
+                # Wait for the round to finish, so each dataset is only fetched once at a time
+                timeout = time.time() + ROUND_TIMEOUT
+                while service.completed() < (r + 1) * datasets:
+                    if time.time() > timeout:
+                        raise Exception("Round %d did not complete in %ds"%(r, ROUND_TIMEOUT))
+                    clock.run_pending()
+                    time.sleep(0.01)
+                clock.run_pending()
+            elapsed = time.time() - start
+        finally:
+            ingester.shutdown()
+
+        total = rounds * datasets * entries
+        return {"datasets":datasets, "entries":entries, "file_size":file_size,
+                "entries_per_s":total / elapsed, "bytes_per_s":total * file_size / elapsed,
+                "p50":percentile(service.latencies, 0.5), "p99":percentile(service.latencies, 0.99),
+                # ru_maxrss is in KB on Linux
+                "peak_rss_mb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    finally:
+        shutil.rmtree(tmp, True)
+
+def _run_child(queue, args, kwargs):
+    try:
+        queue.put(run_benchmark(*args, **kwargs))
+    except Exception, e:
+        logger.exception("Benchmark failed")
+        queue.put({"error":str(e)})
+
+def run_isolated(*args, **kwargs):
+    """Run a benchmark configuration in a new process, returning its results"""
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_child, args=(queue, args, kwargs))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+def _int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--datasets", default="1,10,100", help="comma separated dataset counts [%default]")
+    parser.add_option("--entries", default="1,100", help="comma separated entries per fetch [%default]")
+    parser.add_option("--file-sizes", default="0,65536", help="comma separated file sizes, in bytes [%default]")
+    parser.add_option("--rounds", type="int", default=3, help="number of times each dataset is sampled [%default]")
+    parser.add_option("--ingress-workers", type="int", default=4, help="number of ingress threads [%default]")
+    parser.add_option("--archive-workers", type="int", default=1, help="number of archive threads [%default]")
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    print "%8s %8s %10s %12s %12s %9s %9s %9s"%("datasets", "entries", "file_size", "entries/s",
+                                                 "MB/s", "p50 (s)", "p99 (s)", "RSS (MB)")
+    for datasets, entries, file_size in itertools.product(_int_list(options.datasets),
+                    _int_list(options.entries), _int_list(options.file_sizes)):
+        result = run_isolated(datasets, entries, file_size, rounds=options.rounds,
+                              ingress_workers=options.ingress_workers, archive_workers=options.archive_workers)
+        if "error" in result:
+            print "%8d %8d %10d failed: %s"%(datasets, entries, file_size, result["error"])
+            continue
+        print "%8d %8d %10d %12.1f %12.2f %9.3f %9.3f %9.1f"%(datasets, entries, file_size,
+                result["entries_per_s"], result["bytes_per_s"] / 1048576.0, result["p50"],
+                result["p99"], result["peak_rss_mb"])
+        sys.stdout.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
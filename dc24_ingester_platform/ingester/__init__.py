@@ -17,195 +17,883 @@ import shutil
 import json
 import Queue
 import traceback
+import uuid
+import threading
+import contextlib
+import cProfile
+import pstats
+import StringIO
 
 from processor import *
 from dc24_ingester_platform.utils import *
-from twisted.internet.task import LoopingCall
-from dc24_ingester_platform.ingester.sampling import create_sampler
+from dc24_ingester_platform.ingester.sampling import create_sampler, to_epoch, SamplerSchedule,\
+    SamplerStateCache
 from dc24_ingester_platform.ingester.data_sources import create_data_source
+from dc24_ingester_platform.ingester.queues import IngressQueue, ShardedQueue, OverflowFile,\
+    LANE_MANUAL, LANE_SCHEDULED, LANE_DERIVED
+from dc24_ingester_platform.ingester.staging import ENTRIES_FILE, write_entries, read_entries,\
+    dataset_batches
+from dc24_ingester_platform.ingester.metrics import Metrics
+from twisted.internet import defer, threads
+from twisted.internet.task import LoopingCall
 from jcudc24ingesterapi.ingester_platform_api import Marshaller
 from jcudc24ingesterapi.models.data_sources import DatasetDataSource
+from jcudc24ingesterapi.models.dataset import Dataset
+from jcudc24ingesterapi.models.data_entry import FileObject
 from jcudc24ingesterapi.ingester_exceptions import InvalidObjectError, OperationFailedException
 
 logger = logging.getLogger("dc24_ingester_platfor.ingester")
 
+# How long to wait before asking a sampler again, when it can't say when it is next due
+SAMPLER_POLL_INTERVAL = 15
+# Threads left in the reactor pool for everything other than the ingester workers
+RESERVED_THREADS = 10
+# Cluster mode: seconds a node's lease on a task or role lasts without being renewed
+DEFAULT_LEASE_TIME = 60
+# Cluster mode: how often a node renews its leases and claims new tasks
+CLAIM_INTERVAL = 2
+# Cluster mode: the role held by the one node that runs the samplers
+SAMPLER_ROLE = "sampler"
+# The most data entries handed to the repository at a time. A batch is checkpointed
+# once it is stored, or after each entry if the repository stores them one at a time.
+ARCHIVE_BATCH_SIZE = 500
+# New entries in a source dataset are collected for up to this many seconds, or until
+# there are this many, before its derived datasets are run over all of them at once
+TRIGGER_WINDOW = 5
+TRIGGER_BATCH_SIZE = 500
+# The number of functions kept in the stats of a profiled processing script
+PROFILE_STATS_LINES = 50
+# Samplers are held back while the staging directory has less free space (bytes) than this
+MIN_STAGING_FREE_SPACE = 100 * 1024 * 1024
+
+def count_file_bytes(data_entries, cwd, total):
+    """Yield the data entries, adding the size of the files they reference to total[0]"""
+    for data_entry in data_entries:
+        for value in data_entry.data.values():
+            if isinstance(value, FileObject):
+                path = os.path.join(cwd, value.f_path)
+                if os.path.isfile(path): total[0] += os.path.getsize(path)
+        yield data_entry
+
+def free_space(path):
+    """Returns the bytes available to us on the file system holding path, or None
+    if it can't be determined on this platform"""
+    if not hasattr(os, "statvfs"): return None
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
 class IngesterEngine(object):
-    def __init__(self, service, staging_dir, data_source_factory):
+    def __init__(self, service, staging_dir, data_source_factory, ingress_kind_limits=None, archive_workers=1,
+                 reactor=None, node_id=None, lease_time=DEFAULT_LEASE_TIME, claim_limit=10, queue_size=0,
+                 min_free_space=MIN_STAGING_FREE_SPACE, dataset_weights=None, async_fetch=False):
         """Create an ingester engine, and register itself with the service facade.
+        
+        :param ingress_kind_limits: optional dict of data source kind to the maximum
+            number of concurrent fetches of that kind
+        :param archive_workers: the number of archive queue shards, each of which
+            should have its own process_archive_queue worker
+        :param reactor: the reactor the sampler loop runs on. The worker threads hand
+            their changes to the sampler schedule to it. May be None if the sampler loop
+            isn't started.
+        :param node_id: unique name of this node when several ingesters share the
+            database. If None this is the only node, and owns every task and the samplers.
+        :param lease_time: cluster mode: seconds before the tasks and roles of a node
+            that has stopped renewing them can be taken over by another node
+        :param claim_limit: cluster mode: the most ingress tasks to hold locally
+        :param queue_size: the most tasks to hold in memory on the ingress queue, and
+            on each archive queue shard. The rest are spilled to disk. 0 for no limit.
+        :param min_free_space: the samplers are held back while the staging directory
+            has less than this many bytes free
+        :param dataset_weights: dict of dataset ID to its share of the ingress workers
+            relative to other datasets with waiting tasks. The default weight is 1, so
+            a bulk backfill can be given 0.1 to leave more room for the others.
+            Weights must be positive, ValueError is raised otherwise.
+        :param async_fetch: fetch the data sources that support it on the reactor,
+            rather than blocking an ingress worker. Otherwise all data sources are
+            fetched synchronously by the ingress workers.
         """
         self.service = service
         self.service.register_observation_listener(self)
+        self.service.ingester = self # For invoke_ingester
         self.staging_dir = staging_dir
         if not os.path.exists(self.staging_dir): os.makedirs(self.staging_dir)
-        self._ingress_queue = Queue.Queue()
-        self._archive_queue = Queue.Queue()
+        self.node_id = node_id
+        self.min_free_space = min_free_space
+        self.domain_marshaller = Marshaller()
+        self._ingress_queue = IngressQueue(ingress_kind_limits, queue_size, 
+                lambda lane, ds_id: self._overflow_file("ingress-%d-%s"%(lane, ds_id), self._encode_task, self._decode_task),
+                dataset_weights)
+        self._archive_queue = ShardedQueue(archive_workers, queue_size, 
+                lambda shard: self._overflow_file("archive-%d"%shard, None, tuple))
         self._data_source_factory = data_source_factory
         self.running = True
-        self.domain_marshaller = Marshaller()
+        self.reactor = reactor
+        self.async_fetch = async_fetch and reactor != None
+        
+        self._schedule = SamplerSchedule()
+        self._sampler_states = SamplerStateCache(service)
+        self._clock = None
+        self._sampler_call = None
+        self.service.register_dataset_listener(self)
+        
+        self.lease_time = lease_time
+        self.claim_limit = claim_limit
+        self._claimed = set() # IDs of the tasks this node holds leases on
+        self._lost = set() # IDs of claimed tasks another node has taken over, to be dropped
+        self._lost_lock = threading.Lock()
+        self._sampler_role = node_id == None
+        self._last_sync = None
+        self._claim_loop = None
+        
+        self._dependents = None # Source dataset ID to {derived dataset ID: derived dataset}
+        self._dependent_sources = {} # Derived dataset ID to its source dataset ID
+        self._dependents_lock = threading.RLock()
+        self._pending_triggers = {} # Derived dataset ID to (dataset, source ID, [entry IDs])
+        self._trigger_lock = threading.Lock()
+        self._flush_lock = threading.Lock() # Held while pending triggers are queued
+        node = self.node_id if self.node_id != None else "local"
+        self._trigger_journal_path = os.path.join(self.staging_dir, ".%s-triggers.journal"%node)
+        self._trigger_journal = None
+        self._trigger_loop = None
+        self._archiving = threading.local() # Whether this thread is persisting an archive batch
+        
+        self.metrics = Metrics()
+        self.metrics.gauge("ingester_ingress_queue_depth", self._ingress_queue.qsize)
+        self.metrics.gauge("ingester_ingress_in_flight", self._ingress_queue.in_flight)
+        self.metrics.gauge("ingester_archive_queue_depth", self._archive_queue.qsize)
+        self.metrics.gauge("ingester_scheduled_datasets", lambda: len(self._schedule))
+        
+    def _metric_labels(self, dataset):
+        """The labels the metrics of a dataset are recorded against"""
+        kind = dataset.data_source.__xmlrpc_class__ if dataset.data_source != None else None
+        return {"dataset":dataset.id, "kind":kind}
+        
+    def _overflow_file(self, name, encode, decode):
+        """Create an overflow file in the staging directory for one of our queues"""
+        node = self.node_id if self.node_id != None else "local"
+        return OverflowFile(os.path.join(self.staging_dir, ".%s-%s.overflow"%(node, name)), encode, decode)
+        
+    def _encode_task(self, task):
+        """Convert an ingress task to JSON so it can be spilled to disk"""
+        dataset, parameters, task_id, cwd = task
+        return [self.domain_marshaller.obj_to_dict(dataset), parameters, task_id, cwd]
+    
+    def _decode_task(self, item):
+        return (self.domain_marshaller.dict_to_obj(item[0]), item[1], item[2], item[3])
         
     def shutdown(self):
         """Signal that we want to shutdown to our threads"""
         self.running = False
+        if self._sampler_call != None and self._sampler_call.active():
+            self._sampler_call.cancel()
+        if self._claim_loop != None and self._claim_loop.running:
+            self._claim_loop.stop()
+        if self._trigger_loop != None and self._trigger_loop.running:
+            self._trigger_loop.stop()
+        # Don't leave new entries waiting in memory for their derived datasets
+        self._flush_triggers_safely()
+        if self.node_id != None and self._sampler_role:
+            try:
+                self.service.release_role(SAMPLER_ROLE, self.node_id)
+            except Exception, e:
+                logger.error("Error releasing the sampler role: %s"%str(e))
         
-    def process_samplers(self):
-        """Process all the active dataset samplers to determine which are
-        firing. Only one copy of this method will ever be running at a time.
+    def start_samplers(self, clock):
+        """Load the sampler schedule and start the sampler loop.
+        
+        :param clock: an IReactorTime provider, usually the reactor
         """
-        now = datetime.datetime.now()
+        self._clock = clock
+        self.load_samplers()
+        self._run_samplers()
+        
+    def load_samplers(self):
+        """Schedule the samplers of all the active datasets"""
+        if not self._sampler_role: return
+        self._sampler_states.load()
         datasets = self.service.get_active_datasets()
-        logger.info("Got %s datasets at %s"%(len(datasets), str(now)))
-        # Verify if the schedule has run
+        logger.info("Scheduling samplers for %d datasets"%(len(datasets)))
         for dataset in datasets:
-            if dataset.running: continue
-            if not hasattr(dataset.data_source, "sampling") or dataset.data_source.sampling == None: continue
-            self.process_sampler(now, dataset)
-
-        #self.processQueue()
+            self.schedule_sampler(dataset)
+            
+    def schedule_sampler(self, dataset, due=None):
+        """Put the dataset on the sampler schedule. If due is not provided the
+        sampler is asked when it is next due. Datasets without sampling are removed
+        from the schedule.
+        """
+        if not self._sampler_role: return
+        if dataset.data_source == None or not hasattr(dataset.data_source, "sampling") \
+                or dataset.data_source.sampling == None:
+            self._schedule.remove(dataset.id)
+            return
+        if due == None:
+            result = []
+            def next_sample(state):
+                sampler = create_sampler(dataset.data_source.sampling, state, dataset.id)
+                result.append(sampler.next_sample())
+            try:
+                # Keep any state next_sample sets, such as a staggered sampler's jittered
+                # slot, so the sampler fires at the time it is scheduled for
+                self._sampler_states.update(dataset.id, next_sample)
+                due = result[0]
+            except Exception, e:
+                logger.error("DATASET.id=%d: %s"%(dataset.id,str(e)))
+                self._schedule.remove(dataset.id)
+                return
+        if due == None:
+            due = time.time() + SAMPLER_POLL_INTERVAL
+        self._schedule.schedule(dataset, due)
+        self._wake_samplers(due)
+        
+    def notify_dataset_changed(self, dataset):
+        """Notification that a dataset has been persisted, enabled or disabled.
+        :param dataset: the dataset domain object, as it now is
+        """
+        if dataset.enabled:
+            self.schedule_sampler(dataset)
+        else:
+            self._schedule.remove(dataset.id)
+        self._update_dependents(dataset)
+        
+    def load_dependents(self):
+        """Build the index of source dataset IDs to the active derived datasets that
+        run over their new entries"""
+        datasets = self.service.get_active_datasets(kind="dataset_data_source")
+        with self._dependents_lock:
+            self._dependents = {}
+            self._dependent_sources = {}
+            for dataset in datasets:
+                self._add_dependent(dataset)
+        logger.info("Indexed %d derived datasets"%len(datasets))
+    
+    def _add_dependent(self, dataset):
+        source_id = dataset.data_source.dataset_id
+        if source_id not in self._dependents:
+            self._dependents[source_id] = {}
+        self._dependents[source_id][dataset.id] = dataset
+        self._dependent_sources[dataset.id] = source_id
+        
+    def _update_dependents(self, dataset):
+        """Update the dependents index for a changed dataset"""
+        with self._dependents_lock:
+            if self._dependents == None: return # Not loaded yet, so nothing to update
+            source_id = self._dependent_sources.pop(dataset.id, None)
+            if source_id != None:
+                del self._dependents[source_id][dataset.id]
+                if len(self._dependents[source_id]) == 0:
+                    del self._dependents[source_id]
+            if dataset.enabled and isinstance(dataset.data_source, DatasetDataSource):
+                self._add_dependent(dataset)
+                
+    def get_dependents(self, source_id):
+        """Returns the active datasets derived from the source dataset"""
+        if self._dependents == None:
+            self.load_dependents()
+        with self._dependents_lock:
+            return self._dependents.get(source_id, {}).values()
+        
+    def _run_samplers(self):
+        """Run the samplers that are due, then sleep until the next one is due"""
+        # When called directly, rather than by the sampler call, that call is replaced
+        if self._sampler_call != None and self._sampler_call.active():
+            self._sampler_call.cancel()
+        self._sampler_call = None
+        try:
+            self.process_samplers()
+        except Exception, e:
+            logger.exception("Error while processing samplers")
+        self._wake_samplers(self._schedule.next_due())
+            
+    def _now(self):
+        """The sampler time in seconds since the epoch. This is the sampler clock's
+        time, which for the reactor is the wall clock time."""
+        return self._clock.seconds() if self._clock != None else time.time()
+        
+    def _wake_samplers(self, due):
+        """Make sure the sampler loop will wake up no later than due"""
+        if self._clock == None or due == None or not self.running:
+            return
+        delay = max(0, due - self._now())
+        if self._sampler_call != None and self._sampler_call.active():
+            if self._sampler_call.getTime() - self._clock.seconds() <= delay:
+                return
+            self._sampler_call.reset(delay)
+        else:
+            self._sampler_call = self._clock.callLater(delay, self._run_samplers)
+        
+    def process_samplers(self):
+        """Process the dataset samplers that are due to determine which are
+        firing, and reschedule them. Only one copy of this method will ever be running at a time.
+        """
+        now = datetime.datetime.fromtimestamp(self._now())
+        datasets = self._schedule.pop_due(to_epoch(now))
+        if len(datasets) == 0: return
+        with self.metrics.timer("ingester_sampling_seconds"):
+            self._process_due(now, datasets)
+            
+    def _process_due(self, now, datasets):
+        logger.info("Got %s due datasets at %s"%(len(datasets), str(now)))
+        
+        free = free_space(self.staging_dir)
+        if free != None and free < self.min_free_space:
+            logger.warn("Only %d bytes free in %s, holding back %d samplers"%(free, self.staging_dir, len(datasets)))
+            for dataset in datasets:
+                self.schedule_sampler(dataset, to_epoch(now) + SAMPLER_POLL_INTERVAL)
+            return
+        for dataset in datasets:
+            if dataset.running:
+                self.schedule_sampler(dataset, to_epoch(now) + SAMPLER_POLL_INTERVAL)
+                continue
+            self.schedule_sampler(dataset, self.process_sampler(now, dataset))
+        try:
+            self._sampler_states.flush()
+        except Exception, e:
+            logger.exception("Error while saving sampler states")
 
     def process_sampler(self, now, dataset):
         """To process a dataset:
-        1. load the sampler state
+        1. load the sampler state from the cache
         2. Call the sampler
-        3. If the sampler returns False, save the sampler state and exit
+        3. Update the cached sampler state, which is flushed after the pass
         4. If it returns True, mark the dataset as running, queue the dataset to run
+        
+        :returns: the time the sampler is next due, or None if it is unknown
         """
-        state = self.service.get_sampler_state(dataset.id)
+        result = []
+        def sample(state):
+            sampler = create_sampler(dataset.data_source.sampling, state, dataset.id)
+            result.append(sampler.sample(now, dataset))
+            result.append(sampler.next_sample())
         try:
-            sampler = create_sampler(dataset.data_source.sampling, state)
-            self.service.persist_sampler_state(dataset.id, sampler.state)
-            if sampler.sample(now, dataset):
+            self._sampler_states.update(dataset.id, sample)
+            fire, due = result
+            if fire:
+                self.metrics.incr("ingester_samples_total", self._metric_labels(dataset))
                 self.enqueue_ingress(dataset)
+            return due
         except Exception, e:
             logger.error("DATASET.id=%d: %s"%(dataset.id,str(e)))
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_tb(exc_traceback)
             self.service.log_ingester_event(dataset.id, datetime.datetime.now(), "ERROR", str(e))
+            # Back off rather than retrying straight away
+            return to_epoch(now) + SAMPLER_POLL_INTERVAL
+  
+    def record_fetch(self, dataset, count):
+        """Feed the number of entries a fetch produced back to the dataset's sampler,
+        so adaptive samplers can change their rate. The sampler states are only held
+        by the node with the sampler role, so other nodes record the count with the
+        service for the sampler node to apply when it next runs process_claims.
+        
+        :param count: the number of entries, or None if it is not known
+        """
+        if dataset.data_source == None or getattr(dataset.data_source, "sampling", None) == None:
+            return
+        if not self._sampler_role:
+            try:
+                self.service.record_fetch_feedback(dataset.id, count)
+            except Exception, e:
+                logger.error("DATASET.id=%d: could not record fetch feedback: %s"%(dataset.id,str(e)))
+            return
+        self._update_sampler(dataset, count)
+        
+    def _apply_fetch_feedback(self):
+        """Sampler node: apply the fetch counts other nodes have recorded"""
+        datasets = {}
+        for dataset_id, count in self.service.take_fetch_feedback():
+            if dataset_id not in datasets:
+                try:
+                    # A dataset being sampled right now is off the schedule
+                    datasets[dataset_id] = self._schedule.get(dataset_id) or self.service.get_dataset(dataset_id)
+                except Exception, e:
+                    logger.error("DATASET.id=%d: could not apply fetch feedback: %s"%(dataset_id,str(e)))
+                    datasets[dataset_id] = None
+            if datasets[dataset_id] != None:
+                self.record_fetch(datasets[dataset_id], count)
+            
+    def _update_sampler(self, dataset, count):
+        """Sampler node: update the sampler state with a fetch's count, and reschedule it"""
+        result = []
+        def update(state):
+            sampler = create_sampler(dataset.data_source.sampling, state, dataset.id)
+            sampler.record_fetch(count)
+            result.append(sampler.next_sample())
+        try:
+            self._sampler_states.update(dataset.id, update)
+        except Exception, e:
+            logger.error("DATASET.id=%d: %s"%(dataset.id,str(e)))
+            return
+        # The next sample may now be sooner than it is scheduled. This is called from
+        # the worker threads, and the schedule can only be changed from the reactor thread
+        if self.reactor != None:
+            self.reactor.callFromThread(self._reschedule_sampler, dataset, result[0])
+        else:
+            self._reschedule_sampler(dataset, result[0])
+            
+    def _reschedule_sampler(self, dataset, due):
+        if dataset.id in self._schedule:
+            self.schedule_sampler(dataset, due)
   
     def process_ingress_queue(self, single_pass=False):
-        """Process the pending ingress (fetch) and process queue"""
+        """Process the pending ingress (fetch) and process queue. Many copies of this
+        may run at once, the queue makes sure a dataset is only fetched by one at a time.
+        """
         running = True
         while (not single_pass and self.running) or (single_pass and running):
             if single_pass:
                 running = False
             try:
-                dataset, parameters, task_id, cwd = self._ingress_queue.get(True, 5)
+                task = self._ingress_queue.get(True, 5)
             except Queue.Empty:
                 # just loop, checking the running flag
                 continue
-            
-            state = self.service.get_data_source_state(dataset.id)
+            if self._lease_lost(task[2]):
+                self._drop_task(task[2])
+                self._ingress_queue.task_done(task)
+                continue
+            deferred = False
             try:
-                data_source = self._data_source_factory(dataset.data_source, state, parameters)
-                self.service.log_ingester_event(dataset.id, datetime.datetime.now(), "INFO", "Processing ")
-                
+                deferred = self._process_ingress(task)
+            finally:
+                if not deferred: self._ingress_queue.task_done(task)
+    
+    def _process_ingress(self, task):
+        """Fetch and process a single ingress task. 
+        
+        :returns: True if the fetch is continuing asynchronously, in which case the
+            task will be released when it is complete.
+        """
+        dataset, parameters, task_id, cwd = task
+        state = self.service.get_data_source_state(dataset.id)
+        try:
+            # The working directory is created as late as possible
+            if not os.path.exists(cwd): os.makedirs(cwd)
+            data_source = self._data_source_factory(dataset.data_source, state, parameters)
+            self.service.log_ingester_event(dataset.id, datetime.datetime.now(), "INFO", "Processing ")
+            
+            if self.async_fetch and hasattr(data_source, "fetch_async"):
+                self.reactor.callFromThread(self._fetch_async, task, data_source)
+                return True
+            
+            with self.metrics.timer("ingester_fetch_seconds", self._metric_labels(dataset)):
                 data_entries = data_source.fetch(cwd, self.service)
-                
-                if len(data_entries) > 0:
-                    if hasattr(data_source, "processing_script") and data_source.processing_script != None:
-                        data_entries = run_script(data_source.processing_script, cwd, data_entries)
-                    
-                    # Store the entries as a file on disk so that it is persistent during restarts
-                    if isinstance(data_entries, list):
-                        for entry in data_entries:
-                            entry.dataset = dataset.id
-                            
-                        # Write entries to disk so we can recover later
-                        entries_file = "ingest.json"
-                        with open(os.path.join(cwd, entries_file), "w") as f:
-                            json.dump(self.domain_marshaller.obj_to_dict(data_entries), f)
-                        
-                    else:
-                        # Rename the output file to be consistent
-                        shutil.move(data_entries, os.path.join(cwd, "ingest.json"))
-                        entries_file = "ingest.json"
-                    
-                    # Now queue for ingest
-                    self.enqueue_archive(task_id, entries_file, cwd)
-                
-                self.service.persist_data_source_state(dataset.id, data_source.state)
-                self.service.mark_ingress_complete(task_id)
-                
-            except Exception, e:
-                logger.error("DATASET.id=%d: %s"%(dataset.id,str(e)))
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback)
-                self.service.log_ingester_event(dataset.id, datetime.datetime.now(), "ERROR", str(e))
-  
-    def process_archive_queue(self, single_pass=False):
+            self._process_fetched(dataset, task_id, cwd, data_source, data_entries)
+        except Exception, e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback)
+            self._ingress_failed(dataset, e)
+        return False
+    
+    def _fetch_async(self, task, data_source):
+        """Run an asynchronous fetch from the reactor thread. The download does not
+        hold a thread, only the processing of the fetched entries is done in the thread pool.
+        """
+        dataset, parameters, task_id, cwd = task
+        pool = self.reactor.getThreadPool()
+        start = time.time()
+        def fetched(data_entries):
+            self.metrics.observe("ingester_fetch_seconds", time.time() - start, self._metric_labels(dataset))
+            return data_entries
+        d = defer.maybeDeferred(data_source.fetch_async, cwd, self.service)
+        d.addCallback(fetched)
+        d.addCallback(lambda data_entries: threads.deferToThreadPool(self.reactor, pool, 
+                                self._process_fetched, dataset, task_id, cwd, data_source, data_entries))
+        d.addErrback(lambda failure: threads.deferToThreadPool(self.reactor, pool, 
+                                self._ingress_failed, dataset, failure.value))
+        d.addErrback(lambda failure: logger.error("Error while handling failed fetch: %s"%(str(failure.value))))
+        d.addBoth(lambda ignored: self._ingress_queue.task_done(task))
+        return d
+        
+    def _ingress_failed(self, dataset, e):
+        logger.error("DATASET.id=%d: %s"%(dataset.id,str(e)))
+        self.metrics.incr("ingester_fetch_errors_total", self._metric_labels(dataset))
+        self.service.log_ingester_event(dataset.id, datetime.datetime.now(), "ERROR", str(e))
+    
+    def _process_fetched(self, dataset, task_id, cwd, data_source, data_entries):
+        """Run the processing script over the fetched entries, and queue them for archiving.
+        
+        :param data_entries: list or other iterable of data entries. They are written
+            to the staging file one at a time, so a generator is never held in memory.
+        """
+        labels = self._metric_labels(dataset)
+        count = 0
+        if not isinstance(data_entries, list) or len(data_entries) > 0:
+            if hasattr(data_source, "processing_script") and data_source.processing_script != None:
+                profiler = self._script_profiler(dataset)
+                try:
+                    with self.metrics.timer("ingester_script_seconds", labels):
+                        data_entries = run_script(data_source.processing_script, cwd, data_entries, profiler)
+                finally:
+                    if profiler != None: self._save_script_profile(dataset, profiler)
+            
+            # Store the entries as a file on disk so that it is persistent during restarts
+            entries_path = os.path.join(cwd, ENTRIES_FILE)
+            with self.metrics.timer("ingester_staging_seconds", labels):
+                if isinstance(data_entries, basestring):
+                    # Rename the script's output file to be consistent
+                    shutil.move(data_entries, entries_path)
+                    count = None
+                else:
+                    file_bytes = [0]
+                    count = write_entries(entries_path, count_file_bytes(data_entries, cwd, file_bytes),
+                                          self.domain_marshaller, dataset.id)
+            if count != None:
+                self.metrics.incr("ingester_fetched_entries_total", labels, count)
+                # The size of the files fetched, which aren't known if a script wrote the entries out itself
+                self.metrics.incr("ingester_staged_bytes_total", labels, file_bytes[0])
+        
+        self.service.persist_data_source_state(dataset.id, data_source.state)
+        self.record_fetch(dataset, count)
+        if not self.service.mark_ingress_complete(task_id, self.node_id):
+            self._drop_task(task_id)
+        elif count != 0:
+            # Now queue for ingest
+            self.enqueue_archive(task_id, ENTRIES_FILE, cwd, dataset.id, labels["kind"])
+        else:
+            # Nothing to archive
+            self.service.mark_ingest_complete(task_id, self.node_id)
+            self._claimed.discard(task_id)
+            shutil.rmtree(cwd, True)
+
+    def _script_profiler(self, dataset):
+        """Returns a profiler if this run of the dataset's processing script is to be profiled"""
+        try:
+            if self.service.take_script_profile_run(dataset.id):
+                return cProfile.Profile()
+        except Exception, e:
+            logger.error("DATASET.id=%d: could not check for profile request: %s"%(dataset.id,str(e)))
+        return None
+        
+    def _save_script_profile(self, dataset, profiler):
+        """Store the stats of a profiled processing script run, by cumulative time"""
+        try:
+            stream = StringIO.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_STATS_LINES)
+            self.service.persist_script_profile(dataset.id, datetime.datetime.now(), stream.getvalue())
+        except Exception, e:
+            logger.error("DATASET.id=%d: could not save script profile: %s"%(dataset.id,str(e)))
+
+    def process_archive_queue(self, single_pass=False, shard=0):
         """Process one entry in the ingest queue. 
         Each element in the queue may be many data entries, from the same data source.
+        
+        :param shard: the archive queue shard to work on. Tasks for a dataset are always
+            on the same shard, so they are archived in order.
+        
+        Entries are persisted ARCHIVE_BATCH_SIZE at a time, and an interrupted task
+        resumes from its last checkpoint. If the repository stores a batch atomically
+        the checkpoint is recorded once the batch is stored, and a crash in between
+        archives up to ARCHIVE_BATCH_SIZE entries twice. Otherwise the repository
+        reports each entry as it is stored and each is checkpointed, so at most one
+        entry is archived twice.
         """
         running = True
         while (not single_pass and self.running) or (single_pass and running):
             if single_pass:
                 running = False
             try:
-                task_id, entries_file, cwd = self._archive_queue.get(True, 5)
+                task_id, entries_file, cwd, kind = self._archive_queue.get(shard, True, 5)
             except Queue.Empty:
                 continue
+            if self._lease_lost(task_id):
+                self._drop_task(task_id)
+                continue
             try: 
-                with open(os.path.join(cwd, entries_file), "r") as f:
-                    entries = self.domain_marshaller.dict_to_obj(json.load(f))
-                    
-                for entry in entries:
-                    self.service.persist(entry, cwd)
-                # Cleanup
-                self.service.mark_ingest_complete(task_id)
+                # Resume from the last entry recorded as archived, if this task was interrupted
+                progress = self.service.get_ingest_progress(task_id)
+                if progress > 0:
+                    logger.info("Resuming archive of task %d after %d entries"%(task_id, progress))
+                entries = read_entries(os.path.join(cwd, entries_file), self.domain_marshaller, progress)
+                # Script written files can mix datasets, and a batch is only stored as
+                # a single unit if it is all from one dataset
+                for batch in dataset_batches(entries, ARCHIVE_BATCH_SIZE):
+                    if self._lease_lost(task_id): break
+                    labels = {"dataset":batch[0].dataset, "kind":kind}
+                    checkpointed = [0]
+                    def checkpoint(count, start=progress):
+                        # The repository stores entries one at a time, record each
+                        checkpointed[0] = count
+                        self.service.mark_ingest_progress(task_id, start + count)
+                    with self.metrics.timer("ingester_persist_seconds", labels):
+                        with self._archive_batch():
+                            self.service.persist_many(batch, cwd, checkpoint)
+                    self.metrics.incr("ingester_archived_entries_total", labels, len(batch))
+                    progress += len(batch)
+                    if checkpointed[0] < len(batch):
+                        self.service.mark_ingest_progress(task_id, progress)
+                # Cleanup, unless another node has taken the task over
+                if self._lease_lost(task_id) or not self.service.mark_ingest_complete(task_id, self.node_id):
+                    self._drop_task(task_id)
+                    continue
                 shutil.rmtree(cwd)
             except Exception, e:
                 logger.error("Error while archiving %d %s, not cleaning it up: %s"%(task_id, entries_file, str(e)))
-                self.service.mark_ingest_failed(task_id)
+                self.service.mark_ingest_failed(task_id, self.node_id)
+            self._claimed.discard(task_id)
   
-    def enqueue_ingress(self, dataset, parameters=None):
+    def enqueue_ingress(self, dataset, parameters=None, lane=LANE_SCHEDULED):
         """Enqueue the dataset for ingress and processing ASAP. The markRunning method
         is assumed to also persist the queue entry. The queue_id is the identifier
-        in the persistent store, so that the queued entry can be cleaned up."""
-        cwd = tempfile.mkdtemp(dir=self.staging_dir)
-        task_id = self.service.create_ingest_task(dataset.id, cwd, parameters)
-        self._ingress_queue.put( (dataset, parameters, task_id, cwd) )
+        in the persistent store, so that the queued entry can be cleaned up.
+        In cluster mode the task is left for the next node with capacity to claim.
+        The working directory is only created once the task is processed.
+        
+        :param lane: the priority lane, see queues.LANES
+        """
+        cwd = os.path.join(self.staging_dir, uuid.uuid4().hex)
+        task_id = self.service.create_ingest_task(dataset.id, cwd, parameters, lane)
+        if self.node_id == None:
+            self._ingress_queue.put( (dataset, parameters, task_id, cwd), lane )
 
-    def enqueue_archive(self, task_id, ingest_data, cwd):
+    def enqueue_archive(self, task_id, ingest_data, cwd, dataset_id, kind=None):
         """Queue a data entry for ingest into the repository
         :param task_id: the ID given to the ingest process task
         :param ingest_data: the data entries to be ingested
         :param cwd: the working directory for these data entries
+        :param dataset_id: the dataset being ingested, which decides the archive shard
+        :param kind: the dataset's data source kind, that the metrics are recorded against
         """
-        self._archive_queue.put((task_id, ingest_data, cwd))
+        self._archive_queue.put(dataset_id, (task_id, ingest_data, cwd, kind))
+        
+    @contextlib.contextmanager
+    def _archive_batch(self):
+        """The entries persisted in this block are from an archive batch. Their
+        derived dataset triggers are collected, rather than queued one by one"""
+        self._archiving.active = True
+        try:
+            yield
+        finally:
+            self._archiving.active = False
         
     def notify_new_data_entry(self, data_entry, cwd):
         """Notification of new data. On return it is expected that the cwd will be
         cleaned up, so any data that is required should be copied.
+        
+        The new entry is added to the pending batch of each listening dataset. For
+        entries from an archive batch, the batch builds up across archive batches and
+        tasks, and is queued for ingress once it is full or by the TRIGGER_WINDOW loop.
+        The pending entries are journalled to the staging directory before this returns,
+        so they survive a crash after the archive checkpoint. Entries stored any other
+        way, such as inserts through the management service, are queued straight away
+        as nothing else would flush them.
         :param data_entry: DataEntry object that is triggering
         :param cwd: the working directory for the data entry
         """
-        datasets = self.service.get_active_datasets(kind="dataset_data_source")
-        datasets = [ds for ds in datasets if ds.data_source.dataset_id==data_entry.dataset]
-        logger.info("Notified of new observation, telling %d listeners"%(len(datasets)))
-        for dataset in datasets:
-            self.enqueue_ingress(dataset, {"dataset":data_entry.dataset, "id":data_entry.id})
+        datasets = self.get_dependents(data_entry.dataset)
+        logger.debug("Notified of new observation, telling %d listeners"%(len(datasets)))
+        batched = getattr(self._archiving, "active", False)
+        full = []
+        with self._trigger_lock:
+            for dataset in datasets:
+                ids = self._add_trigger(dataset, data_entry.dataset, [data_entry.id])
+                if not batched or len(ids) >= TRIGGER_BATCH_SIZE:
+                    full.append(dataset.id)
+            if batched and len(datasets) > 0:
+                self._journal_triggers([[dataset.id, data_entry.dataset, data_entry.id] for dataset in datasets])
+        if len(full) > 0:
+            self._flush_triggers(full)
+        
+    def _add_trigger(self, dataset, source_id, entry_ids):
+        """Add entries to the pending batch of a derived dataset, with the trigger lock held.
+        
+        :returns: the pending entry IDs of the dataset
+        """
+        if dataset.id not in self._pending_triggers:
+            self._pending_triggers[dataset.id] = (dataset, source_id, [])
+        ids = self._pending_triggers[dataset.id][2]
+        ids += entry_ids
+        return ids
+        
+    def flush_triggers(self):
+        """Queue an ingress task for every derived dataset with pending new entries"""
+        self._flush_triggers(None)
+        
+    def _flush_triggers(self, dataset_ids):
+        """Queue the pending triggers of the derived datasets, or of all of them if
+        dataset_ids is None. The journal is only rewritten once the tasks are created, 
+        so a crash in between gives a duplicate derived task rather than a lost one.
+        """
+        with self._flush_lock:
+            with self._trigger_lock:
+                if dataset_ids == None: dataset_ids = self._pending_triggers.keys()
+                pending = [self._pending_triggers.pop(ds_id) for ds_id in dataset_ids if ds_id in self._pending_triggers]
+            if len(pending) == 0: return
+            try:
+                while len(pending) > 0:
+                    dataset, source_id, ids = pending[0]
+                    logger.info("DATASET.id=%d: running over %d new entries from dataset %d"%(dataset.id, len(ids), source_id))
+                    self.enqueue_ingress(dataset, {"dataset":source_id, "ids":ids}, LANE_DERIVED)
+                    pending.pop(0)
+            finally:
+                with self._trigger_lock:
+                    # Put back any that couldn't be queued, ahead of newer entries
+                    for dataset, source_id, ids in pending:
+                        newer = self._pending_triggers.pop(dataset.id, (None, None, []))[2]
+                        self._add_trigger(dataset, source_id, ids + newer)
+                    self._rewrite_trigger_journal()
+        
+    def _journal_triggers(self, items):
+        """Append [derived dataset ID, source dataset ID, entry ID] items to the trigger
+        journal, with the trigger lock held"""
+        if self._trigger_journal == None:
+            self._trigger_journal = open(self._trigger_journal_path, "a")
+        for item in items:
+            self._trigger_journal.write(json.dumps(item) + "\n")
+        self._trigger_journal.flush()
+        
+    def _rewrite_trigger_journal(self):
+        """Replace the trigger journal with the pending triggers, with the trigger lock held"""
+        if self._trigger_journal != None:
+            self._trigger_journal.close()
+            self._trigger_journal = None
+        if len(self._pending_triggers) == 0:
+            if os.path.exists(self._trigger_journal_path): os.remove(self._trigger_journal_path)
+            return
+        tmp_path = self._trigger_journal_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for dataset, source_id, ids in self._pending_triggers.values():
+                for entry_id in ids:
+                    f.write(json.dumps([dataset.id, source_id, entry_id]) + "\n")
+        os.rename(tmp_path, self._trigger_journal_path)
+        
+    def restore_triggers(self):
+        """Load the pending derived dataset triggers journalled before a restart. They
+        are queued by the next flush."""
+        if not os.path.exists(self._trigger_journal_path): return
+        with open(self._trigger_journal_path) as f:
+            items = [json.loads(line) for line in f if len(line.strip()) > 0]
+        with self._trigger_lock:
+            for derived_id, source_id, entry_id in items:
+                # Derived datasets that have since been disabled or changed are dropped
+                derived = [ds for ds in self.get_dependents(source_id) if ds.id == derived_id]
+                if len(derived) > 0:
+                    self._add_trigger(derived[0], source_id, [entry_id])
+            logger.info("Restored %d pending derived dataset triggers"%len(items))
+            self._rewrite_trigger_journal()
+            
+    def start_triggers(self, clock):
+        """Flush the pending derived dataset triggers every TRIGGER_WINDOW seconds
+        
+        :param clock: an IReactorTime provider, usually the reactor
+        """
+        self._trigger_loop = LoopingCall(self._flush_triggers_safely)
+        self._trigger_loop.clock = clock
+        self._trigger_loop.start(TRIGGER_WINDOW, now=False)
+        
+    def _flush_triggers_safely(self):
+        try:
+            self.flush_triggers()
+        except Exception, e:
+            logger.exception("Error while queuing derived datasets")
         
     def restore_running(self):
-        """Load any persisted ingress and archive tasks"""
+        """Load any persisted ingress and archive tasks. In cluster mode tasks are
+        claimed by process_claims instead, including any this node held before a restart
+        once their leases run out. The pending derived dataset triggers are restored in
+        both modes."""
+        self.restore_triggers()
+        if self.node_id != None: return
         items = self.service.get_ingest_queue()
         logger.info("Loading %d items into queue"%len(items))
-        for task_id, state, dataset, parameters, cwd in items:
+        self._queue_tasks(items)
+        
+    def _queue_tasks(self, items):
+        """Put persisted tasks on the ingress or archive queue, depending on their state"""
+        for task_id, state, dataset, parameters, cwd, lane in items:
+            if self.node_id != None:
+                self._claimed.add(task_id)
             if state == 0:
                 # State 0 is ready to ingress
-                self._ingress_queue.put( (dataset, parameters, task_id, cwd) )
+                self._ingress_queue.put( (dataset, parameters, task_id, cwd), lane )
             elif state == 1:
                 # State 1 is ready to ingest
                 try:
-                    #with open(os.path.join(cwd, "ingest.json")) as f:
-                    #    entries = self.domain_marshaller.dict_to_obj(json.load(f))
-                    #    self.enqueue_archive(task_id, entries, cwd)
-                    self.enqueue_archive(task_id, "ingest.json", cwd)
+                    self.enqueue_archive(task_id, ENTRIES_FILE, cwd, dataset.id, self._metric_labels(dataset)["kind"])
                 except Exception as e:
                     logger.error("Error loading ingest task %d: %s"%(task_id, str(e)))
             else:
                 logger.error("Unknown state %d for task %d"%(state, task_id))
 
+    def start_claims(self, clock):
+        """Cluster mode: start renewing leases and claiming tasks every CLAIM_INTERVAL seconds
+        
+        :param clock: an IReactorTime provider, usually the reactor
+        """
+        self._claim_loop = LoopingCall(self.process_claims)
+        self._claim_loop.clock = clock
+        self._claim_loop.start(CLAIM_INTERVAL)
+
+    def process_claims(self):
+        """Cluster mode housekeeping, run every CLAIM_INTERVAL seconds: renew the leases
+        on the tasks this node holds, take or keep the sampler role, and claim
+        unowned or abandoned tasks while there is room in the local ingress queue.
+        Tasks whose leases were taken over by another node, because they weren't
+        renewed in time, are dropped.
+        """
+        try:
+            claimed = list(self._claimed)
+            if len(claimed) > 0:
+                held = set(self.service.renew_leases(self.node_id, claimed, self.lease_time))
+                lost = [task_id for task_id in claimed if task_id not in held]
+                if len(lost) > 0:
+                    # The workers drop them as they come off the queues, or when they finish with them
+                    with self._lost_lock:
+                        self._lost.update(lost)
+                    self._claimed.difference_update(lost)
+            self._update_sampler_role()
+            if self._sampler_role:
+                self._apply_fetch_feedback()
+            self._sync_datasets()
+            
+            free = self.claim_limit - self._ingress_queue.qsize()
+            if free > 0 and self.running:
+                items = self.service.claim_ingest_tasks(self.node_id, free, self.lease_time)
+                if len(items) > 0:
+                    logger.info("Node %s claimed %d tasks"%(self.node_id, len(items)))
+                self._queue_tasks(items)
+        except Exception, e:
+            logger.exception("Error while claiming tasks")
+            
+    def _lease_lost(self, task_id):
+        """Cluster mode: returns True if another node has taken over the task"""
+        with self._lost_lock:
+            return task_id in self._lost
+        
+    def _drop_task(self, task_id):
+        """Forget a task another node has taken over, leaving its working directory to that node"""
+        logger.warn("Node %s has lost the lease on task %d, dropping it"%(self.node_id, task_id))
+        with self._lost_lock:
+            self._lost.discard(task_id)
+        self._claimed.discard(task_id)
+            
+    def _update_sampler_role(self):
+        """Take, keep or lose the sampler role. The node that takes the role loads the
+        sampler schedule and states from the database, as another node may have been
+        running them."""
+        has_role = self.service.acquire_role(SAMPLER_ROLE, self.node_id, self.lease_time)
+        if has_role and not self._sampler_role:
+            logger.info("Node %s has taken the sampler role"%self.node_id)
+            self._sampler_role = True
+            self.load_samplers()
+        elif not has_role and self._sampler_role:
+            logger.info("Node %s has lost the sampler role"%self.node_id)
+            self._sampler_role = False
+            self._schedule.clear()
+            
+    def _sync_datasets(self):
+        """Pick up the datasets changed via other nodes"""
+        now = datetime.datetime.utcnow()
+        if self._last_sync != None:
+            # Allow for clock differences between the nodes, repeating a change is harmless
+            since = self._last_sync - datetime.timedelta(seconds=CLAIM_INTERVAL * 2)
+            for dataset in self.service.get_modified_datasets(since):
+                self.notify_dataset_changed(dataset)
+        self._last_sync = now
+
     def invoke_ingester(self, dataset):
-        """Invoke the specified ingester"""
+        """Invoke the specified ingester. A sampled dataset is run ahead of any
+        scheduled or derived work. A dataset data source is run over all the
+        existing entries of its source dataset, in batches, as derived work."""
         if not isinstance(dataset, Dataset):
             raise InvalidObjectError("The object is not a dataset")
         if dataset.data_source == None:
@@ -215,33 +903,65 @@ class IngesterEngine(object):
             # If the dataset has sampling then test if it is running and then run
             if dataset.running:
                 raise OperationFailedException("The dataset is already running")
-            self.enqueue_ingress(dataset)
+            self.enqueue_ingress(dataset, None, LANE_MANUAL)
         elif isinstance(dataset.data_source, DatasetDataSource):
             # If this is a dataset data source then enqueue all of the parent items            
             dataset_id = dataset.data_source.dataset_id
-            data_entries =  self.service.find_data_entries(dataset_id=dataset_id)
-            for data_entry in data_entries:
-                self.enqueue(dataset, {"dataset":data_entry.dataset, "id":data_entry.id})
+            offset = 0
+            while True:
+                data_entries = self.service.find_data_entries(dataset_id, offset, TRIGGER_BATCH_SIZE).results
+                if len(data_entries) == 0: break
+                self.enqueue_ingress(dataset, {"dataset":dataset_id, "ids":[e.id for e in data_entries]}, LANE_DERIVED)
+                offset += len(data_entries)
             
         else:
             raise OperationFailedException("The dataset has no ingester to run")
 
-def start_ingester(service, staging_dir, data_source_factory=create_data_source):
+def start_ingester(service, staging_dir, data_source_factory=create_data_source, ingress_workers=1,
+                   ingress_kind_limits=None, archive_workers=1, async_fetch=False, node_id=None,
+                   lease_time=DEFAULT_LEASE_TIME, queue_size=0, min_free_space=MIN_STAGING_FREE_SPACE,
+                   dataset_weights=None):
     """Setup and start the ingester loop.
     
     :param service: the service facade
     :param staging_dir: the folder that will hold all the staging data
+    :param ingress_workers: the number of concurrent ingress (fetch) workers
+    :param ingress_kind_limits: optional dict of data source kind to the maximum
+        number of concurrent fetches of that kind, ie, {"sos_scraper_data_source":2}
+    :param archive_workers: the number of concurrent archive workers. Each dataset is
+        always archived by the same worker.
+    :param async_fetch: fetch data sources that support it (ie, HTTP pulls) on the
+        reactor, rather than blocking an ingress worker for the whole download.
+    :param node_id: a unique name for this node, to run several ingesters against
+        the same database. Tasks are shared between the nodes using leases, and
+        only one node runs the samplers. The staging_dir must be on storage shared by
+        all the nodes for a task fetched by a failed node to be archived by another.
+    :param lease_time: seconds before the work of a node that has stopped is taken over
+    :param queue_size: the most tasks each queue holds in memory before spilling to
+        disk, 0 for no limit
+    :param min_free_space: bytes that must be free in the staging directory for the
+        samplers to run
+    :param dataset_weights: dict of dataset ID to its share of the ingress workers,
+        relative to the default of 1
     """
-    ingester = IngesterEngine(service, staging_dir, data_source_factory)
+    from twisted.internet import reactor
+
+    ingester = IngesterEngine(service, staging_dir, data_source_factory, ingress_kind_limits, archive_workers,
+                              reactor, node_id, lease_time, max(10, ingress_workers * 2), queue_size,
+                              min_free_space, dataset_weights, async_fetch)
     ingester.restore_running()
+    if node_id != None:
+        ingester.start_claims(reactor)
     
     # Start the sampler loop
-    lc = LoopingCall(ingester.process_samplers)
-    lc.start(15, False)
+    ingester.start_samplers(reactor)
+    ingester.start_triggers(reactor)
     
-    from twisted.internet import reactor
-    reactor.callInThread(ingester.process_ingress_queue)
-    reactor.callInThread(ingester.process_archive_queue)
+    reactor.suggestThreadPoolSize(ingress_workers + archive_workers + RESERVED_THREADS)
+    for i in range(ingress_workers):
+        reactor.callInThread(ingester.process_ingress_queue)
+    for i in range(archive_workers):
+        reactor.callInThread(ingester.process_archive_queue, False, i)
     reactor.addSystemEventTrigger("before", "shutdown", lambda : ingester.shutdown())
 
     return ingester
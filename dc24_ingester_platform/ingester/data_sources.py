@@ -15,14 +15,19 @@ import urlparse
 import sys
 import json
 import pprint
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 
 
 from dc24_ingester_platform.utils import *
 from dc24_ingester_platform import IngesterError
+from dc24_ingester_platform.transfer import move_file, copy_file, COPY_BUFFER_SIZE
 from jcudc24ingesterapi.ingester_platform_api import get_properties, Marshaller
 from jcudc24ingesterapi.models.data_entry import DataEntry, FileObject
 from jcudc24ingesterapi.models.data_sources import _DataSource
 from dc24_ingester_platform.ingester.processor import run_script
+from dc24_ingester_platform.ingester.web_client import MAX_CONCURRENT_DOWNLOADS
 from simplesos.client import SOSClient_V1
 from simplesos.util import SOSMimeTypes
 from simplesos.varients import getSOSVariant
@@ -77,86 +82,212 @@ class PullDataSource(DataSource):
         else:
             raise IngesterError("This scheme is not supported: %s"%url.scheme)
 
-    def fetch_http(self, cwd):
-        """Recursively fetch from an HTTP server.
-        """ 
+    def fetch_async(self, cwd, service=None):
+        """Fetch from an HTTP URI using the Twisted web client, so no thread is
+        blocked during the download. Other schemes fall back to fetch, in a thread.
+        
+        :param cwd: working directory to place binary data
+        :returns: Deferred firing with the data entries to be ingested
+        """
+        from twisted.internet import threads
+        url = urlparse.urlparse(self.url)
+        if url.scheme not in ("http", "https"):
+            return threads.deferToThread(self.fetch, cwd, service)
+        if not self.recursive:
+            return self.fetch_single_async(cwd)
+        else:
+            return self.fetch_http_async(cwd)
+
+    def _since(self):
+        """Returns the last modified time from the state, as an RFC 2822 date, or None"""
+        if "lasttime" in self.state and self.state["lasttime"] != None and len(self.state["lasttime"]) > 0:
+            return eut.formatdate(calendar.timegm(parse_timestamp(self.state["lasttime"]).timetuple()), usegmt=True)
+        return None
+    
+    def _validator_headers(self):
+        """Returns the conditional request headers for the validators of the last
+        download kept in the state, so an unchanged resource isn't downloaded again"""
+        headers = {}
+        if self.state.get("etag"):
+            headers["If-None-Match"] = self.state["etag"]
+        if self.state.get("last_modified"):
+            headers["If-Modified-Since"] = self.state["last_modified"]
+        return headers
+    
+    def _store_validators(self, etag, last_modified):
+        """Keep the validators of a download in the state"""
+        for k, v in (("etag", etag), ("last_modified", last_modified)):
+            if v != None: self.state[k] = v
+            else: self.state.pop(k, None)
+    
+    def _index_files(self, index_page):
+        """Find the files linked from an index page that match the pattern.
+        
+        :returns: list of (url, file name)
+        """
         RE_A = re.compile("href=\"(\./){0,1}([0-9A-Za-z\-_\.\:]+)\"")
-        req = urllib2.Request(self.url)
+        RE_FILENAME = None if self.pattern == None else re.compile(self.pattern)
         ret = []
+        for url_part in RE_A.findall(index_page):
+            if RE_FILENAME != None and RE_FILENAME.match(url_part[1]) == None: continue
+            ret.append( (urlparse.urljoin(self.url, url_part[0]+url_part[1]), url_part[1].split("/")[-1]) )
+        return ret
+    
+    def _file_entry(self, f_path, file_name, timestamp):
+        """Create a data entry holding the downloaded file in the configured field"""
+        new_data_entry = DataEntry(timestamp=timestamp)
+        new_data_entry[self.field] = FileObject(f_path=f_path, mime_type="", file_name=file_name)
+        return new_data_entry
+
+    def fetch_http(self, cwd):
+        """Recursively fetch from an HTTP server. Up to MAX_CONCURRENT_DOWNLOADS files
+        are downloaded at once, over a pool of kept alive connections.
+        """ 
+        since = self._since()
+        headers = {"If-Modified-Since":since} if since != None else {}
         
-        since = None
-        if "lasttime" in self.state and self.state["lasttime"] != None and len(self.state["lasttime"]) > 0:
-            since = eut.formatdate(calendar.timegm(parse_timestamp(self.state["lasttime"]).timetuple()), usegmt=True)
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=MAX_CONCURRENT_DOWNLOADS)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        
+        def _download(item):
+            i, (url, file_name) = item
+            f_path = "outputfile%d"%i
+            response = session.get(url, headers=headers, stream=True)
+            try:
+                if response.status_code == 304: return None
+                if response.status_code != 200:
+                    logger.warn("HTTP %d while fetching %s"%(response.status_code, url))
+                    return None
+                last_modified = response.headers.get("Last-Modified")
+                timestamp = parse_timestamp_rfc_2822(last_modified) if last_modified != None else datetime.datetime.now()
+                with open(os.path.join(cwd, f_path), "wb") as f_out:
+                    for chunk in response.iter_content(COPY_BUFFER_SIZE):
+                        f_out.write(chunk)
+                return self._file_entry(f_path, file_name, timestamp)
+            finally:
+                response.close()
         
-        f_in = None
         try:
-            f_index = urllib2.urlopen(req)
-            index_page = f_index.read()
-            f_index.close()
-            urls = RE_A.findall(index_page)
-            found = 0
+            response = session.get(self.url)
+            response.raise_for_status()
+            files = self._index_files(response.content)
+            if len(files) == 0: return []
             
-            RE_FILENAME = None if self.pattern == None else re.compile(self.pattern)
-            for url_part in urls:
-                if RE_FILENAME != None and RE_FILENAME.match(url_part[1]) == None: continue
-
-                url = urlparse.urljoin(self.url, url_part[0]+url_part[1])
-                req = urllib2.Request(url)
-                if since != None: req.add_header("If-Modified-Since", since)
-                try:
-                    f_in = urllib2.urlopen(req)
-                    f_out_name = os.path.join(cwd, "outputfile%d"%found)
-                    timestamp = parse_timestamp_rfc_2822(f_in.headers["Last-Modified"])
-                    with file(f_out_name, "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                    new_data_entry = DataEntry(timestamp=timestamp)
-                    file_name = None
-                    try:
-                        file_name = url_part[1].split("/")[-1]
-                    except:
-                        pass
-                    new_data_entry[self.field] = FileObject(f_path="outputfile%d"%found, mime_type="", file_name=file_name)
-                    ret.append(new_data_entry)
-                    found += 1
-                    
-                    if since == None or timestamp > since:
-                        since = timestamp
-                    
-                except urllib2.HTTPError, e:
-                    if e.code == 304: 
-                        continue
+            pool = ThreadPool(min(MAX_CONCURRENT_DOWNLOADS, len(files)))
+            try:
+                entries = pool.map(_download, enumerate(files))
+            finally:
+                pool.terminate()
+                pool.join()
         finally:
-            if f_in != None: f_in.close()
-            
-        self.state["lasttime"] = format_timestamp(since) if since != None else None
+            session.close()
+        
+        ret = [entry for entry in entries if entry != None]
+        # Only move the last modified time on, so files that were not modified aren't fetched again
+        latest = parse_timestamp_rfc_2822(since) if since != None else None
+        for entry in ret:
+            if latest == None or entry.timestamp > latest:
+                latest = entry.timestamp
+        self.state["lasttime"] = format_timestamp(latest) if latest != None else None
         return ret
+    
+    def fetch_http_async(self, cwd):
+        """Recursively fetch from an HTTP server using the Twisted web client. 
+        Up to MAX_CONCURRENT_DOWNLOADS files are downloaded at once.
+        
+        :returns: Deferred firing with the list of data entries
+        """
+        from twisted.internet import defer
+        from dc24_ingester_platform.ingester import web_client
+        
+        since = self._since()
+        latest = {}
+        if since != None:
+            latest["time"] = parse_timestamp_rfc_2822(since)
+        headers = {"If-Modified-Since":since} if since != None else None
+        semaphore = defer.DeferredSemaphore(MAX_CONCURRENT_DOWNLOADS)
+        
+        def _download(i, url, file_name):
+            f_path = "outputfile%d"%i
+            def _downloaded(response):
+                if response.code != 200: return None
+                last_modified = web_client.get_header(response, "Last-Modified")
+                timestamp = parse_timestamp_rfc_2822(last_modified) if last_modified != None else datetime.datetime.now()
+                if "time" not in latest or timestamp > latest["time"]:
+                    latest["time"] = timestamp
+                return self._file_entry(f_path, file_name, timestamp)
+            def _failed(failure):
+                failure.trap(web_client.HTTPDownloadError)
+                logger.warn(str(failure.value))
+                return None
+            d = semaphore.run(web_client.http_download, url, os.path.join(cwd, f_path), headers)
+            return d.addCallbacks(_downloaded, _failed)
+        
+        def _index(result):
+            response, index_page = result
+            files = self._index_files(index_page)
+            return defer.gatherResults([_download(i, url, file_name) for i, (url, file_name) in enumerate(files)])
+        
+        def _done(entries):
+            if "time" in latest:
+                self.state["lasttime"] = format_timestamp(latest["time"])
+            return [entry for entry in entries if entry != None]
+        
+        return web_client.http_read(self.url).addCallback(_index).addCallback(_done)
         
     def fetch_single(self, cwd):
-        """Fetch a single resource from a URL"""
+        """Fetch a single resource from a URL. If it has not changed since the last
+        fetch there are no data entries."""
         req = urllib2.Request(self.url)
+        for k, v in self._validator_headers().items():
+            req.add_header(k, v)
         f_out_name = os.path.join(cwd, "outputfile")
         f_in = None
         try:
-            f_in = urllib2.urlopen(req)
+            try:
+                f_in = urllib2.urlopen(req)
+            except urllib2.HTTPError, e:
+                if e.code == 304: return []
+                raise
             timestamp = parse_timestamp_rfc_2822(f_in.headers["Last-Modified"]) if "Last-Modified" in f_in.headers \
                 else datetime.datetime.now()
             with file(f_out_name, "wb") as f_out:
                 shutil.copyfileobj(f_in, f_out)
                 
             self.state["lasttime"] = format_timestamp(timestamp)
+            self._store_validators(f_in.headers.get("ETag"), f_in.headers.get("Last-Modified"))
         finally:
             if f_in != None: f_in.close()
-        new_data_entry = DataEntry(timestamp=timestamp)
+        return [self._file_entry("outputfile", self._url_file_name(), timestamp)]
+    
+    def fetch_single_async(self, cwd):
+        """Fetch a single resource from a URL using the Twisted web client, streaming
+        it straight into the working directory. If it has not changed since the last
+        fetch there are no data entries.
+        
+        :returns: Deferred firing with the list of data entries
+        """
+        from dc24_ingester_platform.ingester import web_client
         
+        def _downloaded(response):
+            if response.code == 304: return []
+            last_modified = web_client.get_header(response, "Last-Modified")
+            timestamp = parse_timestamp_rfc_2822(last_modified) if last_modified != None else datetime.datetime.now()
+            self.state["lasttime"] = format_timestamp(timestamp)
+            self._store_validators(web_client.get_header(response, "ETag"), last_modified)
+            return [self._file_entry("outputfile", self._url_file_name(), timestamp)]
+        return web_client.http_download(self.url, os.path.join(cwd, "outputfile"), 
+                                        self._validator_headers()).addCallback(_downloaded)
+    
+    def _url_file_name(self):
         file_name = None
         try:
             file_name = self.url.split("/")[-1]
         except:
             pass
-
-        new_data_entry[self.field] = FileObject(f_path="outputfile", mime_type="", file_name=file_name)
-            
-        return [new_data_entry]
+        return file_name
 
 class PushDataSource(DataSource):
     """Scan an incoming directory for new data. The filename encodes
@@ -193,8 +324,11 @@ class PushDataSource(DataSource):
             
             new_filename = "file-"+f_name
             if self.archive != None:
-                shutil.copyfile(os.path.join(self.path, f_name), os.path.join(self.archive, f_name))
-            shutil.move(os.path.join(self.path, f_name), os.path.join(cwd, new_filename))
+                # The archive gets its own copy. A link would share the file with the processing
+                # script and the repository, which stores the staged file by linking it too, so
+                # a change to one would silently change the others.
+                copy_file(os.path.join(self.path, f_name), os.path.join(self.archive, f_name))
+            move_file(os.path.join(self.path, f_name), os.path.join(cwd, new_filename))
             #timestamp = datetime.datetime.utcfromtimestamp(int(m.group(1)))
             new_data_entry = DataEntry(timestamp=timestamp)
             new_data_entry[self.field] = FileObject(f_path=new_filename, file_name=f_name, mime_type="" )
@@ -262,21 +396,36 @@ class DatasetDataSource(DataSource):
     dataset_id = None # Source dataset
 
     def fetch(self, cwd, service):
-        """Extract the observation from the repo.
+        """Extract the observations from the repo. The parameters hold the source
+        dataset and either a list of data entry "ids", or a single "id".
         
         :param cwd: working directory to place binary data
-        :returns: dict containing the data to be ingested
+        :returns: list of the source data entries, in the order given
         """
-        data_entry = service.get_data_entry(int(self.parameters["dataset"]), int(self.parameters["id"]))
-        for k in data_entry.data:
-            if isinstance(data_entry.data[k], FileObject):
-                dst_file = os.path.join(cwd, k)
-                f_in=service.get_data_entry_stream(int(self.parameters["dataset"]), int(self.parameters["id"]), k)
-                with open(dst_file, "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                f_in.close()
-                data_entry.data[k].f_path = k
-        return [data_entry]
+        source_id = int(self.parameters["dataset"])
+        if "ids" in self.parameters:
+            ids = [int(i) for i in self.parameters["ids"]]
+        else:
+            ids = [int(self.parameters["id"])]
+        
+        ret = []
+        for entry_id in ids:
+            data_entry = service.get_data_entry(source_id, entry_id)
+            if data_entry == None:
+                logger.warn("Data entry %d of dataset %d no longer exists"%(entry_id, source_id))
+                continue
+            for k in data_entry.data:
+                if isinstance(data_entry.data[k], FileObject):
+                    # Keep the names of a single entry's files the same as they always were
+                    f_name = k if len(ids) == 1 else "%d-%s"%(entry_id, k)
+                    f_in=service.get_data_entry_stream(source_id, entry_id, k)
+                    # A copy, not a link, as processing scripts may change their files
+                    with open(os.path.join(cwd, f_name), "wb") as f_out:
+                        shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+                    f_in.close()
+                    data_entry.data[k].f_path = f_name
+            ret.append(data_entry)
+        return ret
 
 class SOSScraperDataSource(DataSource):
 
@@ -0,0 +1,143 @@
+"""
+Counters, gauges and timing histograms for the stages of the ingester pipeline.
+
+The metrics are kept in memory by the IngesterEngine. A snapshot of them is
+plain dicts, lists and floats so it can be returned over XMLRPC, and can be
+rendered in the Prometheus text format for scraping. Rates, such as entries/s
+and bytes/s, are left to the scraper to derive from the counters.
+"""
+import time
+import threading
+import contextlib
+
+# Upper bounds of the timing histogram buckets, in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+def _label_key(labels):
+    if labels == None: return ()
+    return tuple(sorted([(str(k), str(v)) for k, v in labels.items()]))
+
+class Metrics(object):
+    """A thread safe registry of metrics. Each metric is identified by name and
+    a dict of labels, such as the dataset and data source kind.
+
+    >>> m = Metrics()
+    >>> m.incr("entries_total", {"dataset":1}, 5)
+    >>> m.observe("fetch_seconds", 0.2, {"dataset":1})
+    >>> m.gauge("queue_depth", lambda: 3)
+    >>> print render_text(m.snapshot()),
+    # TYPE entries_total counter
+    entries_total{dataset="1"} 5
+    # TYPE fetch_seconds histogram
+    fetch_seconds_bucket{dataset="1",le="0.005"} 0
+    fetch_seconds_bucket{dataset="1",le="0.01"} 0
+    fetch_seconds_bucket{dataset="1",le="0.05"} 0
+    fetch_seconds_bucket{dataset="1",le="0.1"} 0
+    fetch_seconds_bucket{dataset="1",le="0.5"} 1
+    fetch_seconds_bucket{dataset="1",le="1"} 1
+    fetch_seconds_bucket{dataset="1",le="5"} 1
+    fetch_seconds_bucket{dataset="1",le="10"} 1
+    fetch_seconds_bucket{dataset="1",le="30"} 1
+    fetch_seconds_bucket{dataset="1",le="60"} 1
+    fetch_seconds_bucket{dataset="1",le="300"} 1
+    fetch_seconds_bucket{dataset="1",le="+Inf"} 1
+    fetch_seconds_sum{dataset="1"} 0.2
+    fetch_seconds_count{dataset="1"} 1
+    # TYPE queue_depth gauge
+    queue_depth 3
+    """
+    def __init__(self):
+        self._counters = {} # name -> label key -> value
+        self._histograms = {} # name -> label key -> [bucket counts, sum, count]
+        self._gauges = {} # name -> callable
+        self._lock = threading.Lock()
+
+    def incr(self, name, labels=None, value=1):
+        """Add value to a counter"""
+        key = _label_key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """Record a value, usually a duration in seconds, in a histogram"""
+        key = _label_key(labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {})
+            if key not in histogram:
+                histogram[key] = [[0] * len(TIME_BUCKETS), 0.0, 0]
+            h = histogram[key]
+            for i in range(len(TIME_BUCKETS)):
+                if value <= TIME_BUCKETS[i]:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        """Context manager that records how long its block took in a histogram"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels)
+
+    def gauge(self, name, func):
+        """Register a gauge, which is read when a snapshot is taken.
+
+        :param func: callable returning the current value
+        """
+        with self._lock:
+            self._gauges[name] = func
+
+    def snapshot(self):
+        """Returns the current value of all the metrics, as a dict of metric name to
+        a dict with the type and a list of samples. All the numbers are floats, as
+        XMLRPC can't carry large integers.
+        """
+        ret = {}
+        with self._lock:
+            for name, counter in self._counters.items():
+                ret[name] = {"type":"counter", "samples":[{"labels":dict(key), "value":float(value)}
+                                    for key, value in sorted(counter.items())]}
+            for name, histogram in self._histograms.items():
+                samples = []
+                for key, (buckets, total, count) in sorted(histogram.items()):
+                    samples.append({"labels":dict(key), "sum":float(total), "count":float(count),
+                                    "buckets":[[repr(float(le)), float(n)] for le, n in zip(TIME_BUCKETS, buckets)]})
+                ret[name] = {"type":"histogram", "samples":samples}
+            gauges = self._gauges.items()
+        # Gauges are read outside the lock, as they may take other locks
+        for name, func in gauges:
+            ret[name] = {"type":"gauge", "samples":[{"labels":{}, "value":float(func())}]}
+        return ret
+
+def _format_labels(labels, extra=None):
+    pairs = sorted(labels.items())
+    if extra != None: pairs.append(extra)
+    if len(pairs) == 0: return ""
+    return "{%s}"%(",".join(['%s="%s"'%(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs]))
+
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def _format_le(le):
+    return _format_value(le) if le != "+Inf" else le
+
+def render_text(snapshot):
+    """Render a metrics snapshot in the Prometheus text exposition format"""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append("# TYPE %s %s"%(name, metric["type"]))
+        for sample in metric["samples"]:
+            labels = sample["labels"]
+            if metric["type"] == "histogram":
+                for le, n in sample["buckets"] + [["+Inf", sample["count"]]]:
+                    lines.append("%s_bucket%s %s"%(name, _format_labels(labels, ("le", _format_le(le))), _format_value(n)))
+                lines.append("%s_sum%s %s"%(name, _format_labels(labels), _format_value(sample["sum"])))
+                lines.append("%s_count%s %s"%(name, _format_labels(labels), _format_value(sample["count"])))
+            else:
+                lines.append("%s%s %s"%(name, _format_labels(labels), _format_value(sample["value"])))
+    return "\n".join(lines) + "\n"
@@ -17,24 +17,36 @@ def create_sandbox(cwd):
     sb.config.enable("exit")
     return sb
 
-def run_script(script, cwd, data_entry):
+def run_script(script, cwd, data_entry, profiler=None):
     """Runs the script provided (source code as string) and returns
     an array of additional data entries, including the original
     data_entry that may have been altered.
+    
+    :param profiler: optional cProfile.Profile to run the script under
     """
     #sb = create_sandbox(cwd)
     #return sb.call(_run_script, script, cwd, data_entry)
-    return run_script_local(script, cwd, data_entry)
+    return run_script_local(script, cwd, data_entry, profiler)
 
 def _run_script(script, cwd, data_entry):
     code = compile(script, "<string>", "exec")
     exec(code)
     return process(cwd, data_entry)
 
-def run_script_local(script, cwd, data_entry):
+def run_script_local(script, cwd, data_entry, profiler=None):
     code = compile(script, "<string>", "exec")
     local = {}
-    exec(code, globals(), local)
-    return local["process"](cwd, data_entry)
+    if profiler == None:
+        exec(code, globals(), local)
+        return local["process"](cwd, data_entry)
+    profiler.enable()
+    try:
+        exec(code, globals(), local)
+        ret = local["process"](cwd, data_entry)
+        # Run a generator to the end while profiling, so its work is counted
+        if hasattr(ret, "next"): ret = list(ret)
+        return ret
+    finally:
+        profiler.disable()
 
 
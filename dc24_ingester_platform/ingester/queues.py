@@ -0,0 +1,396 @@
+"""
+Work queues used by the ingester engine to hand tasks to its worker threads.
+
+Ingress tasks are tuples of (dataset, parameters, task_id, cwd).
+
+The queues can be limited to a number of items in memory, with any more
+spilled to an OverflowFile on disk and read back in order as room is made.
+"""
+import logging
+import json
+import threading
+import time
+import os
+import Queue
+from collections import deque, OrderedDict
+from dc24_ingester_platform.service import LANE_MANUAL, LANE_SCHEDULED, LANE_DERIVED, LANES
+
+logger = logging.getLogger("dc24_ingester_platform.ingester.queues")
+
+def task_kind(task):
+    """Returns the data source kind of an ingress task"""
+    dataset = task[0]
+    if dataset.data_source == None: return None
+    return dataset.data_source.__xmlrpc_class__
+
+class OverflowFile(object):
+    """A FIFO of items stored in a file, one JSON document per line. The file
+    is truncated whenever it is emptied. Any existing content is discarded when
+    it is opened, as the tasks are restored from the database on startup.
+    
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "q.overflow")
+    >>> f = OverflowFile(path)
+    >>> f.append(["a", 1])
+    >>> f.append(["b", 2])
+    >>> len(f), f.pop(), len(f)
+    (2, [u'a', 1], 1)
+    """
+    def __init__(self, path, encode=None, decode=None):
+        """
+        :param encode: function converting an item into a JSON serialisable object
+        :param decode: function converting it back again
+        """
+        self.path = path
+        self._encode = encode
+        self._decode = decode
+        self._f = open(path, "w+b")
+        self._count = 0
+        self._read_pos = 0
+        
+    def __len__(self):
+        return self._count
+    
+    def append(self, item):
+        if self._encode != None: item = self._encode(item)
+        self._f.seek(0, 2)
+        self._f.write(json.dumps(item) + "\n")
+        self._count += 1
+        
+    def pop(self):
+        """Remove and return the oldest item"""
+        if self._count == 0:
+            raise IndexError("pop from an empty overflow file")
+        self._f.flush()
+        self._f.seek(self._read_pos)
+        line = self._f.readline()
+        self._read_pos = self._f.tell()
+        self._count -= 1
+        if self._count == 0:
+            self._f.seek(0)
+            self._f.truncate()
+            self._read_pos = 0
+        item = json.loads(line)
+        return self._decode(item) if self._decode != None else item
+    
+    def close(self):
+        self._f.close()
+        
+    def remove(self):
+        """Close and delete the file"""
+        self.close()
+        os.remove(self.path)
+
+class SpillQueue(Queue.Queue):
+    """A Queue.Queue that holds at most memory_size items in memory, and spills the
+    rest to an overflow file. Putting never blocks. 
+    
+    Items only go to the file when memory is full, and each get moves the oldest item
+    in the file into memory, so the order is kept.
+    """
+    def __init__(self, memory_size=0, overflow=None):
+        """
+        :param memory_size: the most items to keep in memory, 0 for no limit
+        :param overflow: the OverflowFile to spill to, if memory_size is set
+        """
+        self.memory_size = memory_size
+        self.overflow = overflow if memory_size > 0 else None
+        Queue.Queue.__init__(self)
+        
+    def _qsize(self, len=len):
+        return len(self.queue) + (len(self.overflow) if self.overflow != None else 0)
+    
+    def _put(self, item):
+        if self.overflow != None and (len(self.queue) >= self.memory_size or len(self.overflow) > 0):
+            self.overflow.append(item)
+        else:
+            self.queue.append(item)
+            
+    def _get(self):
+        item = self.queue.popleft()
+        if self.overflow != None and len(self.overflow) > 0:
+            self.queue.append(self.overflow.pop())
+        return item
+
+class FairScheduler(object):
+    """Deficit round robin over per-dataset FIFOs of tasks. Each dataset with
+    waiting tasks takes its turn, and is handed a task once it has built up a
+    deficit of at least 1 by adding its weight on each turn. So a dataset with
+    weight 0.25 gets a task every fourth round, and no dataset, however many tasks
+    it has waiting, can hold up the others for more than a round.
+
+    Not thread safe, IngressQueue does the locking.
+
+    >>> from jcudc24ingesterapi.models.dataset import Dataset
+    >>> s = FairScheduler({2:0.5})
+    >>> for task_id in range(4): s.put( (Dataset(dataset_id=1), None, task_id, None) )
+    >>> for task_id in range(4, 6): s.put( (Dataset(dataset_id=2), None, task_id, None) )
+    >>> [s.take(lambda task: True)[2] for i in range(6)]
+    [0, 1, 4, 2, 3, 5]
+    >>> FairScheduler({2:0})
+    Traceback (most recent call last):
+    ...
+    ValueError: The weight of dataset 2 must be positive, not 0
+    """
+    def __init__(self, weights=None, default_weight=1):
+        """
+        :param weights: dict of dataset ID to its weight. Weights must be positive,
+            a dataset can't be paused by giving it no share.
+        :param default_weight: the weight of datasets not in weights
+        """
+        self.weights = weights if weights != None else {}
+        for ds_id, weight in self.weights.items() + [(None, default_weight)]:
+            if not weight > 0:
+                raise ValueError("The weight of dataset %s must be positive, not %s"%(ds_id, weight))
+        self.default_weight = default_weight
+        self._queues = {} # Dataset ID to a deque of its tasks
+        self._active = deque() # The IDs of datasets with waiting tasks, in turn order
+        self._deficit = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+    
+    def dataset_size(self, ds_id):
+        """Returns the number of tasks waiting for the dataset"""
+        return len(self._queues[ds_id]) if ds_id in self._queues else 0
+
+    def put(self, task):
+        ds_id = task[0].id
+        if ds_id not in self._queues:
+            self._queues[ds_id] = deque()
+            self._deficit[ds_id] = 0
+            self._active.append(ds_id)
+        self._queues[ds_id].append(task)
+        self._count += 1
+
+    def take(self, eligible):
+        """Remove and return the next task, or None if none can run now.
+
+        :param eligible: function returning whether a task can run now. Datasets
+            whose next task can't run keep their deficit, but don't add to it.
+        """
+        while True:
+            any_eligible = False
+            for i in range(len(self._active)):
+                ds_id = self._active[0]
+                queue = self._queues[ds_id]
+                if eligible(queue[0]):
+                    any_eligible = True
+                    if self._deficit[ds_id] < 1:
+                        self._deficit[ds_id] += self.weights.get(ds_id, self.default_weight)
+                    if self._deficit[ds_id] >= 1:
+                        self._deficit[ds_id] -= 1
+                        self._count -= 1
+                        task = queue.popleft()
+                        if len(queue) == 0:
+                            self._active.popleft()
+                            del self._queues[ds_id]
+                            del self._deficit[ds_id]
+                        elif self._deficit[ds_id] < 1:
+                            self._active.rotate(-1)
+                        return task
+                self._active.rotate(-1)
+            # Go round again, unless nothing could run
+            if not any_eligible: return None
+
+class IngressQueue(object):
+    """A queue of ingress tasks shared by a pool of workers. Tasks are put in a
+    priority lane, and are handed out from the first lane with a task that can
+    run. Within a lane each dataset gets a fair share of the workers (see
+    FairScheduler). A dataset never has two tasks in flight, and each data source
+    kind can be capped to a number of concurrent tasks.
+
+    Workers must call task_done once they have finished with a task.
+    
+    If memory_size is set then only that many tasks are kept in memory, and each
+    dataset only keeps dataset_memory_size of its tasks in each lane in memory. Any
+    more are spilled to an overflow file for their lane and dataset. As room is made
+    the dataset with the fewest tasks in memory is refilled first, so one dataset's
+    backlog can't hold the tasks of the others on disk. Only the tasks in memory are
+    considered when looking for one that can run, so memory_size should be well
+    above the number of workers.
+
+    >>> from jcudc24ingesterapi.models.dataset import Dataset
+    >>> q = IngressQueue()
+    >>> q.put( (Dataset(dataset_id=1), None, 1, "a") )
+    >>> q.put( (Dataset(dataset_id=1), None, 2, "b") )
+    >>> task = q.get(False)
+    >>> task[2]
+    1
+    >>> q.get(False)
+    Traceback (most recent call last):
+    ...
+    Empty
+    >>> q.task_done(task)
+    >>> q.get(False)[2]
+    2
+    >>> q.put( (Dataset(dataset_id=2), None, 3, "c") )
+    >>> q.put( (Dataset(dataset_id=3), None, 4, "d"), LANE_MANUAL )
+    >>> q.get(False)[2]
+    4
+    """
+    def __init__(self, kind_limits=None, memory_size=0, overflow_factory=None, weights=None,
+                 dataset_memory_size=2):
+        """
+        :param kind_limits: dict of data source kind to the maximum number of
+            concurrent tasks of that kind
+        :param memory_size: the most tasks to keep in memory, 0 for no limit
+        :param overflow_factory: called with a lane and dataset ID to create the
+            OverflowFile those tasks are spilled to, if memory_size is set
+        :param weights: dict of dataset ID to its share of the workers, relative to
+            the default of 1
+        :param dataset_memory_size: the most tasks of a dataset to keep in memory in
+            each lane, if memory_size is set. A dataset only runs one task at a time,
+            so a few are plenty.
+        """
+        self.kind_limits = kind_limits if kind_limits != None else {}
+        self.memory_size = memory_size
+        self.dataset_memory_size = dataset_memory_size
+        if memory_size > 0 and overflow_factory != None:
+            self._overflow_factory = overflow_factory
+            # Per lane, dataset ID to its OverflowFile, in the order they are refilled
+            self._overflow = [OrderedDict() for lane in LANES]
+        else:
+            self._overflow = None
+        self._lanes = [FairScheduler(weights) for lane in LANES]
+        self._in_flight = set() # IDs of datasets with a task in flight
+        self._kind_counts = {}
+        self._cond = threading.Condition()
+
+    def qsize(self):
+        """Returns the number of tasks waiting to be handed out"""
+        with self._cond:
+            return self._in_memory() + self._spilled()
+        
+    def _in_memory(self):
+        return sum([len(tasks) for tasks in self._lanes])
+        
+    def _spilled(self):
+        if self._overflow == None: return 0
+        return sum([sum([len(f) for f in overflow.values()]) for overflow in self._overflow])
+
+    def in_flight(self):
+        """Returns the number of tasks handed out and not yet done"""
+        with self._cond:
+            return len(self._in_flight)
+
+    def put(self, task, lane=LANE_SCHEDULED):
+        with self._cond:
+            ds_id = task[0].id
+            if self._overflow != None and (self._in_memory() >= self.memory_size or 
+                    ds_id in self._overflow[lane] or
+                    self._lanes[lane].dataset_size(ds_id) >= self.dataset_memory_size):
+                if ds_id not in self._overflow[lane]:
+                    self._overflow[lane][ds_id] = self._overflow_factory(lane, ds_id)
+                self._overflow[lane][ds_id].append(task)
+            else:
+                self._lanes[lane].put(task)
+            self._cond.notify()
+            
+    def _refill(self):
+        """Move spilled tasks into memory while there is room. Lanes are refilled in
+        priority order, and within a lane the dataset with the fewest tasks in memory
+        goes first, so every dataset with spilled tasks gets a turn."""
+        if self._overflow == None: return
+        for lane in LANES:
+            overflow = self._overflow[lane]
+            while self._in_memory() < self.memory_size and len(overflow) > 0:
+                tasks = self._lanes[lane]
+                sizes = [(tasks.dataset_size(ds_id), i, ds_id) for i, ds_id in enumerate(overflow)]
+                size, i, ds_id = min(sizes)
+                if size >= self.dataset_memory_size: break
+                f = overflow.pop(ds_id)
+                tasks.put(f.pop())
+                if len(f) > 0:
+                    # To the back of the refill order
+                    overflow[ds_id] = f
+                else:
+                    f.remove()
+
+    def _eligible(self, task):
+        if task[0].id in self._in_flight: return False
+        kind = task_kind(task)
+        return kind not in self.kind_limits or self._kind_counts.get(kind, 0) < self.kind_limits[kind]
+
+    def _take(self):
+        """Remove and return the next eligible task, or None"""
+        for tasks in self._lanes:
+            task = tasks.take(self._eligible)
+            if task != None: break
+        if task == None: return None
+        self._refill()
+        self._in_flight.add(task[0].id)
+        kind = task_kind(task)
+        self._kind_counts[kind] = self._kind_counts.get(kind, 0) + 1
+        return task
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next task that may run now. Raises Queue.Empty
+        if none is available within the timeout.
+        """
+        with self._cond:
+            end = time.time() + timeout if timeout != None else None
+            while True:
+                task = self._take()
+                if task != None: return task
+                if not block: raise Queue.Empty()
+                if end == None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0: raise Queue.Empty()
+                    self._cond.wait(remaining)
+
+    def task_done(self, task):
+        """Release the dataset and kind of a task handed out by get"""
+        with self._cond:
+            self._in_flight.discard(task[0].id)
+            kind = task_kind(task)
+            self._kind_counts[kind] = self._kind_counts.get(kind, 1) - 1
+            self._cond.notify_all()
+
+class ShardedQueue(object):
+    """A set of FIFO queues, with each item placed on a shard chosen by its key.
+    With one worker per shard, items with the same key are processed in order
+    while items with different keys can be processed in parallel.
+
+    >>> q = ShardedQueue(2)
+    >>> q.put(1, "a")
+    >>> q.put(2, "b")
+    >>> q.put(3, "c")
+    >>> q.qsize()
+    3
+    >>> q.get(1, False), q.get(1, False)
+    ('a', 'c')
+    """
+    def __init__(self, shards, memory_size=0, overflow_factory=None):
+        """
+        :param shards: the number of shards
+        :param memory_size: the most items to keep in memory on each shard, 0 for no limit
+        :param overflow_factory: called with the shard number to create its OverflowFile
+        """
+        if shards < 1:
+            raise ValueError("There must be at least one shard")
+        if memory_size > 0 and overflow_factory != None:
+            self._queues = [SpillQueue(memory_size, overflow_factory(i)) for i in range(shards)]
+        else:
+            self._queues = [Queue.Queue() for i in range(shards)]
+
+    def __len__(self):
+        return len(self._queues)
+
+    def shard_for(self, key):
+        return hash(key) % len(self._queues)
+
+    def qsize(self):
+        """Returns the number of items on all the shards"""
+        return sum([q.qsize() for q in self._queues])
+
+    def put(self, key, item):
+        self._queues[self.shard_for(key)].put(item)
+
+    def get(self, shard, block=True, timeout=None):
+        """Remove and return the next item on the shard. Raises Queue.Empty if
+        there is none within the timeout."""
+        return self._queues[shard].get(block, timeout)
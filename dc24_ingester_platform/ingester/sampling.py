@@ -5,18 +5,29 @@ Created on Oct 24, 2012
 """
 import logging
 import time
+import math
+import random
+import heapq
+import itertools
+import threading
 from jcudc24ingesterapi.ingester_platform_api import get_properties
 
 logger = logging.getLogger("dc24_ingester_platform.ingester.sampling")
 
+def to_epoch(sample_time):
+    """Convert a naive local datetime to seconds since the epoch, keeping
+    the sub-second part.
+    """
+    return time.mktime(sample_time.timetuple()) + sample_time.microsecond / 1000000.0
 
 class Sampler(object):
     """A Sampler is an object that takes a configuration and state
     and uses this to determine whether a dataset is due for a new sample"""
     state = None # Holds the state of the Sampler. This is persisted by the ingester.
     
-    def __init__(self, config=None, state=None):
-        self.state = {}
+    def __init__(self, config=None, state=None, dataset_id=None):
+        self.state = state if state != None else {}
+        self.dataset_id = dataset_id
         if config != None:
             for param in get_properties(config):
                 setattr(self, param, getattr(config, param))
@@ -25,6 +36,18 @@ class Sampler(object):
         """Returns True or False depending on whether a sample should be made"""
         raise NotImplementedError("sample is not implemented for "+str(type(self)))
 
+    def next_sample(self):
+        """Returns the time, in seconds since the epoch, at which sample should next
+        be called. None means the sampler can not predict this and should be polled.
+        """
+        return None
+    
+    def record_fetch(self, count):
+        """Notification of the number of data entries a fetch started by this sampler
+        produced, or None if it is not known. Changes should be made to the state.
+        """
+        pass
+
 class NoSuchSampler(Exception):
     """An exception that occurs when there is no sampler available."""
     def __init__(self, *args, **kwargs):
@@ -46,18 +69,276 @@ class PeriodicSampler(Sampler):
         >>> s.sample(dt, None)
         True
         """
-        run = False
-        now = time.mktime(sampler_time.utctimetuple())
-        if "last_run" not in self.state or (float(self.state["last_run"]) + self.rate) < now:
-            run = True
+        now = to_epoch(sampler_time)
+        if "last_run" in self.state and (float(self.state["last_run"]) + self.interval()) > now:
+            return False
         self.state["last_run"] = now
+        return True
+
+    def next_sample(self):
+        """The next sample is due one period after the last run
+        >>> s = PeriodicSampler()
+        >>> s.rate = 10
+        >>> s.next_sample()
+        0
+        >>> s.state["last_run"] = 100.0
+        >>> s.next_sample()
+        110.0
+        """
+        if "last_run" not in self.state:
+            return 0
+        return float(self.state["last_run"]) + self.interval()
+    
+    def interval(self):
+        """The time between runs, in s"""
+        return float(self.rate)
+
+class StaggeredPeriodicSampler(PeriodicSampler):
+    """A periodic sampler that spreads datasets with the same rate across the period,
+    so they don't all fire on the same tick. Each dataset fires once per period at
+    a fixed phase derived from its ID, plus a random delay of up to jitter * rate.
+    Unlike PeriodicSampler a new dataset waits for its slot rather than firing at once.
+    
+    >>> s = StaggeredPeriodicSampler(state={}, dataset_id=1)
+    >>> s.rate = 100
+    >>> s.jitter = 0
+    >>> round(s.phase(), 2)
+    61.8
+    >>> round(s.slot_after(1000.0), 2)
+    1061.8
+    >>> round(s.slot_after(1061.9), 2)
+    1161.8
+    """
+    jitter = 0.1 # The most random delay, as a fraction of the rate
+    
+    def phase(self):
+        """The dataset's offset into each period. Fibonacci hashing spreads
+        sequential IDs evenly."""
+        if self.dataset_id == None: return 0.0
+        return ((self.dataset_id * 0.6180339887498949) % 1.0) * float(self.rate)
+    
+    def slot_after(self, t):
+        """Returns the start of the dataset's first slot after t"""
+        rate = float(self.rate)
+        phase = self.phase()
+        return (math.floor((t - phase) / rate) + 1) * rate + phase
+    
+    def _next_run(self, t):
+        return self.slot_after(t) + random.uniform(0, float(self.jitter) * float(self.rate))
+    
+    def sample(self, sampler_time, dataset):
+        """Run if the dataset's next slot has arrived, and pick the one after"""
+        now = to_epoch(sampler_time)
+        if now < self.next_sample(now):
+            return False
+        self.state["last_run"] = now
+        self.state["next_run"] = self._next_run(now)
+        return True
+    
+    def next_sample(self, now=None):
+        if "next_run" not in self.state:
+            if "last_run" in self.state:
+                self.state["next_run"] = self._next_run(float(self.state["last_run"]))
+            else:
+                self.state["next_run"] = self._next_run(now if now != None else time.time())
+        return float(self.state["next_run"])
+
+class AdaptivePeriodicSampler(PeriodicSampler):
+    """A periodic sampler that backs off from sources that have nothing new. Each
+    empty fetch multiplies the interval by backoff, up to max_rate, and any data
+    brings it straight back to the rate.
+    
+    >>> s = AdaptivePeriodicSampler()
+    >>> s.rate = 10
+    >>> s.max_rate = 50
+    >>> s.record_fetch(0)
+    >>> s.record_fetch(0)
+    >>> s.interval()
+    40.0
+    >>> s.record_fetch(0)
+    >>> s.interval()
+    50.0
+    >>> s.record_fetch(3)
+    >>> s.interval()
+    10.0
+    """
+    max_rate = None # The longest interval in s. Defaults to 10 times the rate
+    backoff = 2 # The factor the interval grows by after each empty fetch
+    
+    def interval(self):
+        if "interval" in self.state:
+            return float(self.state["interval"])
+        return float(self.rate)
+    
+    def record_fetch(self, count):
+        if count == 0:
+            max_rate = float(self.max_rate) if self.max_rate != None else float(self.rate) * 10
+            self.state["interval"] = min(self.interval() * float(self.backoff), max_rate)
+            self.state["empty_fetches"] = int(self.state.get("empty_fetches", 0)) + 1
+        else:
+            self.state.pop("interval", None)
+            self.state.pop("empty_fetches", None)
+
+samplers = {"periodic_sampling":PeriodicSampler, "staggered_periodic_sampling":StaggeredPeriodicSampler,
+            "adaptive_periodic_sampling":AdaptivePeriodicSampler}
+
+def _state_value(value):
+    """Normalise a state value to the string form it is persisted as"""
+    if isinstance(value, basestring): return value
+    if isinstance(value, float): return repr(value)
+    return str(value)
+
+class SamplerStateCache(object):
+    """Holds the sampler state of every dataset in memory, and tracks which
+    states have changed so that only those are written back, in one transaction.
+    
+    >>> cache = SamplerStateCache(None)
+    >>> cache.put(1, {"last_run":"10"})
+    >>> cache.dirty()
+    [1]
+    >>> cache._dirty.clear()
+    >>> cache.put(1, {"last_run":10})
+    >>> cache.dirty()
+    []
+    """
+    def __init__(self, service):
+        self.service = service
+        self._states = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+        
+    def load(self):
+        """Load the state of all datasets from the service, discarding anything unflushed"""
+        states = self.service.get_sampler_states()
+        with self._lock:
+            self._states = dict([(ds_id, self._normalise(state)) for ds_id, state in states.items()])
+            self._dirty.clear()
+    
+    def _normalise(self, state):
+        return dict([(k, _state_value(v)) for k, v in state.items()])
+            
+    def get(self, dataset_id):
+        """Returns a copy of the state of the dataset"""
+        with self._lock:
+            return dict(self._states.get(dataset_id, {}))
+        
+    def put(self, dataset_id, state):
+        """Update the state of the dataset. It is only marked dirty if it has changed"""
+        state = self._normalise(state)
+        with self._lock:
+            if self._states.get(dataset_id, {}) != state:
+                self._states[dataset_id] = state
+                self._dirty.add(dataset_id)
+                
+    def update(self, dataset_id, func):
+        """Apply func to a copy of the state of the dataset and store it, with
+        no other changes to the state in between. 
+        :param func: callable that takes the state dict and changes it in place
+        """
+        with self._lock:
+            state = self.get(dataset_id)
+            func(state)
+            self.put(dataset_id, state)
+            
+    def dirty(self):
+        """Returns the IDs of the datasets with unflushed state"""
+        with self._lock:
+            return sorted(self._dirty)
         
-        return run
+    def flush(self):
+        """Write all the changed states back to the service in one go"""
+        with self._lock:
+            if len(self._dirty) == 0: return
+            states = dict([(ds_id, self._states[ds_id]) for ds_id in self._dirty])
+            self._dirty.clear()
+        try:
+            self.service.persist_sampler_states(states)
+        except:
+            # Leave them to be written on the next flush
+            with self._lock:
+                self._dirty.update(states.keys())
+            raise
 
-samplers = {"periodic_sampling":PeriodicSampler}
+class SamplerSchedule(object):
+    """A priority queue of datasets ordered by when their sampler is next due. 
+    Datasets can be rescheduled or removed in place, so the ingester only 
+    has to look at the datasets that are actually due.
+    
+    >>> from jcudc24ingesterapi.models.dataset import Dataset
+    >>> schedule = SamplerSchedule()
+    >>> schedule.schedule(Dataset(dataset_id=1), 20)
+    >>> schedule.schedule(Dataset(dataset_id=2), 10)
+    >>> schedule.next_due()
+    10
+    >>> schedule.schedule(Dataset(dataset_id=2), 30)
+    >>> [ds.id for ds in schedule.pop_due(25)]
+    [1]
+    >>> schedule.remove(2)
+    >>> print schedule.next_due()
+    None
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {} # Maps dataset ID to its heap entry
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, dataset_id):
+        return dataset_id in self._entries
+    
+    def get(self, dataset_id):
+        """Returns the scheduled dataset, or None"""
+        with self._lock:
+            entry = self._entries.get(dataset_id)
+            return entry[2] if entry != None else None
+        
+    def schedule(self, dataset, due):
+        """Schedule the dataset to be sampled at due (seconds since the epoch),
+        replacing any existing entry for it.
+        """
+        with self._lock:
+            self.remove(dataset.id)
+            entry = [due, next(self._counter), dataset]
+            self._entries[dataset.id] = entry
+            heapq.heappush(self._heap, entry)
+        
+    def remove(self, dataset_id):
+        """Remove the dataset from the schedule. The heap entry is only marked
+        as removed, and is discarded when it reaches the top of the heap."""
+        with self._lock:
+            entry = self._entries.pop(dataset_id, None)
+            if entry != None:
+                entry[2] = None
+
+    def clear(self):
+        """Remove every dataset from the schedule"""
+        with self._lock:
+            self._heap = []
+            self._entries = {}
+
+    def next_due(self):
+        """Returns the time the earliest dataset is due, or None if nothing is scheduled"""
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][2] == None:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if len(self._heap) > 0 else None
+        
+    def pop_due(self, now):
+        """Remove and return all the datasets that are due at or before now"""
+        ret = []
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                due, count, dataset = heapq.heappop(self._heap)
+                if dataset == None: continue
+                del self._entries[dataset.id]
+                ret.append(dataset)
+        return ret
 
-def create_sampler(sampler_config, state):
+def create_sampler(sampler_config, state, dataset_id=None):
     """Create the correct configured sampler from the provided dict"""
     if sampler_config.__xmlrpc_class__ not in samplers:
         raise NoSuchSampler("Sampler '%s' not found"%(sampler_config.__xmlrpc_class__))
-    return samplers[sampler_config.__xmlrpc_class__](sampler_config, state)
+    return samplers[sampler_config.__xmlrpc_class__](sampler_config, state, dataset_id)
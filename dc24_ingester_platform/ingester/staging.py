@@ -0,0 +1,74 @@
+"""
+The staging file that hands fetched data entries from the ingress stage to the
+archive stage, and keeps them across restarts.
+
+Each line of the file is one marshalled data entry, so entries can be written as
+they are produced and read back one at a time, without the whole batch ever
+being held in memory. Files holding a single JSON list of entries, as written
+by older versions and some processing scripts, can still be read.
+"""
+import json
+import itertools
+
+# The name of the staging file in a task's working directory
+ENTRIES_FILE = "ingest.json"
+
+def write_entries(path, data_entries, marshaller, dataset_id):
+    """Write data entries to a staging file, one per line.
+
+    :param data_entries: iterable of data entries, which is only iterated once
+    :param dataset_id: the dataset the entries are stored against
+    :returns: the number of entries written
+    """
+    count = 0
+    with open(path, "w") as f:
+        for entry in data_entries:
+            entry.dataset = dataset_id
+            f.write(json.dumps(marshaller.obj_to_dict(entry)))
+            f.write("\n")
+            count += 1
+    return count
+
+def _first_char(f):
+    """Returns the first non whitespace character of the file, and rewinds it"""
+    c = f.read(1)
+    while c != "" and c.isspace():
+        c = f.read(1)
+    f.seek(0)
+    return c
+
+def read_entries(path, marshaller, skip=0):
+    """Read the data entries back from a staging file, one at a time.
+
+    :param skip: the number of entries at the start of the file to skip, without
+        unmarshalling them
+    :returns: generator of data entries
+    """
+    with open(path, "r") as f:
+        if _first_char(f) == "[":
+            # A single JSON list
+            for entry in marshaller.dict_to_obj(json.load(f))[skip:]:
+                yield entry
+            return
+        for line in f:
+            if skip > 0:
+                if len(line.strip()) > 0: skip -= 1
+                continue
+            line = line.strip()
+            if len(line) > 0:
+                yield marshaller.dict_to_obj(json.loads(line))
+
+def dataset_batches(data_entries, size):
+    """Split data entries into batches of up to size consecutive entries, each from a
+    single dataset, so a repository can store each batch as one unit.
+
+    >>> class Entry(object):
+    ...     def __init__(self, dataset): self.dataset = dataset
+    >>> [[e.dataset for e in batch] for batch in dataset_batches([Entry(1), Entry(1), Entry(1), Entry(2), Entry(1)], 2)]
+    [[1, 1], [1], [2], [1]]
+    """
+    for dataset_id, entries in itertools.groupby(data_entries, lambda entry: entry.dataset):
+        while True:
+            batch = list(itertools.islice(entries, size))
+            if len(batch) == 0: break
+            yield batch
@@ -7,17 +7,33 @@ import sys
 #import sandbox
 import unittest
 import datetime
+import time
 import shutil
 import tempfile
 import logging
+import json
+import Queue
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+from twisted.internet.task import Clock
+from twisted.trial import unittest as trial_unittest
 from processor import *
 from dc24_ingester_platform.service import IIngesterService
-from dc24_ingester_platform.ingester import IngesterEngine, create_data_source
-from dc24_ingester_platform.ingester.data_sources import DataSource
+from dc24_ingester_platform.ingester import IngesterEngine, create_data_source, web_client
+from dc24_ingester_platform.ingester.data_sources import DataSource, PullDataSource as PullDataSourceImpl
+from dc24_ingester_platform.ingester.queues import IngressQueue, OverflowFile, LANE_SCHEDULED,\
+    LANE_MANUAL, LANE_DERIVED
+from dc24_ingester_platform.ingester.staging import write_entries, read_entries
+from dc24_ingester_platform.transfer import link_file, move_file, copy_file
+from dc24_ingester_platform.utils import format_timestamp
+from dc24_ingester_platform.ingester.sampling import StaggeredPeriodicSampler, to_epoch
+from jcudc24ingesterapi.ingester_platform_api import Marshaller
 from jcudc24ingesterapi.models.data_entry import DataEntry, FileObject
 from jcudc24ingesterapi.models.dataset import Dataset
 from jcudc24ingesterapi.models.data_sources import _DataSource, PushDataSource,\
-    DatasetDataSource
+    DatasetDataSource, PullDataSource
+from jcudc24ingesterapi.models.sampling import PeriodicSampling
 
 logger = logging.getLogger("dc24_ingester_platform")
 
@@ -50,11 +66,429 @@ class TestScriptModels(unittest.TestCase):
 """
         self.assertRaises(ImportError, run_script, (script, self.cwd, None))
 
+class TestIngressQueue(unittest.TestCase):
+    def make_task(self, dataset_id, kind, task_id):
+        dataset = Dataset(dataset_id=dataset_id)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = kind
+        return (dataset, None, task_id, None)
+    
+    def testDatasetInFlight(self):
+        """A dataset must never have two tasks in flight"""
+        q = IngressQueue()
+        q.put(self.make_task(1, "csv1", 1))
+        q.put(self.make_task(1, "csv1", 2))
+        q.put(self.make_task(2, "csv1", 3))
+        
+        task1 = q.get(False)
+        self.assertEquals(1, task1[2])
+        # Task 2 is for the same dataset so task 3 overtakes it
+        self.assertEquals(3, q.get(False)[2])
+        self.assertRaises(Queue.Empty, q.get, False)
+        q.task_done(task1)
+        self.assertEquals(2, q.get(False)[2])
+        
+    def testKindLimit(self):
+        """Only the configured number of tasks of a kind may run at once"""
+        q = IngressQueue({"slow":1})
+        q.put(self.make_task(1, "slow", 1))
+        q.put(self.make_task(2, "slow", 2))
+        q.put(self.make_task(3, "fast", 3))
+        
+        task1 = q.get(False)
+        self.assertEquals(3, q.get(False)[2])
+        self.assertRaises(Queue.Empty, q.get, True, 0.01)
+        q.task_done(task1)
+        self.assertEquals(2, q.get(False)[2])
+
+    def testFairness(self):
+        """A low weight dataset with a backlog gives way to the others"""
+        q = IngressQueue(weights={1:0.5})
+        for i in range(4):
+            q.put(self.make_task(1, "csv1", i))
+        q.put(self.make_task(2, "csv1", 4))
+        q.put(self.make_task(3, "csv1", 5))
+        
+        task_ids = []
+        while q.qsize() > 0:
+            task = q.get(False)
+            task_ids.append(task[2])
+            q.task_done(task)
+        self.assertEquals([4, 5, 0, 1, 2, 3], task_ids)
+
+    def testInvalidWeight(self):
+        """A dataset can't be given no share of the workers"""
+        self.assertRaises(ValueError, IngressQueue, weights={1:0})
+        self.assertRaises(ValueError, IngressQueue, weights={1:-1})
+        staging = tempfile.mkdtemp()
+        try:
+            self.assertRaises(ValueError, IngesterEngine, MockService(), staging, None, dataset_weights={1:0})
+        finally:
+            shutil.rmtree(staging)
+
+    def testLanes(self):
+        """Manual tasks overtake scheduled ones, which overtake derived ones"""
+        q = IngressQueue()
+        q.put(self.make_task(1, "csv1", 1), LANE_DERIVED)
+        q.put(self.make_task(2, "csv1", 2))
+        q.put(self.make_task(3, "csv1", 3), LANE_MANUAL)
+        self.assertEquals([3, 2, 1], [q.get(False)[2] for i in range(3)])
+
+    def make_overflow_factory(self, staging, overflow):
+        def overflow_factory(lane, ds_id):
+            overflow[(lane, ds_id)] = OverflowFile(os.path.join(staging, "ingress-%d-%d.overflow"%(lane, ds_id)), 
+                    lambda t: [t[0].id, t[2]], lambda t: self.make_task(t[0], "csv1", t[1]))
+            return overflow[(lane, ds_id)]
+        return overflow_factory
+    
+    def testSpill(self):
+        """Tasks beyond the memory size go to disk, and come back in order"""
+        staging = tempfile.mkdtemp()
+        try:
+            overflow = {}
+            q = IngressQueue(memory_size=2, overflow_factory=self.make_overflow_factory(staging, overflow))
+            for i in range(5):
+                q.put(self.make_task(i, "csv1", i))
+            self.assertEquals(5, q.qsize())
+            self.assertEquals(3, sum([len(f) for f in overflow.values()]))
+            
+            task_ids = []
+            while q.qsize() > 0:
+                task = q.get(False)
+                task_ids.append(task[2])
+                q.task_done(task)
+            self.assertEquals(range(5), task_ids)
+            # The overflow files are removed once emptied
+            self.assertEquals([], os.listdir(staging))
+        finally:
+            shutil.rmtree(staging)
+            
+    def testSpillBacklog(self):
+        """A backlog from one dataset doesn't hold another dataset's tasks on disk"""
+        for dataset_memory_size in (2, 4):
+            staging = tempfile.mkdtemp()
+            try:
+                q = IngressQueue(memory_size=4, overflow_factory=self.make_overflow_factory(staging, {}),
+                                 dataset_memory_size=dataset_memory_size)
+                for i in range(10):
+                    q.put(self.make_task(1, "csv1", i))
+                q.put(self.make_task(2, "csv1", 10))
+                self.assertEquals(11, q.qsize())
+                
+                # The second dataset's task runs alongside the backlog
+                task = q.get(False)
+                self.assertEquals(0, task[2])
+                self.assertEquals(10, q.get(False)[2])
+                q.task_done(task)
+                
+                task_ids = []
+                while q.qsize() > 0:
+                    task = q.get(False)
+                    task_ids.append(task[2])
+                    q.task_done(task)
+                self.assertEquals(range(1, 10), task_ids)
+            finally:
+                shutil.rmtree(staging)
+
+class TestStaggeredSampler(unittest.TestCase):
+    def make_sampler(self, dataset_id, state=None):
+        s = StaggeredPeriodicSampler(state=state, dataset_id=dataset_id)
+        s.rate = 60
+        return s
+    
+    def testSpread(self):
+        """Datasets created together should be spread evenly over the period"""
+        buckets = [0] * 6
+        for ds_id in range(1, 61):
+            buckets[int(self.make_sampler(ds_id).phase() / 10)] += 1
+        self.assertTrue(min(buckets) >= 8, buckets)
+        
+    def testSchedule(self):
+        """Each dataset runs once per period, within its jittered slot"""
+        s = self.make_sampler(7)
+        s.jitter = 0.5
+        phase = s.phase()
+        now = datetime.datetime(2013, 1, 1)
+        due = s.next_sample(to_epoch(now))
+        self.assertFalse(s.sample(now, None))
+        for i in range(5):
+            self.assertTrue(due > to_epoch(now))
+            self.assertTrue(0 <= (due - phase) % 60 <= 30)
+            now = datetime.datetime.fromtimestamp(due + 0.001)
+            self.assertTrue(s.sample(now, None))
+            self.assertFalse(s.sample(now, None))
+            due = s.next_sample()
+        # The next run survives a restart
+        self.assertEquals(due, self.make_sampler(7, dict(s.state)).next_sample())
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.cwd = tempfile.mkdtemp()
+        self.src = os.path.join(self.cwd, "src")
+        with open(self.src, "wb") as f:
+            f.write("x" * 100000)
+        
+    def tearDown(self):
+        shutil.rmtree(self.cwd)
+        
+    def testLink(self):
+        """On the same filesystem the file is linked, leaving the source in place"""
+        dst = os.path.join(self.cwd, "dst")
+        with open(dst, "w") as f:
+            f.write("old")
+        link_file(self.src, dst)
+        self.assertEquals(os.stat(self.src).st_ino, os.stat(dst).st_ino)
+        self.assertRaises(OSError, link_file, os.path.join(self.cwd, "missing"), dst)
+        
+    def testMoveAndCopy(self):
+        moved = os.path.join(self.cwd, "moved")
+        move_file(self.src, moved)
+        self.assertFalse(os.path.exists(self.src))
+        copied = os.path.join(self.cwd, "copied")
+        copy_file(moved, copied)
+        self.assertNotEquals(os.stat(moved).st_ino, os.stat(copied).st_ino)
+        with open(copied, "rb") as f:
+            self.assertEquals("x" * 100000, f.read())
+
+def start_http_server(served):
+    """Serve the served directory on a free local port, in a thread. /single is a
+    resource that supports conditional requests, /empty has no content, and files
+    named broken fail.
+    """
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            if "broken" in self.path:
+                return self.send_error(500)
+            if self.path == "/empty":
+                self.send_response(204)
+                self.end_headers()
+                return
+            if self.path != "/single":
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            # A resource that supports conditional requests
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Last-Modified", "Tue, 01 Jan 2013 00:00:00 GMT")
+            self.end_headers()
+            self.wfile.write("1,2\n")
+        def translate_path(self, path):
+            return os.path.join(served, path.lstrip("/"))
+        def log_message(self, *args):
+            pass
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever).start()
+    return server
+
+class TestPullDataSource(unittest.TestCase):
+    """Recursive HTTP fetches against a local web server listing a directory"""
+    def setUp(self):
+        self.served = tempfile.mkdtemp()
+        self.cwd = tempfile.mkdtemp()
+        for i in range(20):
+            with open(os.path.join(self.served, "file%02d.csv"%i), "w") as f:
+                f.write("%d,1\n"%i)
+        self.server = start_http_server(self.served)
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.served)
+        shutil.rmtree(self.cwd)
+        
+    def testFetchHTTP(self):
+        config = PullDataSource("http://127.0.0.1:%d/"%self.server.server_port, field="file", recursive=True)
+        config.pattern = "file.*"
+        data_source = PullDataSourceImpl({}, None, config)
+        entries = data_source.fetch(self.cwd)
+        self.assertEquals(20, len(entries))
+        self.assertEquals(range(20), sorted([int(open(os.path.join(self.cwd, entry["file"].f_path)).read().split(",")[0])
+                                             for entry in entries]))
+        self.assertEquals(format_timestamp(max([entry.timestamp for entry in entries])), data_source.state["lasttime"])
+        
+    def testConditionalGet(self):
+        """An unchanged resource gives no data entries"""
+        config = PullDataSource("http://127.0.0.1:%d/single"%self.server.server_port, field="file")
+        data_source = PullDataSourceImpl({}, None, config)
+        self.assertEquals(1, len(data_source.fetch(self.cwd)))
+        self.assertEquals('"v1"', data_source.state["etag"])
+        self.assertEquals("Tue, 01 Jan 2013 00:00:00 GMT", data_source.state["last_modified"])
+        
+        data_source = PullDataSourceImpl(dict(data_source.state), None, config)
+        self.assertEquals([], data_source.fetch(self.cwd))
+
+class TestAsyncPullDataSource(trial_unittest.TestCase):
+    """Fetches made with the Twisted web client against a local web server. Each
+    test returns a Deferred that trial runs on the reactor.
+    """
+    def setUp(self):
+        self.served = tempfile.mkdtemp()
+        self.cwd = tempfile.mkdtemp()
+        self.staging = tempfile.mkdtemp()
+        for i in range(20):
+            with open(os.path.join(self.served, "file%02d.csv"%i), "w") as f:
+                f.write("%d,1\n"%i)
+        self.server = start_http_server(self.served)
+        self.url = "http://127.0.0.1:%d/"%self.server.server_port
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.served)
+        shutil.rmtree(self.cwd, True)
+        shutil.rmtree(self.staging)
+        # Don't leave kept alive connections open on the reactor
+        return web_client.close_connections()
+    
+    def testFetchSingle(self):
+        """A 200 response is downloaded, and a 304 response gives no data entries"""
+        config = PullDataSource(self.url + "single", field="file")
+        data_source = PullDataSourceImpl({}, None, config)
+        
+        def fetched(entries):
+            self.assertEquals(1, len(entries))
+            with open(os.path.join(self.cwd, entries[0]["file"].f_path)) as f:
+                self.assertEquals("1,2\n", f.read())
+            self.assertEquals('"v1"', data_source.state["etag"])
+            self.assertEquals("Tue, 01 Jan 2013 00:00:00 GMT", data_source.state["last_modified"])
+            return PullDataSourceImpl(dict(data_source.state), None, config).fetch_async(self.cwd)
+        
+        d = data_source.fetch_async(self.cwd)
+        d.addCallback(fetched)
+        d.addCallback(self.assertEquals, [])
+        return d
+    
+    def testFetchSingleError(self):
+        """An error status fails the fetch"""
+        config = PullDataSource(self.url + "broken.csv", field="file")
+        data_source = PullDataSourceImpl({}, None, config)
+        d = self.assertFailure(data_source.fetch_async(self.cwd), web_client.HTTPDownloadError)
+        d.addCallback(lambda e: self.assertEquals(500, e.code))
+        d.addCallback(lambda ignored: self.assertEquals({}, data_source.state))
+        return d
+    
+    def testFetchSingleNoContent(self):
+        """A success status without the resource's content fails the fetch"""
+        config = PullDataSource(self.url + "empty", field="file")
+        data_source = PullDataSourceImpl({}, None, config)
+        d = self.assertFailure(data_source.fetch_async(self.cwd), web_client.HTTPDownloadError)
+        d.addCallback(lambda e: self.assertEquals(204, e.code))
+        d.addCallback(lambda ignored: self.assertFalse(os.path.exists(os.path.join(self.cwd, "outputfile"))))
+        return d
+    
+    def testFetchHTTP(self):
+        """A recursive fetch downloads every matching file"""
+        config = PullDataSource(self.url, field="file", recursive=True)
+        config.pattern = "file.*"
+        data_source = PullDataSourceImpl({}, None, config)
+        
+        def fetched(entries):
+            self.assertEquals(20, len(entries))
+            self.assertEquals(range(20), sorted([int(open(os.path.join(self.cwd, entry["file"].f_path)).read().split(",")[0])
+                                                 for entry in entries]))
+            self.assertEquals(format_timestamp(max([entry.timestamp for entry in entries])), data_source.state["lasttime"])
+        return data_source.fetch_async(self.cwd).addCallback(fetched)
+    
+    def testFetchHTTPError(self):
+        """A file that fails to download is skipped, the rest are still fetched"""
+        open(os.path.join(self.served, "file_broken.csv"), "w").close()
+        config = PullDataSource(self.url, field="file", recursive=True)
+        config.pattern = "file.*"
+        data_source = PullDataSourceImpl({}, None, config)
+        
+        def fetched(entries):
+            self.assertEquals(20, len(entries))
+            self.assertEquals(set(["file%02d.csv"%i for i in range(20)]), 
+                              set([entry["file"].file_name for entry in entries]))
+        return data_source.fetch_async(self.cwd).addCallback(fetched)
+    
+    def _engine_task(self, url):
+        """Returns an engine fetching on the reactor, and a task taken from its ingress queue"""
+        from twisted.internet import reactor
+        self.service = MockService()
+        ingester = IngesterEngine(self.service, self.staging, None, reactor=reactor, async_fetch=True)
+        dataset = Dataset(dataset_id=1)
+        dataset.data_source = PullDataSource(url, field="file")
+        ingester._ingress_queue.put((dataset, None, 1, self.cwd))
+        task = ingester._ingress_queue.get(False)
+        return ingester, task, PullDataSourceImpl({}, None, dataset.data_source)
+    
+    def testEngineFetch(self):
+        """The fetched entries are staged and queued for archiving, and the task is done"""
+        ingester, task, data_source = self._engine_task(self.url + "single")
+        
+        def fetched(ignored):
+            self.assertEquals(0, ingester._ingress_queue.in_flight())
+            self.assertEquals(1, ingester._archive_queue.qsize())
+            self.assertTrue(os.path.exists(os.path.join(self.cwd, "ingest.json")))
+            self.assertEquals([{"labels":{"dataset":"1", "kind":"pull_data_source"}, "value":1.0}],
+                              ingester.metrics.snapshot()["ingester_fetched_entries_total"]["samples"])
+        return ingester._fetch_async(task, data_source).addCallback(fetched)
+    
+    def testEngineFetchError(self):
+        """A failed fetch is logged, and the task is still done"""
+        ingester, task, data_source = self._engine_task(self.url + "missing.csv")
+        
+        def fetched(ignored):
+            self.assertEquals(0, ingester._ingress_queue.in_flight())
+            self.assertEquals(0, ingester._archive_queue.qsize())
+            self.assertEquals("ERROR", self.service.logs[1][-1][1])
+            self.assertEquals([{"labels":{"dataset":"1", "kind":"pull_data_source"}, "value":1.0}],
+                              ingester.metrics.snapshot()["ingester_fetch_errors_total"]["samples"])
+        return ingester._fetch_async(task, data_source).addCallback(fetched)
+
+class TestStaging(unittest.TestCase):
+    def setUp(self):
+        self.cwd = tempfile.mkdtemp()
+        self.marshaller = Marshaller()
+
+    def tearDown(self):
+        shutil.rmtree(self.cwd)
+        
+    def testRoundTrip(self):
+        """Entries are written one per line from a generator, and read back lazily"""
+        path = os.path.join(self.cwd, "ingest.json")
+        entries = (DataEntry(timestamp=datetime.datetime.now()) for i in range(3))
+        self.assertEquals(3, write_entries(path, entries, self.marshaller, 5))
+        with open(path) as f:
+            self.assertEquals(3, len(f.readlines()))
+        
+        entries = list(read_entries(path, self.marshaller))
+        self.assertEquals(3, len(entries))
+        self.assertEquals(5, entries[0].dataset)
+        
+    def testSkip(self):
+        """Entries that have already been archived can be skipped"""
+        path = os.path.join(self.cwd, "ingest.json")
+        entries = [DataEntry(5, datetime.datetime.now()) for i in range(3)]
+        for i in range(3): entries[i].id = i
+        write_entries(path, entries, self.marshaller, 5)
+        self.assertEquals([2], [e.id for e in read_entries(path, self.marshaller, 2)])
+        
+    def testLegacyFormat(self):
+        """A single JSON list, as written by processing scripts, can still be read"""
+        path = os.path.join(self.cwd, "ingest.json")
+        entries = [DataEntry(5, datetime.datetime.now()) for i in range(2)]
+        with open(path, "w") as f:
+            json.dump(self.marshaller.obj_to_dict(entries), f)
+        self.assertEquals(2, len(list(read_entries(path, self.marshaller))))
+
 class MockService(IIngesterService):
     def __init__(self):
         self.logs = {}
         self.datasets = {}
         self.listeners = []
+        self.dataset_listeners = []
+        self.sampler_state = {}
+        self.profile_runs = {}
+        self.profiles = {}
+        self.atomic = True
+        self.progress = []
+        self.lost = set()
+        self.fetch_feedback = []
         
     def get_data_source_state(self, dataset_id):
         return {}
@@ -62,9 +496,32 @@ class MockService(IIngesterService):
     def persist_data_source_state(self, dataset_id, state):
         return
     
+    def get_sampler_state(self, dataset_id):
+        return dict(self.sampler_state.get(dataset_id, {}))
+    
+    def persist_sampler_state(self, dataset_id, state):
+        self.sampler_state[dataset_id] = dict(state)
+    
+    def get_sampler_states(self):
+        return dict([(k, dict(v)) for k, v in self.sampler_state.items()])
+    
+    def persist_sampler_states(self, states):
+        for dataset_id in states:
+            self.persist_sampler_state(dataset_id, states[dataset_id])
+    
     def getDataset(self, dataset_id):
         return self.datasets[dataset_id]
     
+    def get_dataset(self, dataset_id):
+        return self.datasets.get(dataset_id)
+    
+    def record_fetch_feedback(self, dataset_id, count):
+        self.fetch_feedback.append((dataset_id, count))
+        
+    def take_fetch_feedback(self):
+        ret, self.fetch_feedback = self.fetch_feedback, []
+        return ret
+    
     def log_ingester_event(self, dataset_id, timestamp, level, message):
         if dataset_id not in self.logs:
             self.logs[dataset_id] = []
@@ -80,17 +537,56 @@ class MockService(IIngesterService):
     def register_observation_listener(self, listener):
         self.listeners.append(listener)
         
+    def register_dataset_listener(self, listener):
+        self.dataset_listeners.append(listener)
+        
     def get_active_datasets(self, kind=None):
         return [ds for ds in self.datasets.values() if ds.enabled==True and (kind==None or ds.data_source != None and ds.data_source.__xmlrpc_class__==kind)]
 
-    def create_ingest_task(self, ds_id, params, cwd):
+    def create_ingest_task(self, ds_id, params, cwd, lane=None):
         return 0
 
-    def mark_ingress_complete(self, task_id):
-        pass
+    def mark_ingress_complete(self, task_id, node_id=None):
+        return True
+
+    def mark_ingest_complete(self, task_id, node_id=None):
+        return True
+
+    def persist_many(self, entries, cwd, progress=None):
+        ret = []
+        for entry in entries:
+            ret.append(self.persist(entry, cwd))
+            if not self.atomic and progress != None: progress(len(ret))
+        return ret
+
+    def mark_ingest_progress(self, task_id, progress):
+        self.progress.append(progress)
+
+    def get_ingest_progress(self, task_id):
+        return 0
+
+    def renew_leases(self, node_id, task_ids, lease_time):
+        return [task_id for task_id in task_ids if task_id not in self.lost]
+
+    def claim_ingest_tasks(self, node_id, limit, lease_time):
+        return []
+
+    def acquire_role(self, role, node_id, lease_time):
+        return False
+
+    def get_modified_datasets(self, since):
+        return []
+
+    def request_script_profile(self, dataset_id, runs):
+        self.profile_runs[dataset_id] = runs
+
+    def take_script_profile_run(self, dataset_id):
+        if self.profile_runs.get(dataset_id, 0) == 0: return False
+        self.profile_runs[dataset_id] -= 1
+        return True
 
-    def mark_ingest_complete(self, task_id):
-        pass
+    def persist_script_profile(self, dataset_id, timestamp, stats):
+        self.profiles.setdefault(dataset_id, []).append(stats)
 
 class MockSource(DataSource):
     pass
@@ -116,6 +612,21 @@ class DataEntryListener(object):
     def count(self):
         return len(self._data_entries)
 
+class ThreadedClock(Clock):
+    """A Clock that takes calls from other threads, as the reactor does. They are
+    run on the test's thread by run_pending."""
+    def __init__(self):
+        Clock.__init__(self)
+        self.pending = Queue.Queue()
+        
+    def callFromThread(self, f, *args, **kwargs):
+        self.pending.put((f, args, kwargs))
+        
+    def run_pending(self):
+        while not self.pending.empty():
+            f, args, kwargs = self.pending.get()
+            f(*args, **kwargs)
+
 class TestIngesterProcess(unittest.TestCase):
     def setUp(self):
         self.cwd = tempfile.mkdtemp()
@@ -159,6 +670,29 @@ class TestIngesterProcess(unittest.TestCase):
         
         self.ingester.process_archive_queue(True)
         self.assertEquals(1, data_entries.count())
+        
+    def testMetrics(self):
+        """Each stage of an ingest is recorded against the dataset and data source kind"""
+        dataset = Dataset()
+        dataset.id = 1
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        
+        self.ingester.enqueue_ingress(dataset)
+        self.ingester.process_ingress_queue(True)
+        self.ingester.process_archive_queue(True)
+        
+        metrics = self.ingester.metrics.snapshot()
+        labels = {"dataset":"1", "kind":"csv1"}
+        self.assertEquals([{"labels":labels, "value":1.0}], metrics["ingester_fetched_entries_total"]["samples"])
+        self.assertEquals([{"labels":labels, "value":1.0}], metrics["ingester_archived_entries_total"]["samples"])
+        # The size of the fetched file, not of the staged entries
+        self.assertEquals([{"labels":labels, "value":float(len("2,55\n3,2\n"))}], 
+                          metrics["ingester_staged_bytes_total"]["samples"])
+        for name in ("ingester_fetch_seconds", "ingester_staging_seconds", "ingester_persist_seconds"):
+            self.assertEquals([labels], [sample["labels"] for sample in metrics[name]["samples"]])
+            self.assertEquals(1.0, metrics[name]["samples"][0]["count"])
+        self.assertEquals(0.0, metrics["ingester_ingress_queue_depth"]["samples"][0]["value"])
     
     def testPostProcessScript(self):
         """This test performs a complex data ingest, where the main data goes into dataset 1 and 
@@ -196,6 +730,51 @@ def process(cwd, data_entry):
         self.assertEquals(0, self.ingester._archive_queue.qsize())
         self.assertEquals(2, data_entries.count())
         
+    def testScriptProfile(self):
+        """Only the requested number of runs of a processing script are profiled"""
+        script = """def process(cwd, data_entry):
+    return data_entry
+"""
+        dataset = Dataset(dataset_id=1)
+        dataset.data_source = _DataSource(processing_script = script)
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        
+        self.service.request_script_profile(1, 1)
+        for i in range(2):
+            self.ingester.enqueue_ingress( dataset )
+            self.ingester.process_ingress_queue(True)
+            self.ingester.process_archive_queue(True)
+        self.assertEquals(1, len(self.service.profiles[1]))
+        self.assertIn("process", self.service.profiles[1][0])
+        
+    def testArchiveCheckpoints(self):
+        """Progress is checkpointed per batch if the repository stores a batch atomically,
+        otherwise after each entry the repository reports stored"""
+        for atomic, progress in ((True, [3]), (False, [1, 2, 3])):
+            self.service.atomic = atomic
+            self.service.progress = []
+            cwd = tempfile.mkdtemp(dir=self.staging)
+            entries = [DataEntry(timestamp=datetime.datetime.now()) for i in range(3)]
+            write_entries(os.path.join(cwd, "ingest.json"), entries, self.ingester.domain_marshaller, 1)
+            self.ingester.enqueue_archive(0, "ingest.json", cwd, 1)
+            self.ingester.process_archive_queue(True)
+            self.assertEquals(progress, self.service.progress)
+            self.assertFalse(os.path.exists(cwd))
+        
+    def testArchiveMixedDatasets(self):
+        """A staging file with entries from several datasets is archived a dataset at a time"""
+        batches = []
+        self.service.persist_many = lambda entries, cwd, progress=None: batches.append([e.dataset for e in entries])
+        cwd = tempfile.mkdtemp(dir=self.staging)
+        entries = [DataEntry(timestamp=datetime.datetime.now()) for i in range(3)]
+        with open(os.path.join(cwd, "ingest.json"), "w") as f:
+            for dataset_id, entry in zip([1, 2, 2], entries):
+                entry.dataset = dataset_id
+                f.write(json.dumps(self.ingester.domain_marshaller.obj_to_dict(entry)) + "\n")
+        self.ingester.enqueue_archive(0, "ingest.json", cwd, 1)
+        self.ingester.process_archive_queue(True)
+        self.assertEquals([[1], [2, 2]], batches)
+        self.assertEquals([1, 3], self.service.progress)
         
     def testComplexIngest(self):
         """This test performs a complex data ingest, where the main data goes into dataset 1 and 
@@ -245,6 +824,252 @@ def process(cwd, data_entry):
 #        self.ingester.processQueue()
 #        self.assertEquals(2, len(self.ingester._ingest_queue), "Two output rows")
         
+    def testTriggerBatching(self):
+        """New entries in a source dataset are collected into one derived task"""
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset2 = Dataset(dataset_id=2, enabled=True)
+        dataset2.data_source = DatasetDataSource(dataset_id=1)
+        self.service.datasets[1] = dataset
+        self.service.datasets[2] = dataset2
+        
+        for i in range(3):
+            data_entry = DataEntry(1, datetime.datetime.now())
+            data_entry.id = i
+            with self.ingester._archive_batch():
+                self.ingester.notify_new_data_entry(data_entry, None)
+        self.assertEquals(0, self.ingester._ingress_queue.qsize())
+        
+        self.ingester.flush_triggers()
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        task = self.ingester._ingress_queue.get(False)
+        self.assertEquals(2, task[0].id)
+        self.assertEquals({"dataset":1, "ids":[0, 1, 2]}, task[1])
+        self.ingester._ingress_queue.task_done(task)
+        
+    def testTriggersAcrossTasks(self):
+        """Triggers from several archive tasks build up into one derived task"""
+        dataset2 = Dataset(dataset_id=2, enabled=True)
+        dataset2.data_source = DatasetDataSource(dataset_id=1)
+        self.service.datasets[2] = dataset2
+        
+        for task_id in range(2):
+            cwd = tempfile.mkdtemp(dir=self.staging)
+            entries = [DataEntry(timestamp=datetime.datetime.now()) for i in range(2)]
+            write_entries(os.path.join(cwd, "ingest.json"), entries, self.ingester.domain_marshaller, 1)
+            self.ingester.enqueue_archive(task_id, "ingest.json", cwd, 1)
+            self.ingester.process_archive_queue(True)
+        self.assertEquals(0, self.ingester._ingress_queue.qsize())
+        
+        self.ingester.flush_triggers()
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        self.assertEquals(4, len(self.ingester._ingress_queue.get(False)[1]["ids"]))
+        
+    def testTriggerJournal(self):
+        """Pending triggers are journalled, and restored after a restart"""
+        dataset2 = Dataset(dataset_id=2, enabled=True)
+        dataset2.data_source = DatasetDataSource(dataset_id=1)
+        self.service.datasets[2] = dataset2
+        
+        for i in range(2):
+            data_entry = DataEntry(1, datetime.datetime.now())
+            data_entry.id = i
+            with self.ingester._archive_batch():
+                self.ingester.notify_new_data_entry(data_entry, None)
+        
+        ingester = IngesterEngine(self.service, self.staging, self.data_source_factory)
+        ingester.restore_triggers()
+        ingester.flush_triggers()
+        self.assertEquals(1, ingester._ingress_queue.qsize())
+        self.assertEquals({"dataset":1, "ids":[0, 1]}, ingester._ingress_queue.get(False)[1])
+        self.assertFalse(os.path.exists(ingester._trigger_journal_path))
+        
+    def testTriggerFlush(self):
+        """Entries stored outside an archive batch trigger straight away, and pending
+        triggers are queued on shutdown"""
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset2 = Dataset(dataset_id=2, enabled=True)
+        dataset2.data_source = DatasetDataSource(dataset_id=1)
+        self.service.datasets[1] = dataset
+        self.service.datasets[2] = dataset2
+        
+        data_entry = DataEntry(1, datetime.datetime.now())
+        data_entry.id = 0
+        self.ingester.notify_new_data_entry(data_entry, None)
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        task = self.ingester._ingress_queue.get(False)
+        self.assertEquals({"dataset":1, "ids":[0]}, task[1])
+        self.ingester._ingress_queue.task_done(task)
+        
+        data_entry.id = 1
+        with self.ingester._archive_batch():
+            self.ingester.notify_new_data_entry(data_entry, None)
+        self.assertEquals(0, self.ingester._ingress_queue.qsize())
+        self.ingester.shutdown()
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        self.assertEquals({"dataset":1, "ids":[1]}, self.ingester._ingress_queue.get(False)[1])
+        
+    def testDependentsIndex(self):
+        """The derived datasets of a source are found without querying the service"""
+        dataset2 = Dataset(dataset_id=2, enabled=True)
+        dataset2.data_source = DatasetDataSource(dataset_id=1)
+        self.service.datasets[2] = dataset2
+        self.assertEquals([2], [ds.id for ds in self.ingester.get_dependents(1)])
+        
+        dataset2.data_source = DatasetDataSource(dataset_id=3)
+        self.ingester.notify_dataset_changed(dataset2)
+        self.assertEquals(0, len(self.ingester.get_dependents(1)))
+        self.assertEquals([2], [ds.id for ds in self.ingester.get_dependents(3)])
+        
+        dataset2.enabled = False
+        self.ingester.notify_dataset_changed(dataset2)
+        self.assertEquals(0, len(self.ingester.get_dependents(3)))
+        
+    def testSamplerSchedule(self):
+        """This test checks that samplers are only run when due, and that
+        disabled datasets are dropped from the schedule"""
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        dataset.data_source.sampling = PeriodicSampling(10000)
+        self.service.datasets[1] = dataset
+        
+        self.ingester.load_samplers()
+        self.ingester.process_samplers()
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        
+        # Not due again for another 10000s
+        self.ingester.process_samplers()
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        self.assertIn(1, self.ingester._schedule)
+        # The sampler state was flushed to the service
+        self.assertIn("last_run", self.service.sampler_state[1])
+        
+        dataset.enabled = False
+        self.ingester.notify_dataset_changed(dataset)
+        self.assertNotIn(1, self.ingester._schedule)
+        
+    def testStaggeredSampler(self):
+        """A staggered sampler fires at the jittered slot it was scheduled for"""
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        dataset.data_source.sampling = PeriodicSampling(100)
+        dataset.data_source.sampling.__xmlrpc_class__ = "staggered_periodic_sampling"
+        self.service.datasets[1] = dataset
+        
+        clock = Clock()
+        clock.advance(time.time())
+        self.ingester.start_samplers(clock)
+        due = self.ingester._schedule.next_due()
+        self.assertEquals(due, float(self.ingester._sampler_states.get(1)["next_run"]))
+        self.assertEquals(0, self.ingester._ingress_queue.qsize())
+        
+        clock.advance(due - clock.seconds() + 0.001)
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        
+    def testAdaptiveSampler(self):
+        """This test checks that empty fetches back off the sampler, and that data
+        brings it back to the base rate"""
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        dataset.data_source.sampling = PeriodicSampling(100)
+        dataset.data_source.sampling.__xmlrpc_class__ = "adaptive_periodic_sampling"
+        self.service.datasets[1] = dataset
+        
+        self.ingester.load_samplers()
+        self.ingester.process_samplers()
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        last_run = float(self.ingester._sampler_states.get(1)["last_run"])
+        self.assertEquals(last_run + 100, self.ingester._schedule.next_due())
+        
+        self.ingester.record_fetch(dataset, 0)
+        self.ingester.record_fetch(dataset, 0)
+        self.assertEquals(last_run + 400, self.ingester._schedule.next_due())
+        
+        self.ingester.record_fetch(dataset, 3)
+        self.assertEquals(last_run + 100, self.ingester._schedule.next_due())
+        self.assertNotIn("interval", self.ingester._sampler_states.get(1))
+        
+    def testRecordFetchThreaded(self):
+        """A fetch recorded by a worker thread reschedules the sampler on the reactor thread"""
+        clock = ThreadedClock()
+        self.ingester = IngesterEngine(self.service, self.staging, self.data_source_factory, reactor=clock)
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        dataset.data_source.sampling = PeriodicSampling(100)
+        dataset.data_source.sampling.__xmlrpc_class__ = "adaptive_periodic_sampling"
+        self.service.datasets[1] = dataset
+        
+        self.ingester.start_samplers(clock)
+        self.assertEquals(1, self.ingester._ingress_queue.qsize())
+        self.assertTrue(abs(100 - self.ingester._sampler_call.getTime()) < 1)
+        
+        def record_fetch(count):
+            worker = threading.Thread(target=self.ingester.record_fetch, args=(dataset, count))
+            worker.start()
+            worker.join()
+        # Back off to 400s. The sampler loop wakes at 100s, finds nothing due, and sleeps until 400s
+        record_fetch(0)
+        record_fetch(0)
+        clock.run_pending()
+        clock.advance(101)
+        self.assertTrue(abs(400 - self.ingester._sampler_call.getTime()) < 1)
+        
+        # Data brings the sampler back to 100s, so it is due now, but only once the 
+        # reactor thread runs the change
+        record_fetch(3)
+        self.assertTrue(abs(400 - self.ingester._sampler_call.getTime()) < 1)
+        clock.run_pending()
+        self.assertTrue(abs(101 - self.ingester._sampler_call.getTime()) < 1)
+        self.assertEquals(1, len(clock.getDelayedCalls()))
+        
+    def testFetchFeedback(self):
+        """Fetches on a node without the sampler role still back off the sampler, 
+        once the sampler node applies them"""
+        dataset = Dataset(dataset_id=1, enabled=True)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        dataset.data_source.sampling = PeriodicSampling(100)
+        dataset.data_source.sampling.__xmlrpc_class__ = "adaptive_periodic_sampling"
+        self.service.datasets[1] = dataset
+        
+        self.ingester.load_samplers()
+        self.ingester.process_samplers()
+        last_run = float(self.ingester._sampler_states.get(1)["last_run"])
+        
+        node = IngesterEngine(self.service, self.staging, self.data_source_factory, node_id="node1")
+        node.record_fetch(dataset, 0)
+        node.record_fetch(dataset, 0)
+        self.assertEquals(last_run + 100, self.ingester._schedule.next_due())
+        
+        self.ingester._apply_fetch_feedback()
+        self.assertEquals(last_run + 400, self.ingester._schedule.next_due())
+        self.assertEquals([], self.service.fetch_feedback)
+        
+    def testLostLease(self):
+        """Tasks another node has taken over are dropped, not fetched or archived"""
+        self.ingester = IngesterEngine(self.service, self.staging, self.data_source_factory, node_id="node1")
+        data_entries = DataEntryListener()
+        self.service.register_observation_listener(data_entries)
+        dataset = Dataset(dataset_id=1)
+        dataset.data_source = _DataSource()
+        dataset.data_source.__xmlrpc_class__ = "csv1"
+        self.ingester._queue_tasks([(1, 0, dataset, None, os.path.join(self.staging, "1"), LANE_SCHEDULED),
+                                    (2, 1, dataset, None, os.path.join(self.staging, "2"), LANE_SCHEDULED)])
+        self.assertEquals(set([1, 2]), self.ingester._claimed)
+        
+        self.service.lost = set([1, 2])
+        self.ingester.process_claims()
+        self.assertEquals(set(), self.ingester._claimed)
+        self.ingester.process_ingress_queue(True)
+        self.ingester.process_archive_queue(True)
+        self.assertFalse(os.path.exists(os.path.join(self.staging, "1")))
+        self.assertEquals(0, data_entries.count())
+        self.assertEquals(0, self.ingester._ingress_queue.qsize() + self.ingester._archive_queue.qsize())
+        self.assertEquals(set(), self.ingester._lost)
+        
     def testPush(self):
         """This tests the push ingest by creating a test dir, populating it, then forcing the ingester to run
         """
@@ -0,0 +1,124 @@
+"""
+Non-blocking HTTP helpers built on the Twisted web client. These are used by
+data sources that can fetch without tying up a reactor thread.
+"""
+import logging
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, RedirectAgent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from dc24_ingester_platform import IngesterError
+
+logger = logging.getLogger("dc24_ingester_platform.ingester.web_client")
+
+# Maximum number of files a recursive HTTP fetch downloads at once, by either the
+# Twisted web client or the synchronous fetch
+MAX_CONCURRENT_DOWNLOADS = 8
+
+_agent = None
+_pool = None
+
+def get_agent():
+    """Returns the shared HTTP agent. Connections are kept alive and reused
+    between requests to the same host."""
+    global _agent, _pool
+    if _agent == None:
+        from twisted.internet import reactor
+        _pool = HTTPConnectionPool(reactor, persistent=True)
+        _pool.maxPersistentPerHost = MAX_CONCURRENT_DOWNLOADS
+        _agent = RedirectAgent(Agent(reactor, pool=_pool))
+    return _agent
+
+def close_connections():
+    """Close the connections the shared agent is keeping alive.
+
+    :returns: Deferred firing once they are closed
+    """
+    if _pool == None: return defer.succeed(None)
+    return _pool.closeCachedConnections()
+
+class HTTPDownloadError(IngesterError):
+    """An HTTP request returned an error status"""
+    def __init__(self, url, code):
+        IngesterError.__init__(self, "HTTP %s while fetching %s"%(code, url))
+        self.url = url
+        self.code = code
+
+class _BodyWriter(Protocol):
+    """Streams a response body into a file like object as it arrives. The body is
+    discarded if there is no file."""
+    def __init__(self, f_out, finished):
+        self.f_out = f_out
+        self.finished = finished
+
+    def dataReceived(self, data):
+        if self.f_out != None:
+            self.f_out.write(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+def http_get(url, headers=None, open_output=None):
+    """Make a GET request, streaming a successful response body to a file as it arrives.
+
+    :param url: the URL to fetch
+    :param headers: dict of extra request headers
+    :param open_output: called for a 200 response to get the file like object the
+        body is written to. If None the body is discarded.
+    :returns: Deferred firing with (response, output) once the body is written. Any
+        status other than 200, or 304 for a conditional request, errbacks with
+        HTTPDownloadError, as there is no body to use.
+    """
+    req_headers = Headers()
+    if headers != None:
+        for k in headers:
+            req_headers.addRawHeader(k, headers[k])
+    d = get_agent().request("GET", url, req_headers)
+
+    def _response(response):
+        f_out = open_output() if open_output != None and response.code == 200 else None
+        finished = defer.Deferred()
+        # Always consume the body so the connection can go back to the pool
+        response.deliverBody(_BodyWriter(f_out, finished))
+        def _done(ignored):
+            if response.code not in (200, 304):
+                raise HTTPDownloadError(url, response.code)
+            return (response, f_out)
+        def _failed(failure):
+            if f_out != None: f_out.close()
+            return failure
+        return finished.addCallbacks(_done, _failed)
+    return d.addCallback(_response)
+
+def http_download(url, f_out_name, headers=None):
+    """Download a URL straight to a file. The file is only created for a 200 response.
+
+    :returns: Deferred firing with the response
+    """
+    def _done(result):
+        response, f_out = result
+        if f_out != None: f_out.close()
+        return response
+    return http_get(url, headers, lambda: open(f_out_name, "wb")).addCallback(_done)
+
+def http_read(url, headers=None):
+    """Fetch a URL into memory.
+
+    :returns: Deferred firing with (response, body)
+    """
+    def _done(result):
+        response, f_out = result
+        return (response, f_out.getvalue() if f_out != None else "")
+    return http_get(url, headers, StringIO).addCallback(_done)
+
+def get_header(response, name):
+    """Returns the first value of the named response header, or None"""
+    values = response.headers.getRawHeaders(name)
+    return values[0] if values else None
@@ -32,6 +32,7 @@ def data_source_factory(data_source_config, state, parameters):
 class MockService(IIngesterService):
     def __init__(self):
         self.obs_listeners = []
+        self.dataset_listeners = []
         self.data_source_state = {}
         self.sampler_state = {}
         
@@ -52,12 +53,21 @@ class MockService(IIngesterService):
     def unregister_observation_listener(self, listener):
         self.obs_listeners.remove(listener)
         
+    def register_dataset_listener(self, listener):
+        self.dataset_listeners.append(listener)
+        
     def persist_sampler_state(self, ds_id, state):
         self.sampler_state[ds_id] = state
     
     def get_sampler_state(self, ds_id):
         return self.sampler_state[ds_id] if ds_id in self.sampler_state else {}
 
+    def persist_sampler_states(self, states):
+        self.sampler_state.update(states)
+    
+    def get_sampler_states(self):
+        return dict(self.sampler_state)
+
     def persist_data_source_state(self, ds_id, state):
         self.data_source_state[ds_id] = state
 
@@ -74,15 +84,32 @@ class MockService(IIngesterService):
     def persist(self, entry, cwd):
         logger.info("Got entry: "+str(entry))
         
-    def create_ingest_task(self, ds_id, params, cwd):
+    def create_ingest_task(self, ds_id, params, cwd, lane=None):
         self.datasets[0].running = True
         return 0
         
-    def mark_ingress_complete(self, task_id):
+    def mark_ingress_complete(self, task_id, node_id=None):
         self.datasets[0].running = False
+        return True
+
+    def mark_ingest_complete(self, task_id, node_id=None):
+        return True
 
-    def mark_ingest_complete(self, task_id):
+    def persist_many(self, entries, cwd, progress=None):
+        ret = []
+        for entry in entries:
+            ret.append(self.persist(entry, cwd))
+            if progress != None: progress(len(ret))
+        return ret
+
+    def mark_ingest_progress(self, task_id, progress):
         pass
+
+    def get_ingest_progress(self, task_id):
+        return 0
+
+    def take_script_profile_run(self, dataset_id):
+        return False
         
 class MockServer(xmlrpc.XMLRPC):
     def __init__(self, service):
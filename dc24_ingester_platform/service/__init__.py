@@ -2,9 +2,19 @@
 facade, to aggregate all the operations into transactionally safe operations.
 """
 
+# Ingress priority lanes, stored against each ingest task. A task in a lane is
+# always handed out before any task in the lanes after it.
+LANE_MANUAL = 0 # Runs requested by an operator
+LANE_SCHEDULED = 1 # Sampler firings
+LANE_DERIVED = 2 # Dataset data source triggers and backfills
+LANES = (LANE_MANUAL, LANE_SCHEDULED, LANE_DERIVED)
+
 class BaseRepositoryService(object):
     """Interface for data management service
     """
+    # Whether persist_data_entries stores a batch as a single unit, all or nothing
+    atomic_batches = False
+    
     def validate_schema(self, attrs, schema):
         """Validate the attributes against the schema"""
         for k in attrs:
@@ -22,6 +32,20 @@ class BaseRepositoryService(object):
         """
         raise NotImplementedError()
     
+    def persist_data_entries(self, dataset, schema, data_entries, cwd, stored=None):
+        """Persist a batch of data entries into a dataset. Repositories that can
+        should store the batch as a single unit.
+
+        :param stored: repositories that store the entries one at a time call this
+            with each persisted data entry as soon as it is stored
+        :returns: list of the persisted data entries
+        """
+        ret = []
+        for data_entry in data_entries:
+            ret.append(self.persist_data_entry(dataset, schema, data_entry, cwd))
+            if stored != None: stored(ret[-1])
+        return ret
+    
     def get_data_entry(self, dataset_id, data_entry_id):
         raise NotImplementedError()
 
@@ -39,14 +63,50 @@ class IIngesterService(object):
         raise NotImplementedError()
     def get_active_datasets(self, kind=None):
         raise NotImplementedError()
+    def register_dataset_listener(self, listener):
+        raise NotImplementedError()
     def persist_sampler_state(self, dataset_id, state):
         raise NotImplementedError()
     def get_sampler_state(self, dataset_id):
         raise NotImplementedError()
+    def persist_sampler_states(self, states):
+        raise NotImplementedError()
+    def get_sampler_states(self):
+        raise NotImplementedError()
+    def record_fetch_feedback(self, dataset_id, count):
+        raise NotImplementedError()
+    def take_fetch_feedback(self):
+        raise NotImplementedError()
     def persist_data_source_state(self, dataset_id, state):
         raise NotImplementedError()
     def get_data_source_state(self, dataset_id):
         raise NotImplementedError()
+    def get_modified_datasets(self, since):
+        raise NotImplementedError()
+    def persist_many(self, data_entries, cwd, progress=None):
+        raise NotImplementedError()
+    def mark_ingest_progress(self, ingest_task_id, progress):
+        raise NotImplementedError()
+    def get_ingest_progress(self, ingest_task_id):
+        raise NotImplementedError()
+    def claim_ingest_tasks(self, node_id, limit, lease_time):
+        raise NotImplementedError()
+    def renew_leases(self, node_id, task_ids, lease_time):
+        raise NotImplementedError()
+    def acquire_role(self, role, node_id, lease_time):
+        raise NotImplementedError()
+    def release_role(self, role, node_id):
+        raise NotImplementedError()
+    def get_metrics(self):
+        raise NotImplementedError()
+    def request_script_profile(self, dataset_id, runs):
+        raise NotImplementedError()
+    def take_script_profile_run(self, dataset_id):
+        raise NotImplementedError()
+    def persist_script_profile(self, dataset_id, timestamp, stats):
+        raise NotImplementedError()
+    def get_script_profiles(self, dataset_id):
+        raise NotImplementedError()
     def log_ingester_event(self, dataset_id, timestamp, level, message):
         raise NotImplementedError()
     def get_ingester_logs(self, dataset_id):
@@ -3,14 +3,15 @@ Created on Oct 5, 2012
 
 @author: nigel
 """
-from dc24_ingester_platform.service import IIngesterService, find_method, method
+from dc24_ingester_platform.service import IIngesterService, find_method, method, LANE_SCHEDULED
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, DECIMAL, Boolean, ForeignKey, DateTime
 import sqlalchemy.orm as orm
 from sqlalchemy.schema import Table
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, or_
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 import decimal
 import logging
 from dc24_ingester_platform.utils import parse_timestamp, format_timestamp
@@ -39,6 +40,9 @@ Base = declarative_base()
 
 domain_marshaller = Marshaller()
 
+# Maximum number of dataset IDs in a single state query
+STATE_QUERY_BATCH = 500
+
 class Region(Base):
     __tablename__ = "REGION"
     __xmlrpc_class__ = "region"
@@ -86,6 +90,7 @@ class Dataset(Base):
     description = Column(String(255))
     redbox_uri = Column(String(255))
     repository_id = Column(String(255))
+    modified = Column(DateTime) # When it was last persisted, enabled or disabled
     # FIXME: Move to separate schema
     x = Column(DECIMAL)
     y = Column(DECIMAL)
@@ -194,6 +199,39 @@ class IngesterTask(Base):
     state = Column(Integer, nullable=False, default=0)
     cwd = Column(String(255), nullable=False)
     parameters = Column(TEXT)
+    progress = Column(Integer, nullable=False, default=0) # Number of entries archived so far
+    lane = Column(Integer, nullable=False, default=LANE_SCHEDULED) # Ingress priority, lower goes first
+    owner = Column(String(255)) # The ingester node holding the lease on this task
+    lease_expires = Column(DateTime)
+
+class IngesterRole(Base):
+    """A role, such as running the samplers, that only one ingester node may hold at a time"""
+    __tablename__ = "INGESTER_ROLE"
+    name = Column(String(255), primary_key=True)
+    owner = Column(String(255))
+    lease_expires = Column(DateTime)
+
+class FetchFeedback(Base):
+    """The number of entries a fetch produced on a node without the sampler role,
+    waiting to be applied to the dataset's sampler by the sampler node"""
+    __tablename__ = "FETCH_FEEDBACK"
+    id = Column(Integer, primary_key=True)
+    dataset_id = Column(Integer, ForeignKey("DATASETS.id"))
+    count = Column(Integer) # None if not known
+
+class ScriptProfileRequest(Base):
+    """The number of runs of a dataset's processing script still to be profiled"""
+    __tablename__ = "SCRIPT_PROFILE_REQUEST"
+    dataset_id = Column(Integer, ForeignKey("DATASETS.id"), primary_key=True)
+    runs = Column(Integer, nullable=False, default=0)
+
+class ScriptProfile(Base):
+    """The profiler stats of one run of a dataset's processing script"""
+    __tablename__ = "SCRIPT_PROFILE"
+    id = Column(Integer, primary_key=True)
+    dataset_id = Column(Integer, ForeignKey("DATASETS.id"))
+    timestamp = Column(DateTime)
+    stats = Column(TEXT)
     
 def merge_parameters(src, dst, klass, name_attr="name", value_attr="value", ignore_props=[]):
     """This method updates col_orig removing any that aren't in col_new, updating those that are, and adding new ones
@@ -384,6 +422,7 @@ class IngesterServiceDB(IIngesterService):
         # Give the repo a reference to this service.
         self.repo.service = self 
         self.obs_listeners = []
+        self.dataset_listeners = []
 
     def register_observation_listener(self, listener):
         self.obs_listeners.append(listener)
@@ -391,6 +430,18 @@ class IngesterServiceDB(IIngesterService):
     def unregister_observation_listener(self, listener):
         self.obs_listeners.remove(listener)
 
+    def register_dataset_listener(self, listener):
+        """Register a listener to be notified, via notify_dataset_changed, whenever 
+        a dataset is persisted, enabled or disabled."""
+        self.dataset_listeners.append(listener)
+        
+    def unregister_dataset_listener(self, listener):
+        self.dataset_listeners.remove(listener)
+        
+    def _notify_dataset_changed(self, dataset):
+        for listener in self.dataset_listeners:
+            listener.notify_dataset_changed(dataset)
+
     def reset(self):
         Location.metadata.drop_all(self.engine)
         Location.metadata.create_all(self.engine, checkfirst=True)
@@ -446,6 +497,9 @@ class IngesterServiceDB(IIngesterService):
             for obj_id in unit._to_disable:
                 self.disable_dataset(obj_id)
             s.commit()
+            for obj in ret:
+                if obj.__xmlrpc_class__ == "dataset":
+                    self._notify_dataset_changed(obj)
             return ret
         except Exception as e:
             s.rollback()
@@ -462,6 +516,8 @@ class IngesterServiceDB(IIngesterService):
             try:
                 obj = fn(obj, s, cwd)
                 s.commit()
+                if cls == "dataset":
+                    self._notify_dataset_changed(obj)
                 return obj
             finally:
                 s.close()
@@ -496,6 +552,7 @@ class IngesterServiceDB(IIngesterService):
                 raise StaleObjectError("No dataset with id=%d and version=%d to update" % (dataset.id, dataset.version))
         
         ds.version = dataset.version + 1 if dataset.version != None else 1
+        ds.modified = datetime.datetime.utcnow()
             
         copy_attrs(dataset, ds, ["location", "schema", "enabled", "description", "redbox_uri", "sampling_script"])
         if dataset.location_offset != None:
@@ -714,8 +771,10 @@ class IngesterServiceDB(IIngesterService):
         try:
             obj = session.query(Dataset).filter(Dataset.id == ds_id).one()
             obj.enabled = True
+            obj.modified = datetime.datetime.utcnow()
             session.merge(obj)
             session.commit()
+            self._notify_dataset_changed(dao_to_domain(obj))
         finally:
             session.close()
     
@@ -725,14 +784,19 @@ class IngesterServiceDB(IIngesterService):
         try:
             obj = session.query(Dataset).filter(Dataset.id == ds_id).one()
             obj.enabled = False
+            obj.modified = datetime.datetime.utcnow()
             session.merge(obj)
             session.commit()
+            self._notify_dataset_changed(dao_to_domain(obj))
         finally:
             session.close()
             
-    def create_ingest_task(self, ds_id, cwd, parameters=None):
+    def create_ingest_task(self, ds_id, cwd, parameters=None, lane=LANE_SCHEDULED):
         """Mark the dataset as currently undertaing the ingest process. This
-        will also persist the ingest task and return the id for this object."""
+        will also persist the ingest task and return the id for this object.
+        
+        :param lane: the ingress priority lane of the task, lower lanes go first
+        """
         session = orm.sessionmaker(bind=self.engine)()
         try:
             obj = session.query(Dataset).filter(Dataset.id == ds_id).one()
@@ -744,6 +808,7 @@ class IngesterServiceDB(IIngesterService):
             task.parameters = json.dumps(parameters)
             task.cwd = cwd
             task.state = 0
+            task.lane = lane
             task.timestamp = datetime.datetime.utcnow()
             session.add(task)
             
@@ -753,55 +818,189 @@ class IngesterServiceDB(IIngesterService):
         finally:
             session.close()
     
-    def mark_ingress_complete(self, ingest_task_id):
+    def _update_owned_task(self, session, ingest_task_id, node_id, values):
+        """Update the task if the node still holds its lease, or unconditionally if
+        node_id is None.
+        
+        :returns: True if the task was updated
+        """
+        tasks = session.query(IngesterTask).filter(IngesterTask.id == ingest_task_id)
+        if node_id != None:
+            tasks = tasks.filter(IngesterTask.owner == node_id)
+        return tasks.update(values, synchronize_session=False) == 1
+    
+    def mark_ingress_complete(self, ingest_task_id, node_id=None):
         """Once the ingress is complete the dataset is able to ingress new data
-        without conflict"""
+        without conflict
+        
+        :param node_id: cluster mode: the node completing the task. Nothing is
+            changed if it no longer holds the task's lease.
+        :returns: True if the task was marked
+        """
         session = orm.sessionmaker(bind=self.engine)()
         try:
-            task = session.query(IngesterTask).filter(IngesterTask.id == ingest_task_id).one()
-            task.state = 1
-            session.merge(task)
+            if not self._update_owned_task(session, ingest_task_id, node_id, {IngesterTask.state:1}):
+                return False
             
+            task = session.query(IngesterTask).filter(IngesterTask.id == ingest_task_id).one()
             obj = session.query(Dataset).filter(Dataset.id == task.dataset_id).one()
             obj.running = False
             session.merge(obj)
             
             session.commit()
+            return True
         finally:
             session.close()
         
-    def mark_ingest_complete(self, ingest_task_id):
-        """Once the ingest is complete the ingest process is complete"""
+    def mark_ingest_complete(self, ingest_task_id, node_id=None):
+        """Once the ingest is complete the ingest process is complete
+        
+        :param node_id: cluster mode: the node completing the task. Nothing is
+            changed if it no longer holds the task's lease.
+        :returns: True if the task was marked
+        """
         session = orm.sessionmaker(bind=self.engine)()
         try:
-            task = session.query(IngesterTask).filter(IngesterTask.id == ingest_task_id).one()
-            task.state = 2
-            session.merge(task)
-            
+            if not self._update_owned_task(session, ingest_task_id, node_id, {IngesterTask.state:2}):
+                return False
             session.commit()
+            return True
         finally:
             session.close()
     
-    def mark_ingest_failed(self, ingest_task_id):
-        """If the ingest fails then mark it as such"""
+    def mark_ingest_progress(self, ingest_task_id, progress):
+        """Record how many of the task's data entries have been archived, so that an
+        interrupted archive can resume from there"""
         session = orm.sessionmaker(bind=self.engine)()
         try:
-            task = session.query(IngesterTask).filter(IngesterTask.id == ingest_task_id).one()
-            task.state = 3
-            session.merge(task)
+            session.query(IngesterTask).filter(IngesterTask.id == ingest_task_id) \
+                .update({IngesterTask.progress:progress}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
             
+    def get_ingest_progress(self, ingest_task_id):
+        """Returns the number of the task's data entries that have already been archived"""
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            progress = session.query(IngesterTask.progress).filter(IngesterTask.id == ingest_task_id).scalar()
+            return progress if progress != None else 0
+        finally:
+            session.close()
+    
+    def mark_ingest_failed(self, ingest_task_id, node_id=None):
+        """If the ingest fails then mark it as such
+        
+        :param node_id: cluster mode: the node the task failed on. Nothing is
+            changed if it no longer holds the task's lease.
+        """
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            self._update_owned_task(session, ingest_task_id, node_id, {IngesterTask.state:3})
             session.commit()
         finally:
             session.close()
 
     def get_ingest_queue(self):
         """Get all the items queued for ingest.
-        :returns: List of tuples (task_id, state, dataset object, parameter dict, cwd)
+        :returns: List of tuples (task_id, state, dataset object, parameter dict, cwd, lane)
         """
         session = orm.sessionmaker(bind=self.engine)()
         try:
             ret = session.query(IngesterTask).filter(IngesterTask.state.in_( (0,1) )).all()
-            return [(obj.id, obj.state, dao_to_domain(obj.dataset), json.loads(obj.parameters), obj.cwd) for obj in ret]
+            return [self._task_tuple(obj) for obj in ret]
+        finally:
+            session.close()
+            
+    def _task_tuple(self, obj):
+        return (obj.id, obj.state, dao_to_domain(obj.dataset), json.loads(obj.parameters), obj.cwd, obj.lane)
+
+    def claim_ingest_tasks(self, node_id, limit, lease_time):
+        """Claim up to limit unfinished ingest tasks for this node by taking a lease on
+        them. Tasks can be claimed if they are unowned or their lease has expired. Each
+        claim is a conditional update, so when nodes race for a task only one gets it.
+        
+        :param node_id: unique name of the claiming ingester node
+        :param limit: maximum number of tasks to claim
+        :param lease_time: seconds until the lease expires, unless it is renewed
+        :returns: List of tuples (task_id, state, dataset object, parameter dict, cwd, lane)
+        """
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            now = datetime.datetime.utcnow()
+            expires = now + datetime.timedelta(seconds=lease_time)
+            claimable = (IngesterTask.state.in_( (0,1) ), 
+                         or_(IngesterTask.owner == None, IngesterTask.lease_expires < now))
+            candidates = session.query(IngesterTask.id).filter(*claimable) \
+                    .order_by(IngesterTask.lane, IngesterTask.id).limit(limit).all()
+            claimed = []
+            for (task_id,) in candidates:
+                count = session.query(IngesterTask).filter(IngesterTask.id == task_id, *claimable) \
+                    .update({IngesterTask.owner:node_id, IngesterTask.lease_expires:expires}, synchronize_session=False)
+                if count == 1:
+                    claimed.append(task_id)
+            session.commit()
+            if len(claimed) == 0: return []
+            
+            ret = session.query(IngesterTask).filter(IngesterTask.id.in_(claimed)) \
+                    .order_by(IngesterTask.lane, IngesterTask.id).all()
+            return [self._task_tuple(obj) for obj in ret]
+        finally:
+            session.close()
+            
+    def renew_leases(self, node_id, task_ids, lease_time):
+        """Extend the lease this node holds on the given tasks. Tasks that another
+        node has taken over are left alone.
+        
+        :returns: list of the IDs of the tasks this node still holds
+        """
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_time)
+            task_ids = list(task_ids)
+            held = []
+            for i in range(0, len(task_ids), STATE_QUERY_BATCH):
+                owned = (IngesterTask.owner == node_id, IngesterTask.id.in_(task_ids[i:i+STATE_QUERY_BATCH]))
+                session.query(IngesterTask).filter(*owned) \
+                    .update({IngesterTask.lease_expires:expires}, synchronize_session=False)
+                held += [task_id for (task_id,) in session.query(IngesterTask.id).filter(*owned)]
+            session.commit()
+            return held
+        finally:
+            session.close()
+
+    def acquire_role(self, role, node_id, lease_time):
+        """Take or renew the lease on a role that only one node may hold at a time.
+        
+        :returns: True if this node now holds the role
+        """
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            now = datetime.datetime.utcnow()
+            expires = now + datetime.timedelta(seconds=lease_time)
+            if session.query(IngesterRole).filter(IngesterRole.name == role).count() == 0:
+                try:
+                    session.add(IngesterRole(name=role, owner=node_id, lease_expires=expires))
+                    session.commit()
+                    return True
+                except IntegrityError:
+                    # Another node created it first
+                    session.rollback()
+            count = session.query(IngesterRole).filter(IngesterRole.name == role, 
+                    or_(IngesterRole.owner == node_id, IngesterRole.owner == None, IngesterRole.lease_expires < now)) \
+                .update({IngesterRole.owner:node_id, IngesterRole.lease_expires:expires}, synchronize_session=False)
+            session.commit()
+            return count == 1
+        finally:
+            session.close()
+            
+    def release_role(self, role, node_id):
+        """Give up a role, if this node holds it"""
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            session.query(IngesterRole).filter(IngesterRole.name == role, IngesterRole.owner == node_id) \
+                .update({IngesterRole.owner:None, IngesterRole.lease_expires:None}, synchronize_session=False)
+            session.commit()
         finally:
             session.close()
 
@@ -826,6 +1025,16 @@ class IngesterServiceDB(IIngesterService):
         finally:
             s.close()
     
+    def get_modified_datasets(self, since):
+        """Returns all the datasets, enabled or not, that were persisted, enabled or
+        disabled after since (UTC)."""
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            objs = s.query(Dataset).filter(Dataset.modified > since).all()
+            return [dao_to_domain(obj) for obj in objs]
+        finally:
+            s.close()
+    
     def get_schema(self, s_id):
         """Get the schema as a DTO"""
         session = orm.sessionmaker(bind=self.engine)()
@@ -885,6 +1094,55 @@ class IngesterServiceDB(IIngesterService):
         finally:
             s.close()
     
+    def request_script_profile(self, dataset_id, runs):
+        """Profile the next runs of the dataset's processing script, replacing any
+        outstanding request. 0 cancels the request.
+        """
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            s.merge(ScriptProfileRequest(dataset_id=dataset_id, runs=runs))
+            s.commit()
+        finally:
+            s.close()
+            
+    def take_script_profile_run(self, dataset_id):
+        """Use up one of the requested profile runs of the dataset's processing script.
+        
+        :returns: True if this run should be profiled
+        """
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            pending = s.query(ScriptProfileRequest).filter(ScriptProfileRequest.dataset_id == dataset_id,
+                    ScriptProfileRequest.runs > 0)
+            # Almost every run is not profiled, so only write when a request is pending
+            if pending.first() == None:
+                return False
+            count = pending.update({ScriptProfileRequest.runs:ScriptProfileRequest.runs - 1}, synchronize_session=False)
+            s.commit()
+            return count == 1
+        finally:
+            s.close()
+            
+    def persist_script_profile(self, dataset_id, timestamp, stats):
+        """Store the profiler stats of a run of the dataset's processing script"""
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            s.add(ScriptProfile(dataset_id=dataset_id, timestamp=timestamp, stats=stats))
+            s.commit()
+        finally:
+            s.close()
+            
+    def get_script_profiles(self, dataset_id):
+        """Returns the stored profiles of the dataset's processing script, oldest first, 
+        as dicts of timestamp and stats text"""
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            objs = s.query(ScriptProfile).filter(ScriptProfile.dataset_id == dataset_id) \
+                .order_by(ScriptProfile.id).all()
+            return [{"timestamp":format_timestamp(obj.timestamp), "stats":obj.stats} for obj in objs]
+        finally:
+            s.close()
+    
     def get_ingester_logs(self, dataset_id):
         """Returns a list of all events that have occurred on a given dataset"""
         s = orm.sessionmaker(bind=self.engine)()
@@ -897,35 +1155,74 @@ class IngesterServiceDB(IIngesterService):
         finally:
             s.close()
             
+    def _merge_state(self, session, klass, ds_id, state, objs):
+        """Update the name/value state rows in objs to match state, only touching
+        the rows that have changed.
+        """
+        state = state.copy()
+        for obj in objs:
+            if obj.name in state:
+                # Update
+                if obj.value != state[obj.name]:
+                    obj.value = state[obj.name]
+                del state[obj.name]
+            else:
+                # Delete
+                session.delete(obj)
+        # Add
+        for k in state:
+            obj = klass()
+            obj.dataset_id = ds_id
+            obj.name = k
+            obj.value = state[k]
+            session.add(obj)
+
     def persist_sampler_state(self, ds_id, state):
-        session = orm.sessionmaker(bind=self.engine)()
+        self.persist_sampler_states({ds_id:state})
+    
+    def record_fetch_feedback(self, dataset_id, count):
+        """Record the number of entries a fetch produced, for the sampler node"""
+        s = orm.sessionmaker(bind=self.engine)()
         try:
-            objs = session.query(SamplerState).filter(SamplerState.dataset_id == ds_id).all()
+            s.add(FetchFeedback(dataset_id=dataset_id, count=count))
+            s.commit()
+        finally:
+            s.close()
             
-            state = state.copy()
-            to_del = []
+    def take_fetch_feedback(self):
+        """Remove and return the oldest recorded fetch counts.
+        
+        :returns: list of (dataset ID, count), in the order they were recorded
+        """
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            objs = s.query(FetchFeedback).order_by(FetchFeedback.id).limit(STATE_QUERY_BATCH).all()
+            if len(objs) == 0: return []
+            ret = [(obj.dataset_id, obj.count) for obj in objs]
+            s.query(FetchFeedback).filter(FetchFeedback.id.in_([obj.id for obj in objs])) \
+                .delete(synchronize_session=False)
+            s.commit()
+            return ret
+        finally:
+            s.close()
             
-            for obj in objs:
-                prop_name = getattr(obj, "name")
-                if prop_name in state:
-                    # Update
-                    setattr(obj, "value", state[prop_name])
-                    del state[prop_name]
-                else:
-                    # Delete pending
-                    to_del.append(obj)
-            # Delete
-            for obj in to_del:
-                session.delete(obj)
-            # Add
-            for k in state:
-                obj = SamplerState()
-                obj.dataset_id = ds_id
-                setattr(obj, "name", k)
-                setattr(obj, "value", state[k])
-                session.add(obj)
+    def persist_sampler_states(self, states):
+        """Persist the sampler state of many datasets in a single transaction.
+        
+        :param states: dict of dataset ID to state dict
+        """
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            ds_ids = states.keys()
+            existing = {}
+            # Keep the IN clause under the SQLite variable limit
+            for i in range(0, len(ds_ids), STATE_QUERY_BATCH):
+                objs = session.query(SamplerState).filter(SamplerState.dataset_id.in_(ds_ids[i:i+STATE_QUERY_BATCH])).all()
+                for obj in objs:
+                    existing.setdefault(obj.dataset_id, []).append(obj)
+            for ds_id in ds_ids:
+                self._merge_state(session, SamplerState, ds_id, states[ds_id], existing.get(ds_id, []))
             session.commit()
-            session.flush()
         finally:
             session.close()
     
@@ -937,36 +1234,27 @@ class IngesterServiceDB(IIngesterService):
             return parameters_to_dict(objs)
         finally:
             session.close()
+            
+    def get_sampler_states(self):
+        """Gets the sampler state of every dataset in one query.
+        
+        :returns: dict of dataset ID to state dict. All values will be string.
+        """
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            ret = {}
+            for obj in session.query(SamplerState).all():
+                ret.setdefault(obj.dataset_id, {})[obj.name] = obj.value
+            return ret
+        finally:
+            session.close()
 
     def persist_data_source_state(self, ds_id, state):
         session = orm.sessionmaker(bind=self.engine)()
         try:
             objs = session.query(DataSourceState).filter(DataSourceState.dataset_id == ds_id).all()
-            
-            state = state.copy()
-            to_del = []
-            
-            for obj in objs:
-                prop_name = getattr(obj, "name")
-                if prop_name in state:
-                    # Update
-                    setattr(obj, "value", state[prop_name])
-                    del state[prop_name]
-                else:
-                    # Delete pending
-                    to_del.append(obj)
-            # Delete
-            for obj in to_del:
-                session.delete(obj)
-            # Add
-            for k in state:
-                obj = DataSourceState()
-                obj.dataset_id = ds_id
-                setattr(obj, "name", k)
-                setattr(obj, "value", state[k])
-                session.add(obj)
+            self._merge_state(session, DataSourceState, ds_id, state, objs)
             session.commit()
-            session.flush()
         finally:
             session.close()
 
@@ -1008,11 +1296,11 @@ class IngesterServiceDB(IIngesterService):
         finally:
             session.close()
 
-    def find_data_entries(self, dataset_id):
+    def find_data_entries(self, dataset_id, offset=0, limit=None):
         """Find the data entries for this dataset. Lookup the dataset domain
         object and pass it to the repo layer.
         """
-        return self.repo.find_data_entries(self.get_dataset(dataset_id))
+        return self.repo.find_data_entries(self.get_dataset(dataset_id), offset, limit)
 
     def get_data_entry(self, dataset_id, data_entry_id):
         return self.repo.get_data_entry(dataset_id, data_entry_id)
@@ -1042,6 +1330,52 @@ class IngesterServiceDB(IIngesterService):
             listener.notify_new_data_entry(obs, cwd)
         return obs
 
+    def persist_many(self, data_entries, cwd, progress=None):
+        """Persist a batch of data entries. The dataset and schema are looked up once
+        for each run of entries from the same dataset, and each run is handed to the
+        repository in one call. A repository with atomic_batches stores each run as a
+        single unit, and listeners are notified once it is stored. Other repositories
+        store the entries one at a time, and listeners are notified of each, and
+        progress called, as soon as it is stored.
+        
+        :param data_entries: list of data entries
+        :param cwd: Working directory for this ingest
+        :param progress: called with the number of entries of the batch stored so far,
+            after each entry stored on its own
+        :returns: list of the persisted data entries, in order
+        """
+        for data_entry in data_entries:
+            if data_entry.__xmlrpc_class__ != "data_entry":
+                raise ValueError("%s not supported" % (data_entry.__xmlrpc_class__))
+            if data_entry.timestamp == None: 
+                raise ValueError("timestamp is not set")
+        
+        ret = []
+        def stored(obs):
+            ret.append(obs)
+            for listener in self.obs_listeners:
+                listener.notify_new_data_entry(obs, cwd)
+            if progress != None: progress(len(ret))
+        
+        start = 0
+        while start < len(data_entries):
+            dataset_id = data_entries[start].dataset
+            end = start + 1
+            while end < len(data_entries) and data_entries[end].dataset == dataset_id:
+                end += 1
+            dataset = self.get_dataset(dataset_id)
+            schema = ConcreteSchema(self.get_schema_tree(dataset.schema))
+            if self.repo.atomic_batches:
+                objs = self.repo.persist_data_entries(dataset, schema, data_entries[start:end], cwd)
+                ret += objs
+                for obs in objs:
+                    for listener in self.obs_listeners:
+                        listener.notify_new_data_entry(obs, cwd)
+            else:
+                self.repo.persist_data_entries(dataset, schema, data_entries[start:end], cwd, stored)
+            start = end
+        return ret
+
     def invoke_ingester(self, dataset_id):
         """Run the ingester for the given dataset ID. 
         If this is a scheduled dataset then this will be as if the sampler had
@@ -1049,6 +1383,10 @@ class IngesterServiceDB(IIngesterService):
         the data entries in the source dataset."""
         self.ingester.invoke_ingester(self.get_dataset(dataset_id))
 
+    def get_metrics(self):
+        """Returns a snapshot of the ingester pipeline metrics"""
+        return self.ingester.metrics.snapshot()
+
     @method("persist", "dataset_metadata_entry")
     def persist_dataset_metadata(self, dataset_metadata, session, cwd):
         dataset_id = dataset_metadata.object_id
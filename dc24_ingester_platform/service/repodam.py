@@ -166,17 +166,21 @@ class RepositoryDAM(BaseRepositoryService):
             logger.exception("Exception while persisting dataset")
             raise PersistenceError("Error persisting dataset: %s"%(str(e)))
     
-    def _persist_attributes(self, obs, attributes, cwd):
-        with self.connection() as repo:
-            for attr_name in attributes: 
-                attr = {"name":attr_name} # DAM Attribute
-                if isinstance(attributes[attr_name], FileObject):
-                    attr["originalFileName"] = attributes[attr_name].file_name
-                    with open(os.path.join(cwd, attributes[attr_name].f_path), "rb") as f:
-                        repo.ingest_attribute(obs["id"], attr, f)
-                else:
-                    attr["value"] = attributes[attr_name]
-                    repo.ingest_attribute(obs["id"], attr)
+    def _persist_attributes(self, obs, attributes, cwd, repo=None):
+        """Persist the attributes of a DAM object. If repo is provided that
+        connection is used, otherwise a new one is opened."""
+        if repo == None:
+            with self.connection() as repo:
+                return self._persist_attributes(obs, attributes, cwd, repo)
+        for attr_name in attributes: 
+            attr = {"name":attr_name} # DAM Attribute
+            if isinstance(attributes[attr_name], FileObject):
+                attr["originalFileName"] = attributes[attr_name].file_name
+                with open(os.path.join(cwd, attributes[attr_name].f_path), "rb") as f:
+                    repo.ingest_attribute(obs["id"], attr, f)
+            else:
+                attr["value"] = attributes[attr_name]
+                repo.ingest_attribute(obs["id"], attr)
     
     def persist_data_entry(self, dataset, schema, data_entry, cwd):
         # Check the attributes are actually in the schema
@@ -203,6 +207,44 @@ class RepositoryDAM(BaseRepositoryService):
             logger.exception("Exception while persisting data entry")
             raise PersistenceError("Error persisting data entry: %s"%(str(e)))
         
+    def persist_data_entries(self, dataset, schema, data_entries, cwd, stored=None):
+        """Persist a batch of data entries over a single DAM connection. The DAM has
+        no transactions, so the batch is not atomic, and stored is called with each
+        entry once it is in the DAM. Rather than fetching each entry back, the
+        returned data entries are built from the entries given.
+        """
+        for data_entry in data_entries:
+            self.validate_schema(data_entry.data, schema.attrs)
+        
+        ret = []
+        try:
+            with self.connection() as repo:
+                for data_entry in data_entries:
+                    dam_obs = {"dam_type":"Observation",
+                        "dataset":dataset.repository_id,
+                        "time":dam.format_time(data_entry.timestamp)}
+                    
+                    dam_obs = repo.ingest(dam_obs, lock=True)
+                    self._persist_attributes(dam_obs, data_entry.data, cwd, repo)
+                    repo.unlock(dam_obs["id"])
+                    self.mark_for_reset(dam_obs["id"])
+                    
+                    entry = DataEntry()
+                    entry.id = dam_obs["id"]
+                    entry.dataset = dataset.id
+                    entry.timestamp = data_entry.timestamp
+                    for k in data_entry.data:
+                        entry[k] = data_entry[k]
+                    ret.append(entry)
+                    if stored != None: stored(entry)
+            return ret
+        except dam.DuplicateEntityException as e:
+            logger.exception("Exception while persisting data entries")
+            raise PersistenceError("Error persisting data entries: DuplicateEntityException %s"%(str(e)))
+        except dam.DAMException as e:
+            logger.exception("Exception while persisting data entries")
+            raise PersistenceError("Error persisting data entries: %s"%(str(e)))
+        
     def get_data_entry(self, dataset_id, data_entry_id):
         try:
             with self.connection() as repo:
@@ -5,15 +5,22 @@ Created on Oct 5, 2012
 """
 from dc24_ingester_platform.utils import format_timestamp, parse_timestamp
 from dc24_ingester_platform.service import BaseRepositoryService
+from dc24_ingester_platform.transfer import link_file, COPY_BUFFER_SIZE
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, DECIMAL, Boolean, ForeignKey, DateTime
 import sqlalchemy.orm as orm
 from sqlalchemy import create_engine
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 import decimal
 import logging
 import os
+import errno
 import shutil
+import tempfile
+import hashlib
+import gzip
+from optparse import OptionParser
 from jcudc24ingesterapi.schemas.data_types import FileDataType
 from jcudc24ingesterapi.models.data_entry import DataEntry, FileObject
 from jcudc24ingesterapi.models.metadata import DatasetMetadataEntry, DataEntryMetadataEntry
@@ -84,6 +91,79 @@ class DataEntryMetadataAttr(Base):
     metadata_entry = Column(Integer, ForeignKey('DATA_ENTRY_METADATA.id'))
     name = Column(String(255))
     value = Column(String(255))
+
+class FileBlob(Base):
+    """A file in the content addressed store, and the number of attributes referencing it"""
+    __tablename__ = "FILE_BLOBS"
+    hash = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    refs = Column(Integer, nullable=False, default=0)
+
+# Compression codecs by name, as the suffix of the stored file and a function to open it
+CODECS = {"gzip":(".gz", gzip.GzipFile)}
+# The size of the start of a file that is compressed to see whether the file is worth compressing
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+# Files are only stored compressed if it makes them at least this much smaller
+MIN_COMPRESSION_RATIO = 0.9
+
+# The attribute tables that may hold files, with the directory the flat layout kept their files in
+LEGACY_FILE_ATTRS = [("data_entry", ObservationAttr), ("dataset_metadata", DatasetMetadataAttr),
+                     ("data_entry_metadata", DataEntryMetadataAttr)]
+# The number of files moved in each transaction when migrating from the flat layout
+MIGRATION_BATCH_SIZE = 1000
+
+def open_stored_file(path):
+    """Open a stored file for reading, decompressing it if it was stored compressed"""
+    for suffix, open_codec in CODECS.values():
+        if path.endswith(suffix):
+            return open_codec(path, "rb")
+    return open(path, "rb")
+
+def compress_file(src, dst, codec):
+    """Write a compressed copy of src to dst, if compressing is worth it.
+    Otherwise dst is removed.
+    
+    :returns: True if dst was written
+    """
+    open_codec = CODECS[codec][1]
+    size = os.path.getsize(src)
+    if size == 0:
+        if os.path.exists(dst): os.remove(dst)
+        return False
+    with open(src, "rb") as f_in:
+        # Try a sample first, so that files that don't compress aren't read twice
+        sample = f_in.read(COMPRESSION_SAMPLE_SIZE)
+        f_out = open_codec(dst, "wb")
+        try:
+            f_out.write(sample)
+            if len(sample) == size:
+                f_out.close()
+            else:
+                f_out.flush()
+                if f_out.fileobj.tell() > len(sample) * MIN_COMPRESSION_RATIO:
+                    f_out.close()
+                    os.remove(dst)
+                    return False
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+                f_out.close()
+        except:
+            f_out.close()
+            os.remove(dst)
+            raise
+    if os.path.getsize(dst) > size * MIN_COMPRESSION_RATIO:
+        os.remove(dst)
+        return False
+    return True
+
+def hash_file(path):
+    """Returns the hex SHA-256 digest of the file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(COPY_BUFFER_SIZE)
+            if len(data) == 0: break
+            digest.update(data)
+    return digest.hexdigest()
     
 def merge_parameters(col_orig, col_new, klass, name_attr="name", value_attr="value"):
     """This method updates col_orig removing any that aren't in col_new, updating those that are, and adding new ones
@@ -119,9 +199,15 @@ class RepositoryDB(BaseRepositoryService):
     
     All objects/DTOs passed in and out of this service are dicts. This service protects the storage layer.
     """
+    atomic_batches = True
+    
     def __init__(self, config):
         self.engine = create_engine(config["db"])
         self.repo = config["files"]
+        # The codec new files are compressed with, if any
+        self.compression = config.get("compression")
+        if self.compression != None and self.compression not in CODECS:
+            raise ValueError("Unknown compression codec: %s"%self.compression)
         
         if not os.path.exists(self.repo):
             os.makedirs(self.repo)
@@ -132,16 +218,77 @@ class RepositoryDB(BaseRepositoryService):
         Observation.metadata.drop_all(self.engine, checkfirst=True)
         Observation.metadata.create_all(self.engine, checkfirst=True)
     
-    def copy_files(self, attrs, schema, cwd, obj, obj_type):
-        """Copy file attributes into place and update the File Objects
-        to point to the destination path."""
-        obj_path = os.path.join(self.repo, obj_type)
-        if not os.path.exists(obj_path): os.makedirs(obj_path)
+    def place_files(self, attrs, schema, cwd):
+        """Store the files of the file attributes and update the File Objects to point
+        to the stored path. This is done before the transaction that references the
+        files is started, so the hashing and copying don't hold the database's write lock.
+        
+        :returns: list of the hashes of the stored files, to pass to reference_files
+        """
+        digests = []
         for k in attrs:
             if isinstance(schema[k], FileDataType):
-                dest_file_name = os.path.join(obj_path, "%d-%s"%(obj.id, k))
-                shutil.copyfile(os.path.join(cwd, attrs[k].f_path), dest_file_name)
-                attrs[k].f_path = dest_file_name
+                digest, attrs[k].f_path = self.store_file(os.path.join(cwd, attrs[k].f_path))
+                digests.append(digest)
+        return digests
+    
+    def reference_files(self, session, digests):
+        """Take a reference to each of the stored files in the session's transaction"""
+        for digest in digests:
+            session.query(FileBlob).filter(FileBlob.hash == digest) \
+                .update({FileBlob.refs:FileBlob.refs + 1}, synchronize_session=False)
+    
+    def store_file(self, src):
+        """Add a file to the content addressed store, unless it is already stored.
+        It is compressed if the repository has a codec and the file compresses well,
+        or else hard linked into place where possible. The file is written to a
+        temporary file and renamed into place, so a worker storing the same file at
+        the same time can't leave a partly written file under the hash's name.
+        
+        The file gets a FILE_BLOBS row with no references if it doesn't have one,
+        in its own transaction. References are taken with reference_files.
+        
+        :returns: the hash and the path of the stored file
+        """
+        digest = hash_file(src)
+        path = os.path.join(self.repo, "blobs", digest[0:2], digest[2:4], digest)
+        # The file may already be stored, compressed or not, even without a reference
+        # if it is left from a transaction that rolled back
+        stored = [p for p in [path] + [path + suffix for suffix, c in CODECS.values()] if os.path.exists(p)]
+        if len(stored) > 0:
+            path = stored[0]
+        else:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+            fd, tmp = tempfile.mkstemp(prefix=digest, suffix=".tmp", dir=os.path.dirname(path))
+            os.close(fd)
+            try:
+                if self.compression != None and compress_file(src, tmp, self.compression):
+                    path = path + CODECS[self.compression][0]
+                else:
+                    link_file(src, tmp)
+                os.rename(tmp, path)
+            except:
+                if os.path.exists(tmp): os.remove(tmp)
+                raise
+        self._register_blob(digest, os.path.getsize(src))
+        return digest, path
+    
+    def _register_blob(self, digest, size):
+        """Make sure there is a FILE_BLOBS row for the hash"""
+        s = orm.sessionmaker(bind=self.engine)()
+        try:
+            if s.query(FileBlob).filter(FileBlob.hash == digest).count() > 0: return
+            s.add(FileBlob(hash=digest, size=size, refs=0))
+            try:
+                s.commit()
+            except IntegrityError:
+                # Another worker stored the same file first, its row will do
+                s.rollback()
+        finally:
+            s.close()
     
     def find_data_entries(self, dataset, offset, limit, start_time=None, end_time=None):
         """Find all observations within this dataset that match the given criteria"""
@@ -221,6 +368,8 @@ class RepositoryDB(BaseRepositoryService):
     def persist_data_entry(self, dataset, schema, data_entry, cwd):
         # Check the attributes are actually in the schema
         self.validate_schema(data_entry.data, schema.attrs)
+        # Copy all files into place
+        digests = self.place_files(data_entry.data, schema.attrs, cwd)
         
         session = orm.sessionmaker(bind=self.engine)()
         try:
@@ -231,8 +380,7 @@ class RepositoryDB(BaseRepositoryService):
             session.add(obs)
             session.flush()
             
-            # Copy all files into place
-            self.copy_files(data_entry.data, schema.attrs, cwd, obs, "data_entry")
+            self.reference_files(session, digests)
             
             merge_parameters(obs.attrs, data_entry.data, ObservationAttr)
             session.merge(obs)
@@ -243,6 +391,38 @@ class RepositoryDB(BaseRepositoryService):
         finally:
             session.close()
             
+    def persist_data_entries(self, dataset, schema, data_entries, cwd, stored=None):
+        """Persist a batch of data entries in a single transaction. As the batch is
+        stored as a single unit stored is never called."""
+        for data_entry in data_entries:
+            self.validate_schema(data_entry.data, schema.attrs)
+        digests = []
+        for data_entry in data_entries:
+            digests += self.place_files(data_entry.data, schema.attrs, cwd)
+        
+        session = orm.sessionmaker(bind=self.engine)()
+        try:
+            objs = []
+            for data_entry in data_entries:
+                obs = Observation()
+                obs.timestamp = data_entry.timestamp
+                obs.dataset = dataset.id
+                session.add(obs)
+                objs.append(obs)
+            # Get all the IDs in one go
+            session.flush()
+            
+            self.reference_files(session, digests)
+            for obs, data_entry in zip(objs, data_entries):
+                merge_parameters(obs.attrs, data_entry.data, ObservationAttr)
+            session.flush()
+            
+            ret = [self._create_data_entry(obs, schema) for obs in objs]
+            session.commit()
+            return ret
+        finally:
+            session.close()
+            
     def get_data_entry(self, dataset_id, data_entry_id):
         
         session = orm.sessionmaker(bind=self.engine)()
@@ -254,10 +434,10 @@ class RepositoryDB(BaseRepositoryService):
             session.close()
             
     def get_data_entry_stream(self, dataset_id, data_entry_id, attr):
-        """Get a file stream for the data entry"""
+        """Get a file stream for the data entry, decompressing it if it was stored compressed"""
         data_entry = self.get_data_entry(dataset_id, data_entry_id)
         if data_entry == None: return None
-        return open(data_entry[attr].f_path, "rb")
+        return open_stored_file(data_entry[attr].f_path)
     
     def _get_data_entry(self, dataset_id, data_entry_id, session):
         obs = session.query(Observation).filter(Observation.dataset == dataset_id,
@@ -285,6 +465,8 @@ class RepositoryDB(BaseRepositoryService):
     def persist_dataset_metadata(self, dataset, schema, attrs, cwd):
         # Check the attributes are actually in the schema
         self.validate_schema(attrs, schema.attrs)
+        # Copy all files into place
+        digests = self.place_files(attrs, schema.attrs, cwd)
         
         s = orm.sessionmaker(bind=self.engine)()
         try:
@@ -295,8 +477,7 @@ class RepositoryDB(BaseRepositoryService):
             s.add(md)
             s.flush()
             
-            # Copy all files into place
-            self.copy_files(attrs, schema.attrs, cwd, md, "dataset_metadata")
+            self.reference_files(s, digests)
             
             merge_parameters(md.attrs, attrs, DatasetMetadataAttr)
             s.merge(md)
@@ -316,6 +497,8 @@ class RepositoryDB(BaseRepositoryService):
     def persist_data_entry_metadata(self, data_entry, schema, attrs, cwd):
         # Check the attributes are actually in the schema
         self.validate_schema(attrs, schema.attrs)
+        # Copy all files into place
+        digests = self.place_files(attrs, schema.attrs, cwd)
         s = orm.sessionmaker(bind=self.engine)()
         try:
             md = DataEntryMetadata()
@@ -325,8 +508,7 @@ class RepositoryDB(BaseRepositoryService):
             s.add(md)
             s.flush()
             
-            # Copy all files into place
-            self.copy_files(attrs, schema.attrs, cwd, md, "data_entry_metadata")
+            self.reference_files(s, digests)
             
             merge_parameters(md.attrs, attrs, DataEntryMetadataAttr)
             s.merge(md)
@@ -343,3 +525,70 @@ class RepositoryDB(BaseRepositoryService):
                     
         finally:
             s.close()
+
+    def migrate_files(self, batch_size=MIGRATION_BATCH_SIZE):
+        """Move files stored in the old flat <obj_type>/<id>-<attr> layout into the
+        sharded content addressed store, rewriting the attribute paths. Each batch
+        is its own transaction, and the old files are only removed once it has
+        committed, so the repository can stay in use while this runs.
+        
+        :returns: the number of files migrated
+        """
+        migrated = 0
+        for obj_type, klass in LEGACY_FILE_ATTRS:
+            # The stored paths may spell the repository directory differently to
+            # the configuration (relative, doubled separators, symlinks), so only
+            # narrow the query down by the layout and compare the resolved paths
+            prefix = os.path.join(os.path.realpath(self.repo), obj_type) + os.sep
+            last_id = 0
+            while True:
+                s = orm.sessionmaker(bind=self.engine)()
+                try:
+                    attrs = [(attr.id, attr.value) for attr in s.query(klass) \
+                        .filter(klass.id > last_id, klass.value.like("%" + obj_type + os.sep + "%")) \
+                        .order_by(klass.id).limit(batch_size)]
+                finally:
+                    s.close()
+                if len(attrs) == 0: break
+                last_id = attrs[-1][0]
+                # Store the files before the transaction, so it doesn't hold the write lock while copying
+                stored = []
+                for attr_id, value in attrs:
+                    if not os.path.realpath(value).startswith(prefix): continue
+                    if not os.path.exists(value):
+                        logger.warn("%s %d: file %s is missing"%(klass.__tablename__, attr_id, value))
+                        continue
+                    stored.append((attr_id, value) + self.store_file(value))
+                to_remove = []
+                s = orm.sessionmaker(bind=self.engine)()
+                try:
+                    for attr_id, value, digest, path in stored:
+                        # Skip attributes changed since they were read
+                        if s.query(klass).filter(klass.id == attr_id, klass.value == value) \
+                                .update({klass.value:path}, synchronize_session=False) == 0: continue
+                        self.reference_files(s, [digest])
+                        to_remove.append(value)
+                    s.commit()
+                finally:
+                    s.close()
+                for path in to_remove:
+                    os.remove(path)
+                migrated += len(to_remove)
+                logger.info("Migrated %d files"%(migrated))
+        return migrated
+
+def main_migrate():
+    """Migrate the files of a repository to the sharded layout"""
+    parser = OptionParser(usage="%prog [options] <repository db url> <repository files directory>")
+    parser.add_option("--batch-size", type="int", default=MIGRATION_BATCH_SIZE, 
+                      help="number of files moved in each transaction [%default]")
+    parser.add_option("--compression", default=None, help="compress the files that compress well, with this codec")
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.print_usage()
+        return 1
+    
+    logging.basicConfig(level=logging.INFO)
+    repo = RepositoryDB({"db":args[0], "files":args[1], "compression":options.compression})
+    print "Migrated %d files"%(repo.migrate_files(options.batch_size))
+    return 0
@@ -3,7 +3,9 @@
 import unittest
 import tempfile
 import shutil
+import os
 import datetime
+import threading
 from dc24_ingester_platform.service import ingesterdb, repodb
 from jcudc24ingesterapi.models.locations import Region, Location
 from jcudc24ingesterapi.models.dataset import Dataset
@@ -14,7 +16,7 @@ from jcudc24ingesterapi.ingester_platform_api import UnitOfWork
 from jcudc24ingesterapi.models.data_sources import PullDataSource,\
     DatasetDataSource
 from jcudc24ingesterapi.models.sampling import PeriodicSampling
-from jcudc24ingesterapi.models.data_entry import DataEntry
+from jcudc24ingesterapi.models.data_entry import DataEntry, FileObject
 from jcudc24ingesterapi.ingester_exceptions import InvalidObjectError,\
     StaleObjectError, PersistenceError
 
@@ -203,6 +205,42 @@ class TestServiceModels(unittest.TestCase):
         self.assertEquals("xyz", data_source_state["test2"])
                 
                 
+    def test_bulk_sampler_state(self):
+        """Test that the sampler state of many datasets can be loaded and saved at once."""
+        self.assertEquals(0, len(self.service.get_sampler_states()))
+        self.service.persist_sampler_states({1:{"last_run":"10"}, 2:{"last_run":"20", "x":"y"}})
+        states = self.service.get_sampler_states()
+        self.assertEquals(2, len(states))
+        self.assertEquals({"last_run":"20", "x":"y"}, states[2])
+        
+        self.service.persist_sampler_states({2:{"last_run":"30"}})
+        states = self.service.get_sampler_states()
+        self.assertEquals({"last_run":"10"}, states[1])
+        self.assertEquals({"last_run":"30"}, states[2])
+        
+    def test_fetch_feedback(self):
+        """Fetch counts recorded by one node are taken, in order, once"""
+        self.assertEquals([], self.service.take_fetch_feedback())
+        self.service.record_fetch_feedback(1, 0)
+        self.service.record_fetch_feedback(2, None)
+        self.service.record_fetch_feedback(1, 3)
+        self.assertEquals([(1, 0), (2, None), (1, 3)], self.service.take_fetch_feedback())
+        self.assertEquals([], self.service.take_fetch_feedback())
+        
+    def test_script_profiles(self):
+        """Test that only the requested number of script runs are profiled, and their stats kept"""
+        self.assertFalse(self.service.take_script_profile_run(1))
+        self.service.request_script_profile(1, 2)
+        self.assertTrue(self.service.take_script_profile_run(1))
+        self.assertTrue(self.service.take_script_profile_run(1))
+        self.assertFalse(self.service.take_script_profile_run(1))
+        
+        self.service.persist_script_profile(1, datetime.datetime.now(), "stats")
+        profiles = self.service.get_script_profiles(1)
+        self.assertEquals(1, len(profiles))
+        self.assertEquals("stats", profiles[0]["stats"])
+        self.assertEquals(0, len(self.service.get_script_profiles(2)))
+                
     def test_dataset_data_source_unit(self):
         """This test creates a simple schema hierarchy, and tests updates, etc"""
         unit = UnitOfWork(None)
@@ -306,6 +344,328 @@ class TestServiceModels(unittest.TestCase):
         dataset1.version = 1
         dataset2 = self.service.persist(dataset1)
         self.assertEquals(2, dataset2.version)
-        
+
+    def test_persist_many(self):
+        """A batch of data entries is stored in one go, and each gets an ID"""
+        schema = DataEntrySchema("base1")
+        schema.addAttr(Double("x"))
+        schema = self.service.persist(schema)
+        loc = Location(10.0, 11.0)
+        loc = self.service.persist(loc)
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.service.persist(dataset)
+        
+        entries = []
+        for i in range(3):
+            entry = DataEntry(dataset.id, datetime.datetime.now())
+            entry["x"] = float(i)
+            entries.append(entry)
+        entries = self.service.persist_many(entries, None)
+        self.assertEquals(3, len(entries))
+        self.assertEquals(3, len(set([entry.id for entry in entries])))
+        self.assertEquals(2.0, float(self.service.get_data_entry(dataset.id, entries[2].id)["x"]))
+        
+        entry = DataEntry(dataset.id, datetime.datetime.now())
+        entry["y"] = 1.0
+        self.assertRaises(ValueError, self.service.persist_many, [entry], None)
+
+    def test_persist_many_progress(self):
+        """A repository that stores entries one at a time reports each as it is stored"""
+        schema = DataEntrySchema("base1")
+        schema.addAttr(Double("x"))
+        schema = self.service.persist(schema)
+        loc = self.service.persist(Location(10.0, 11.0))
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.service.persist(dataset)
+        
+        entries = []
+        for i in range(3):
+            entry = DataEntry(dataset.id, datetime.datetime.now())
+            entry["x"] = float(i)
+            entries.append(entry)
+        progress = []
+        self.repo.atomic_batches = False
+        self.assertEquals(3, len(self.service.persist_many(entries, None, progress.append)))
+        self.assertEquals([1, 2, 3], progress)
+        
+        # A batch stored as a single unit doesn't report progress
+        progress = []
+        self.repo.atomic_batches = True
+        self.assertEquals(3, len(self.service.persist_many(entries, None, progress.append)))
+        self.assertEquals([], progress)
+
+    def test_file_dedup(self):
+        """Identical files are stored once, and referenced by each data entry"""
+        schema = DataEntrySchema("base1")
+        schema.addAttr(FileDataType("file"))
+        schema = self.service.persist(schema)
+        loc = self.service.persist(Location(10.0, 11.0))
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.service.persist(dataset)
+        
+        cwd = tempfile.mkdtemp()
+        try:
+            entries = []
+            for i, content in enumerate(["same", "same", "different"]):
+                with open(os.path.join(cwd, "f%d"%i), "w") as f:
+                    f.write(content)
+                entry = DataEntry(dataset.id, datetime.datetime.now())
+                entry["file"] = FileObject(f_path="f%d"%i)
+                entries.append(entry)
+            entries = self.service.persist_many(entries[:2], cwd) + self.service.persist_many(entries[2:], cwd)
+        finally:
+            shutil.rmtree(cwd)
+        paths = [entry["file"].f_path for entry in entries]
+        self.assertEquals(paths[0], paths[1])
+        self.assertNotEquals(paths[0], paths[2])
+        with open(paths[1]) as f:
+            self.assertEquals("same", f.read())
+        s = repodb.orm.sessionmaker(bind=self.repo.engine)()
+        try:
+            self.assertEquals([1, 2], sorted([blob.refs for blob in s.query(repodb.FileBlob).all()]))
+        finally:
+            s.close()
+
+    def test_concurrent_file_store(self):
+        """Workers storing the same new file at the same time share one blob and its row"""
+        repo = repodb.RepositoryDB({"db":"sqlite:///" + os.path.join(self.files, "repo.db"),
+                                    "files":os.path.join(self.files, "repo"), "compression":"gzip"})
+        cwd = tempfile.mkdtemp()
+        try:
+            srcs = []
+            for i in range(4):
+                srcs.append(os.path.join(cwd, "f%d"%i))
+                with open(srcs[-1], "w") as f:
+                    f.write("2013-01-01T00:00:00,1.5,2.5\n" * 1000)
+            results = []
+            def store(src):
+                digest, path = repo.store_file(src)
+                s = repodb.orm.sessionmaker(bind=repo.engine)()
+                try:
+                    repo.reference_files(s, [digest])
+                    s.commit()
+                finally:
+                    s.close()
+                results.append(path)
+            workers = [threading.Thread(target=store, args=(src,)) for src in srcs]
+            for worker in workers: worker.start()
+            for worker in workers: worker.join()
+        finally:
+            shutil.rmtree(cwd)
+        self.assertEquals(4, len(results))
+        self.assertEquals(1, len(set(results)))
+        self.assertEquals([os.path.basename(results[0])], os.listdir(os.path.dirname(results[0])))
+        s = repodb.orm.sessionmaker(bind=repo.engine)()
+        try:
+            self.assertEquals([4], [blob.refs for blob in s.query(repodb.FileBlob).all()])
+        finally:
+            s.close()
+        f = repodb.open_stored_file(results[0])
+        try:
+            self.assertEquals("2013-01-01T00:00:00,1.5,2.5\n" * 1000, f.read())
+        finally:
+            f.close()
+
+    def test_compressed_files(self):
+        """Files that compress well are stored compressed, and read back as they were"""
+        self.repo = repodb.RepositoryDB({"db":"sqlite://", "files":self.files, "compression":"gzip"})
+        self.service = ingesterdb.IngesterServiceDB("sqlite://", self.repo)
+        schema = DataEntrySchema("base1")
+        schema.addAttr(FileDataType("file"))
+        schema = self.service.persist(schema)
+        loc = self.service.persist(Location(10.0, 11.0))
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.service.persist(dataset)
+        
+        cwd = tempfile.mkdtemp()
+        try:
+            content = "2013-01-01T00:00:00,1.5,2.5\n" * 1000
+            with open(os.path.join(cwd, "f"), "w") as f:
+                f.write(content)
+            entry = DataEntry(dataset.id, datetime.datetime.now())
+            entry["file"] = FileObject(f_path="f")
+            entry = self.service.persist_many([entry], cwd)[0]
+        finally:
+            shutil.rmtree(cwd)
+        self.assertTrue(entry["file"].f_path.endswith(".gz"))
+        self.assertTrue(os.path.getsize(entry["file"].f_path) < len(content) / 10)
+        f = self.service.get_data_entry_stream(dataset.id, entry.id, "file")
+        try:
+            self.assertEquals(content, f.read())
+        finally:
+            f.close()
+
+    def test_migrate_files(self):
+        """Files in the old flat layout are moved into the sharded store, and their paths updated"""
+        old_dir = os.path.join(self.files, "data_entry")
+        os.makedirs(old_dir)
+        s = repodb.orm.sessionmaker(bind=self.repo.engine)()
+        try:
+            for i in range(3):
+                obs = repodb.Observation()
+                obs.dataset = 1
+                s.add(obs)
+                s.flush()
+                path = os.path.join(old_dir, "%d-file"%obs.id)
+                with open(path, "w") as f:
+                    f.write("content %d"%(i % 2))
+                obs.attrs.append(repodb.ObservationAttr(name="file", value=path))
+                obs.attrs.append(repodb.ObservationAttr(name="x", value="1.0"))
+            s.commit()
+        finally:
+            s.close()
+        
+        self.assertEquals(3, self.repo.migrate_files(batch_size=2))
+        self.assertEquals(0, len(os.listdir(old_dir)))
+        s = repodb.orm.sessionmaker(bind=self.repo.engine)()
+        try:
+            paths = [attr.value for attr in s.query(repodb.ObservationAttr).filter(repodb.ObservationAttr.name == "file") \
+                        .order_by(repodb.ObservationAttr.id)]
+            self.assertEquals(paths[0], paths[2])
+            for i, path in enumerate(paths):
+                self.assertTrue(path.startswith(os.path.join(self.files, "blobs")))
+                with open(path) as f:
+                    self.assertEquals("content %d"%(i % 2), f.read())
+            self.assertEquals(["1.0"] * 3, [attr.value for attr in 
+                    s.query(repodb.ObservationAttr).filter(repodb.ObservationAttr.name == "x")])
+        finally:
+            s.close()
+        self.assertEquals(0, self.repo.migrate_files())
+
+    def test_migrate_files_path_spelling(self):
+        """Legacy paths are matched whatever spelling of the repository directory they were stored with"""
+        old_dir = os.path.join(self.files, "data_entry")
+        os.makedirs(old_dir)
+        link = self.files + "-link"
+        os.symlink(self.files, link)
+        sibling = self.files + "-old"
+        os.makedirs(os.path.join(sibling, "data_entry"))
+        try:
+            spellings = [os.path.join(link, "data_entry"), self.files + os.sep + os.sep + "data_entry",
+                         os.path.join(self.files, "x", os.pardir, "data_entry"), os.path.join(sibling, "data_entry")]
+            s = repodb.orm.sessionmaker(bind=self.repo.engine)()
+            try:
+                for i, spelling in enumerate(spellings):
+                    obs = repodb.Observation()
+                    obs.dataset = 1
+                    s.add(obs)
+                    s.flush()
+                    path = os.path.join(spelling, "%d-file"%obs.id)
+                    with open(path, "w") as f:
+                        f.write("content %d"%i)
+                    obs.attrs.append(repodb.ObservationAttr(name="file", value=path))
+                s.commit()
+            finally:
+                s.close()
+            
+            # Configured by way of the symlink this time
+            repo = repodb.RepositoryDB({"db":"sqlite://", "files":link + os.sep})
+            repo.engine = self.repo.engine
+            self.assertEquals(3, repo.migrate_files())
+            self.assertEquals(0, len(os.listdir(old_dir)))
+            self.assertEquals(1, len(os.listdir(os.path.join(sibling, "data_entry"))))
+        finally:
+            os.remove(link)
+            shutil.rmtree(sibling)
+
+class TestClusterLeases(unittest.TestCase):
+    """Two service instances sharing one database, as two ingester nodes would"""
+    def setUp(self):
+        self.files = tempfile.mkdtemp()
+        db = "sqlite:///" + os.path.join(self.files, "ingester.db")
+        self.repo = repodb.RepositoryDB({"db":"sqlite://", "files":self.files})
+        self.node1 = ingesterdb.IngesterServiceDB(db, self.repo)
+        self.node2 = ingesterdb.IngesterServiceDB(db, self.repo)
+
+    def tearDown(self):
+        del self.node1
+        del self.node2
+        del self.repo
+        shutil.rmtree(self.files)
+
+    def test_claim_tasks(self):
+        schema = DataEntrySchema("base1")
+        schema.addAttr(FileDataType("file"))
+        schema = self.node1.persist(schema)
+        loc = Location(10.0, 11.0)
+        loc.name = "Location"
+        loc = self.node1.persist(loc)
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.node1.persist(dataset)
+
+        task_ids = [self.node1.create_ingest_task(dataset.id, "/tmp/%d"%i) for i in range(3)]
+
+        claimed1 = self.node1.claim_ingest_tasks("node1", 2, 60)
+        self.assertEquals(task_ids[:2], [t[0] for t in claimed1])
+        claimed2 = self.node2.claim_ingest_tasks("node2", 2, 60)
+        self.assertEquals(task_ids[2:], [t[0] for t in claimed2])
+        self.assertEquals(0, len(self.node1.claim_ingest_tasks("node1", 2, 60)))
+
+        # Let node1's leases lapse, then node2 can take over its unfinished tasks
+        self.assertTrue(self.node1.mark_ingest_complete(task_ids[0], "node1"))
+        self.assertEquals(task_ids[:2], sorted(self.node1.renew_leases("node1", task_ids[:2], -1)))
+        claimed2 = self.node2.claim_ingest_tasks("node2", 2, 60)
+        self.assertEquals([task_ids[1]], [t[0] for t in claimed2])
+
+    def test_lost_lease(self):
+        """A node learns it has lost a task, and can't complete it"""
+        schema = DataEntrySchema("base1")
+        schema.addAttr(FileDataType("file"))
+        schema = self.node1.persist(schema)
+        loc = self.node1.persist(Location(10.0, 11.0))
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.node1.persist(dataset)
+        task_id = self.node1.create_ingest_task(dataset.id, "/tmp/0")
+        
+        self.assertEquals([task_id], [t[0] for t in self.node1.claim_ingest_tasks("node1", 1, -1)])
+        # The lease ran out before node1 renewed it, and node2 took the task over
+        self.assertEquals([task_id], [t[0] for t in self.node2.claim_ingest_tasks("node2", 1, 60)])
+        self.assertEquals([], self.node1.renew_leases("node1", [task_id], 60))
+        self.assertFalse(self.node1.mark_ingress_complete(task_id, "node1"))
+        self.assertFalse(self.node1.mark_ingest_complete(task_id, "node1"))
+        self.assertEquals([(task_id, 0)], [(t[0], t[1]) for t in self.node2.get_ingest_queue()])
+        
+        self.assertTrue(self.node2.mark_ingress_complete(task_id, "node2"))
+        self.assertTrue(self.node2.mark_ingest_complete(task_id, "node2"))
+        self.assertEquals([], self.node2.get_ingest_queue())
+
+    def test_roles(self):
+        self.assertTrue(self.node1.acquire_role("sampler", "node1", 60))
+        self.assertFalse(self.node2.acquire_role("sampler", "node2", 60))
+        self.assertTrue(self.node1.acquire_role("sampler", "node1", 60))
+
+        self.node1.release_role("sampler", "node1")
+        self.assertTrue(self.node2.acquire_role("sampler", "node2", -1))
+        # node2's lease has expired
+        self.assertTrue(self.node1.acquire_role("sampler", "node1", 60))
+
+    def test_modified_datasets(self):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.assertEquals(0, len(self.node2.get_modified_datasets(since)))
+        schema = DataEntrySchema("base1")
+        schema.addAttr(FileDataType("file"))
+        schema = self.node1.persist(schema)
+        loc = Location(10.0, 11.0)
+        loc.name = "Location"
+        loc = self.node1.persist(loc)
+        dataset = Dataset()
+        dataset.schema = schema.id
+        dataset.location = loc.id
+        dataset = self.node1.persist(dataset)
+
+        self.assertEquals([dataset.id], [ds.id for ds in self.node2.get_modified_datasets(since)])
+
 if __name__ == '__main__':
     unittest.main()
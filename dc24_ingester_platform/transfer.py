@@ -0,0 +1,51 @@
+"""
+Moving files between the push, staging and repository directories without
+copying their contents where possible.
+
+When the source and destination are on the same filesystem files are hard
+linked or renamed, which costs the same however big the file is. Otherwise
+they are copied through a COPY_BUFFER_SIZE buffer, as Python 2 has no way to
+have the kernel copy a file.
+"""
+import os
+import errno
+import shutil
+import logging
+
+logger = logging.getLogger("dc24_ingester_platform.transfer")
+
+# The read size used when a file has to be copied
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def copy_file(src, dst):
+    """Copy the contents of src to dst, replacing dst"""
+    with open(src, "rb") as f_in:
+        with open(dst, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+
+def link_file(src, dst):
+    """Make dst a hard link to src, replacing dst, or a copy of it if they are on
+    different filesystems or the filesystem can't link. The source is left in place,
+    so it can still be used if the operation using dst is retried.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    if hasattr(os, "link"):
+        try:
+            os.link(src, dst)
+            return
+        except OSError, e:
+            if e.errno == errno.ENOENT: raise
+            logger.debug("Could not link %s to %s, copying: %s"%(src, dst, str(e)))
+    copy_file(src, dst)
+
+def move_file(src, dst):
+    """Move src to dst by renaming it, or by copying it and removing the
+    original if they are on different filesystems"""
+    try:
+        os.rename(src, dst)
+        return
+    except OSError, e:
+        if e.errno != errno.EXDEV: raise
+    copy_file(src, dst)
+    os.remove(src)
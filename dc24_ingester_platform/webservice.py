@@ -17,6 +17,7 @@ from jcudc24ingesterapi.ingester_platform_api import Marshaller
 import traceback
 import inspect
 from jcudc24ingesterapi.ingester_exceptions import IngestPlatformError, InternalSystemError
+from dc24_ingester_platform.ingester.metrics import render_text
 
 logger = logging.getLogger(__name__)
 
@@ -217,6 +218,37 @@ class ManagementService(xmlrpc.XMLRPC):
             logger.exception("Error invoking ingester")
             raise xmlrpc.Fault(InternalSystemError.__xmlrpc_error__, str(e))
         
+    def xmlrpc_profileScript(self, dataset_id, runs):
+        """Profile the next runs of a dataset's processing script. 0 cancels profiling.
+        """
+        try:
+            return self.service.request_script_profile(dataset_id, runs)
+        except IngestPlatformError, e:
+            raise translate_exception(e)
+        except Exception, e:
+            logger.exception("Error requesting script profile")
+            raise xmlrpc.Fault(InternalSystemError.__xmlrpc_error__, str(e))
+
+    def xmlrpc_getScriptProfiles(self, dataset_id):
+        """Retrieve the stored profiles of a dataset's processing script
+        """
+        try:
+            return self.service.get_script_profiles(dataset_id)
+        except IngestPlatformError, e:
+            raise translate_exception(e)
+        except Exception, e:
+            logger.exception("Error getting script profiles")
+            raise xmlrpc.Fault(InternalSystemError.__xmlrpc_error__, str(e))
+
+    def xmlrpc_getMetrics(self):
+        """Retrieve a snapshot of the ingester pipeline metrics
+        """
+        try:
+            return self.service.get_metrics()
+        except Exception, e:
+            logger.exception("Error getting metrics")
+            raise xmlrpc.Fault(InternalSystemError.__xmlrpc_error__, str(e))
+        
     def xmlrpc_ping(self):
         """A simple connection diagnostic method.
         """
@@ -332,6 +364,18 @@ class DataController(Resource):
             request.setResponseCode(400)
             return "Invalid request"
 
+class MetricsController(Resource):
+    """Serves the ingester pipeline metrics as plain text, in the Prometheus format"""
+    isLeaf = True
+
+    def __init__(self, service):
+        Resource.__init__(self)
+        self.service = service
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return render_text(self.service.get_metrics())
+
 def makeServer(staging_dir, service):
     """Construct a management service server using the supplied service facade.
     """
@@ -341,3 +385,8 @@ def makeResettableServer(staging_dir, service):
     """Construct a management service server using the supplied service facade.
     """
     return DataController(service, ResettableManagementService(staging_dir, service))
+
+def makeMetricsServer(service):
+    """Construct a plain text metrics endpoint using the supplied service facade.
+    """
+    return MetricsController(service)
@@ -24,7 +24,9 @@ setup(name='jcu.dc24.ingesterplatform',
       entry_points={
           "console_scripts": [
           "run_ingester = dc24_ingester_platform.ingester.data_sources:main_ingress",
-          "run_script = dc24_ingester_platform.ingester.data_sources:main_script"]
+          "run_script = dc24_ingester_platform.ingester.data_sources:main_script",
+          "run_benchmark = dc24_ingester_platform.benchmark:main",
+          "migrate_repository = dc24_ingester_platform.service.repodb:main_migrate"]
       },
 )
 #      package_data={'twisted.plugins': ['twisted/plugins/dc24_ingester_platform.py']},